@@ -5,14 +5,20 @@ Architecture:
     Outer Layer - UI (Qt, console). Knows about storage layer and inner objects.
     No objects should use private/hidden members of other objects.
 '''
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from enum import Enum
 from fractions import Fraction
 from functools import partial
+from math import gcd
+import numbers
 import os
 from pathlib import Path
+import re
 import sqlite3
 import subprocess
 import sys
@@ -25,6 +31,8 @@ except ImportError:
 TITLE = 'bricbooks'
 PYSIDE2_VERSION = '5.15.1'
 CUR_DIR = Path(__file__).parent.resolve()
+MAX_SQL_VARIABLES = 900 #older SQLite versions limit statements to 999 variables
+LEDGER_WINDOW_DAYS = 90 #the ledger view starts out showing this many days of txns
 
 
 class CommodityType(Enum):
@@ -155,6 +163,8 @@ def increment_year(date_obj):
 
 class Account:
 
+    __slots__ = ('id', 'type', 'number', 'name', 'parent')
+
     def __init__(self, id_=None, type_=None, number=None, name=None, parent=None):
         self.id = id_
         if not type_:
@@ -198,6 +208,8 @@ class Account:
 
 class Payee:
 
+    __slots__ = ('name', 'notes', 'id')
+
     def __init__(self, name, notes=None, id_=None):
         if not name:
             raise Exception('must pass in a payee name')
@@ -217,29 +229,254 @@ class Payee:
         return self.id
 
 
+class Money:
+    '''An exact amount of money, stored as integer cents - arithmetic is just integer math, instead of Fraction math.
+    It acts like the equal Fraction (it compares & hashes the same, and has numerator & denominator), and str()
+    gives the same string as fraction_to_decimal. Money(value) validates value like get_validated_amount always has.'''
+
+    __slots__ = ('_cents',)
+
+    def __init__(self, value=0):
+        if isinstance(value, Money):
+            self._cents = value._cents
+            return
+        #try to only allow exact values (eg. no floats)
+        if isinstance(value, (int, str, Fraction)):
+            try:
+                amount = Fraction(value)
+            except (ValueError, ZeroDivisionError):
+                raise InvalidAmount(f'error generating Fraction from "{value}"')
+        else:
+            raise InvalidAmount(f'invalid value type: {type(value)} {value}')
+        if (100 % amount.denominator) != 0:
+            raise InvalidAmount('no fractions of cents allowed: %s' % value)
+        self._cents = amount.numerator * (100 // amount.denominator)
+
+    @classmethod
+    def from_cents(cls, cents):
+        money = object.__new__(cls)
+        money._cents = cents
+        return money
+
+    @property
+    def cents(self):
+        return self._cents
+
+    @property
+    def numerator(self):
+        return self._cents // gcd(self._cents, 100)
+
+    @property
+    def denominator(self):
+        return 100 // gcd(self._cents, 100)
+
+    def __str__(self):
+        whole, part = divmod(abs(self._cents), 100)
+        sign = '-' if self._cents < 0 else ''
+        if not part:
+            return f'{sign}{whole}'
+        if part % 10 == 0:
+            return f'{sign}{whole}.{part // 10}'
+        return f'{sign}{whole}.{part:02}'
+
+    def __repr__(self):
+        return f"Money('{self}')"
+
+    def __hash__(self):
+        if self._cents % 100 == 0:
+            return hash(self._cents // 100)
+        return hash(Fraction(self._cents, 100))
+
+    def __bool__(self):
+        return self._cents != 0
+
+    def __int__(self):
+        return int(Fraction(self._cents, 100))
+
+    def __float__(self):
+        return self._cents / 100
+
+    def _compare(self, other, op):
+        if isinstance(other, Money):
+            return op(self._cents, other._cents)
+        if isinstance(other, int):
+            return op(self._cents, other * 100)
+        if isinstance(other, Fraction):
+            return op(self._cents * other.denominator, other.numerator * 100)
+        return NotImplemented
+
+    def __eq__(self, other):
+        return self._compare(other, int.__eq__)
+
+    def __lt__(self, other):
+        return self._compare(other, int.__lt__)
+
+    def __le__(self, other):
+        return self._compare(other, int.__le__)
+
+    def __gt__(self, other):
+        return self._compare(other, int.__gt__)
+
+    def __ge__(self, other):
+        return self._compare(other, int.__ge__)
+
+    def __neg__(self):
+        return Money.from_cents(-self._cents)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return Money.from_cents(abs(self._cents))
+
+    #Money with Money (or an int) stays Money - anything else falls back to Fraction math
+    def __add__(self, other):
+        if isinstance(other, Money):
+            return Money.from_cents(self._cents + other._cents)
+        if isinstance(other, int):
+            return Money.from_cents(self._cents + other * 100)
+        if isinstance(other, Fraction):
+            return Fraction(self._cents, 100) + other
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self + -other
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __mul__(self, other):
+        if isinstance(other, int):
+            return Money.from_cents(self._cents * other)
+        if isinstance(other, (Money, Fraction)):
+            return Fraction(self._cents, 100) * Fraction(other)
+        return NotImplemented
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if isinstance(other, (Money, int, Fraction)):
+            return Fraction(self._cents, 100) / Fraction(other)
+        return NotImplemented
+
+    def __rtruediv__(self, other):
+        if isinstance(other, (int, Fraction)):
+            return Fraction(other) / Fraction(self._cents, 100)
+        return NotImplemented
+
+numbers.Rational.register(Money)
+
+
+def get_search_words(text):
+    #split text the way the FTS5 tokenizer does - words are runs of letters & numbers
+    return re.findall(r'[^\W_]+', text)
+
+
+def has_word_prefix(text, prefix):
+    '''SQL function for searching without FTS5: does text have a word that starts with prefix (ignoring case)?
+    Unlike FTS5, it doesn't ignore accents (so "cafe" doesn't match "café").'''
+    if not text:
+        return False
+    prefix = prefix.casefold()
+    return any(w.casefold().startswith(prefix) for w in get_search_words(text))
+
+
 def get_validated_amount(value):
-    amount = None
-    #try to only allow exact values (eg. no floats)
-    if isinstance(value, (int, str, Fraction)):
-        try:
-            amount = Fraction(value)
-        except InvalidOperation:
-            raise InvalidAmount('error generating Fraction from "{value}"')
-    else:
-        raise InvalidAmount(f'invalid value type: {type(value)} {value}')
-    if (100 % amount.denominator) != 0:
-        raise InvalidAmount('no fractions of cents allowed: %s' % value)
-    return amount
+    return Money(value)
 
 
 def fraction_to_decimal(f):
     return Decimal(f.numerator) / Decimal(f.denominator)
 
 
+def amount_to_cents(amount):
+    if isinstance(amount, Money):
+        return amount.cents
+    #amounts are validated to whole cents, so this is exact
+    return int(amount * 100)
+
+
+def cents_to_amount(cents):
+    return Money.from_cents(cents)
+
+
+class Split:
+    '''One account's part of a txn: a Money amount, and a status (None if it's not cleared or reconciled).
+    Splits used to be {'amount': ..., 'status': ...} dicts, so for code outside this module a Split also works like one
+    of those (with no 'status' key when there's no status), and compares equal to the matching dict. Code in here
+    should use the attributes.'''
+
+    __slots__ = ('amount', 'status')
+
+    def __init__(self, amount, status=None):
+        self.amount = amount
+        self.status = status
+
+    def keys(self):
+        if self.status:
+            return ['amount', 'status']
+        return ['amount']
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        if key == 'amount':
+            return self.amount
+        if key == 'status' and self.status:
+            return self.status
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key not in ['amount', 'status']:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def pop(self, key, *default):
+        if key == 'status' and self.status:
+            status = self.status
+            self.status = None
+            return status
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def __eq__(self, other):
+        if isinstance(other, Split):
+            return self.amount == other.amount and self.status == other.status
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
 def check_txn_splits(splits):
+    '''validate splits (a dict of {account: {'amount': ..., 'status': ...}} or {account: Split}), and return them as {account: Split}'''
     if not splits or len(splits.items()) < 2:
         raise InvalidTransactionError('transaction must have at least 2 splits')
-    total = Fraction(0)
+    total = Money(0)
+    checked_splits = {}
     for account, info in splits.items():
         if not account:
             raise InvalidTransactionError('must have a valid account in splits')
@@ -247,25 +484,20 @@ def check_txn_splits(splits):
             amount = get_validated_amount(info['amount'])
         except InvalidAmount as e:
             raise InvalidTransactionError('invalid split: %s' % e)
-        amt_str = str(amount)
         total += amount
-        info['amount'] = amount
-        if 'status' in info:
-            status = Transaction.handle_status(info['status'])
-            if status:
-                info['status'] = status
-            else:
-                info.pop('status')
-    if total != Fraction(0):
+        checked_splits[account] = Split(amount, Transaction.handle_status(info.get('status', None)))
+    if total:
         amounts = []
-        for account, info in splits.items():
-            amounts.append(str(fraction_to_decimal(info['amount'])))
+        for account, split in checked_splits.items():
+            amounts.append(str(fraction_to_decimal(split.amount)))
         raise InvalidTransactionError("splits don't balance: %s" % ', '.join(amounts))
-    return splits
+    return checked_splits
 
 
 class Transaction:
 
+    __slots__ = ('splits', 'txn_date', 'txn_type', 'payee', 'description', 'id')
+
     CLEARED = 'C'
     RECONCILED = 'R'
 
@@ -294,7 +526,7 @@ class Transaction:
             categories[input_categories] = {'amount': amount}
         elif isinstance(input_categories, dict):
             for acc, split_info in input_categories.items():
-                if isinstance(split_info, dict) and 'amount' in split_info:
+                if isinstance(split_info, (dict, Split)) and 'amount' in split_info:
                     categories[acc] = split_info
                 else:
                     raise InvalidTransactionError(f'invalid input categories: {input_categories}')
@@ -341,6 +573,25 @@ class Transaction:
         self.description = description
         self.id = id_
 
+    @classmethod
+    def from_storage(cls, txn_date, txn_type, splits, payee, description, id_, validate=False):
+        '''Build a txn from data that was validated before it was saved (a date, Money amounts, valid statuses, and
+        a Payee or None), without validating & parsing it all again. With validate, also run the data through the
+        regular constructor, and raise an error if that would have given something different.'''
+        txn = cls.__new__(cls)
+        txn.splits = splits
+        txn.txn_date = txn_date
+        txn.txn_type = txn_type
+        txn.payee = payee
+        txn.description = description
+        txn.id = id_
+        if validate:
+            checked = cls(txn_date=txn_date, txn_type=txn_type, splits={a: dict(info) for a, info in splits.items()},
+                    payee=payee, description=description, id_=id_)
+            if checked.splits != splits or checked.txn_date != txn_date:
+                raise InvalidTransactionError(f'txn {id_} from storage is invalid: {splits} {txn_date}')
+        return txn
+
     def __str__(self):
         return '%s: %s' % (self.id, self.txn_date)
 
@@ -362,13 +613,13 @@ class Transaction:
 
     def update_reconciled_state(self, account):
         #this updates the txn, instead of creating a new one - might want to change it
-        cur_status = self.splits[account].get('status', None)
-        if cur_status == Transaction.CLEARED:
-            self.splits[account]['status'] = Transaction.RECONCILED
-        elif cur_status == Transaction.RECONCILED:
-            self.splits[account].pop('status')
+        split = self.splits[account]
+        if split.status == Transaction.CLEARED:
+            split.status = Transaction.RECONCILED
+        elif split.status == Transaction.RECONCILED:
+            split.status = None
         else:
-            self.splits[account]['status'] = Transaction.CLEARED
+            split.status = Transaction.CLEARED
 
 
 def _categories_display(splits, main_account):
@@ -379,12 +630,12 @@ def _categories_display(splits, main_account):
     return 'multiple'
 
 
-def get_display_strings_for_ledger(account, txn):
-    '''txn can be either Transaction or ScheduledTransaction'''
-    amount = txn.splits[account]['amount']
-    if amount < Fraction(0):
+def get_display_strings_for_ledger(account, txn, balance=None):
+    '''txn can be either Transaction or ScheduledTransaction - pass in the txn's balance (eg. from Ledger.get_balances) to display it'''
+    amount = txn.splits[account].amount
+    if amount < 0:
         #make negative amount display as positive
-        withdrawal = str(fraction_to_decimal(amount * Fraction('-1')))
+        withdrawal = str(fraction_to_decimal(-amount))
         deposit = ''
     else:
         withdrawal = ''
@@ -407,30 +658,209 @@ def get_display_strings_for_ledger(account, txn):
         display_strings['frequency'] = str(txn.frequency)
         display_strings['txn_date'] = str(txn.next_due_date)
     else:
-        display_strings['status'] = txn.splits[account].get('status', '')
+        display_strings['status'] = txn.splits[account].status or ''
         display_strings['txn_date'] = str(txn.txn_date)
+    if balance is not None:
+        display_strings['balance'] = str(fraction_to_decimal(balance))
     return display_strings
 
 
 LedgerBalances = namedtuple('LedgerBalances', ['current', 'current_cleared'])
+#txns are newest first, balances line up with txns, and the cursors are None if there are no more txns that way
+TxnsPage = namedtuple('TxnsPage', ['txns', 'balances', 'older_cursor', 'newer_cursor'])
+
+
+class BalanceColumn:
+    '''Read-only running balances, lined up with a ledger's sorted txns. They're stored as integer cents
+    in an array, and read back as Money.'''
+
+    def __init__(self, cents):
+        self._cents = array('q', cents)
+
+    def __len__(self):
+        return len(self._cents)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return BalanceColumn(self._cents[index])
+        return cents_to_amount(self._cents[index])
+
+    def __iter__(self):
+        for cents in self._cents:
+            yield cents_to_amount(cents)
+
+    def __reversed__(self):
+        for cents in reversed(self._cents):
+            yield cents_to_amount(cents)
+
+    def __eq__(self, other):
+        if isinstance(other, BalanceColumn):
+            return self._cents == other._cents
+        if not isinstance(other, (list, tuple)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return 'BalanceColumn(%s)' % [str(fraction_to_decimal(b)) for b in self]
+
+
+class LedgerEntries:
+    '''A ledger's (sort key, amount, cleared amount, txn) entries, kept in order in blocks along with each block's
+    totals. Adding or removing an entry only touches one block, and a balance only needs the totals of the blocks
+    before it, instead of a pass over every entry.'''
+
+    BLOCK_SIZE = 500
+
+    def __init__(self):
+        self._keys = [] #sort keys for each block, for bisecting
+        self._entries = []
+        self._totals = [] #[amount, cleared amount] for each block
+        self._maxes = [] #last key in each block
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for block in self._entries:
+            yield from block
+
+    def _block_for_key(self, key):
+        index = bisect_left(self._maxes, key)
+        if index == len(self._maxes):
+            index -= 1
+        return index
+
+    def add(self, key, amount, cleared_amount, txn):
+        if not self._entries:
+            self._keys.append([key])
+            self._entries.append([(key, amount, cleared_amount, txn)])
+            self._totals.append([amount, cleared_amount])
+            self._maxes.append(key)
+        else:
+            index = self._block_for_key(key)
+            keys = self._keys[index]
+            position = bisect_left(keys, key)
+            keys.insert(position, key)
+            self._entries[index].insert(position, (key, amount, cleared_amount, txn))
+            self._totals[index][0] += amount
+            self._totals[index][1] += cleared_amount
+            self._maxes[index] = keys[-1]
+            if len(keys) > 2 * self.BLOCK_SIZE:
+                self._split_block(index)
+        self._len += 1
+
+    def _split_block(self, index):
+        keys = self._keys[index]
+        entries = self._entries[index]
+        half = len(keys) // 2
+        self._keys[index:index+1] = [keys[:half], keys[half:]]
+        self._entries[index:index+1] = [entries[:half], entries[half:]]
+        self._totals[index:index+1] = [self._sum_entries(entries[:half]), self._sum_entries(entries[half:])]
+        self._maxes[index:index+1] = [keys[half-1], keys[-1]]
+
+    @staticmethod
+    def _sum_entries(entries):
+        return [sum([e[1] for e in entries], Money(0)), sum([e[2] for e in entries], Money(0))]
+
+    def remove(self, key):
+        index = self._block_for_key(key)
+        keys = self._keys[index]
+        position = bisect_left(keys, key)
+        if position == len(keys) or keys[position] != key:
+            raise KeyError(key)
+        del keys[position]
+        _, amount, cleared_amount, _ = self._entries[index].pop(position)
+        self._totals[index][0] -= amount
+        self._totals[index][1] -= cleared_amount
+        if keys:
+            self._maxes[index] = keys[-1]
+        else:
+            del self._keys[index]
+            del self._entries[index]
+            del self._totals[index]
+            del self._maxes[index]
+        self._len -= 1
+
+    def get_balances_through_key(self, key):
+        '''returns (balance, cleared balance) of all the entries up to & including key'''
+        balance = Money(0)
+        cleared = Money(0)
+        for index, block_max in enumerate(self._maxes):
+            if block_max <= key:
+                balance += self._totals[index][0]
+                cleared += self._totals[index][1]
+            else:
+                position = bisect_right(self._keys[index], key)
+                for _, amount, cleared_amount, _ in self._entries[index][:position]:
+                    balance += amount
+                    cleared += cleared_amount
+                break
+        return balance, cleared
+
+    def get_balance_at(self, position):
+        '''balance through the entry at position (in sorted order)'''
+        if position < 0 or position >= self._len:
+            raise IndexError(position)
+        balance = Money(0)
+        for index, block in enumerate(self._entries):
+            if position < len(block):
+                for _, amount, _, _ in block[:position+1]:
+                    balance += amount
+                return balance
+            balance += self._totals[index][0]
+            position -= len(block)
 
 
 class Ledger:
+    '''An account's txns, in date order, with running balances. A ledger can hold just the txns from start through end
+    (either can be None) - then opening_balance & opening_cleared are the balances of everything before start.'''
 
-    def __init__(self, account=None):
+    def __init__(self, account=None, start=None, end=None, opening_balance=0, opening_cleared=0):
         if account is None:
             raise InvalidLedgerError('ledger must have an account')
         self.account = account
+        self.start = start
+        self.end = end
+        self.opening_balance = Money(opening_balance)
+        self.opening_cleared = Money(opening_cleared)
         self._txns = {}
+        self._entries = LedgerEntries()
+        self._txn_keys = {}
+        #txn id -> (amount, cleared amount) for the txns added before start, so they can be replaced or removed
+        self._opening_amounts = {}
         self._scheduled_txns = {}
+        self._balances = None
 
     def __str__(self):
         return '%s ledger' % self.account.name
 
     def add_transaction(self, txn):
+        '''add a txn (or replace the one with the same id) - the ledger stays sorted, so there's no re-sorting later'''
         if not txn.id:
             raise Exception('txn must have an id')
+        if txn.id in self._txns or txn.id in self._opening_amounts:
+            self.remove_txn(txn.id)
+        split = txn.splits[self.account]
+        amount = split.amount
+        if split.status in [Transaction.CLEARED, Transaction.RECONCILED]:
+            cleared_amount = amount
+        else:
+            cleared_amount = Money(0)
+        if self.start and txn.txn_date < self.start:
+            #outside the window, but it still counts toward the balances
+            self.opening_balance += amount
+            self.opening_cleared += cleared_amount
+            self._opening_amounts[txn.id] = (amount, cleared_amount)
+            self._balances = None
+            return
+        if self.end and txn.txn_date > self.end:
+            return
+        key = (txn.txn_date, txn.id)
+        self._entries.add(key, amount, cleared_amount, txn)
+        self._txn_keys[txn.id] = key
         self._txns[txn.id] = txn
+        self._balances = None
 
     def add_scheduled_transaction(self, scheduled_txn):
         self._scheduled_txns[scheduled_txn.id] = scheduled_txn
@@ -438,24 +868,32 @@ class Ledger:
     def _sort_txns(self, txns):
         return sorted(txns, key=lambda t: t.txn_date)
 
-    def _add_balance_to_txns(self, txns):
-        #txns must be sorted in chronological order (not reversed) already
-        txns_with_balance = []
-        balance = Fraction(0)
-        for t in txns:
-            balance = balance + t.splits[self.account]['amount']
-            t.balance = balance
-            txns_with_balance.append(t)
-        return txns_with_balance
-
-    def get_sorted_txns_with_balance(self, reverse=False):
+    def get_sorted_txns(self, reverse=False):
+        sorted_txns = [t for _, _, _, t in self._entries]
         if reverse:
-            sorted_txns = self._sort_txns(self._txns.values())
-            sorted_txns_with_balance = self._add_balance_to_txns(sorted_txns)
-            return list(reversed(sorted_txns_with_balance))
-        else:
-            sorted_txns = self._sort_txns(self._txns.values())
-            return self._add_balance_to_txns(sorted_txns)
+            sorted_txns.reverse()
+        return sorted_txns
+
+    def get_balances(self, reverse=False):
+        '''running balances, lined up with get_sorted_txns - calculated once & reused until the ledger changes'''
+        if self._balances is None:
+            cents = []
+            balance = amount_to_cents(self.opening_balance)
+            for _, amount, _, _ in self._entries:
+                balance += amount_to_cents(amount)
+                cents.append(balance)
+            self._balances = BalanceColumn(cents)
+        if reverse:
+            return self._balances[::-1]
+        return self._balances
+
+    def get_balance_at(self, position):
+        '''balance after the txn at position (in date order)'''
+        return self.opening_balance + self._entries.get_balance_at(position)
+
+    def get_txn_balance(self, txn_id):
+        '''balance after the txn with this id'''
+        return self.opening_balance + self._entries.get_balances_through_key(self._txn_keys[txn_id])[0]
 
     def search(self, search_term):
         results = []
@@ -471,24 +909,27 @@ class Ledger:
         return self._txns[id_]
 
     def remove_txn(self, id_):
-        del self._txns[id_]
+        if id_ in self._opening_amounts:
+            amount, cleared_amount = self._opening_amounts.pop(id_)
+            self.opening_balance -= amount
+            self.opening_cleared -= cleared_amount
+        else:
+            self._entries.remove(self._txn_keys.pop(id_))
+            del self._txns[id_]
+        self._balances = None
 
     def clear_txns(self):
         self._txns = {}
+        self._entries = LedgerEntries()
+        self._txn_keys = {}
+        self._balances = None
 
     def get_current_balances_for_display(self):
-        sorted_txns = self.get_sorted_txns_with_balance()
-        current = Fraction(0)
-        current_cleared = Fraction(0)
-        today = date.today()
-        for t in sorted_txns:
-            if t.txn_date <= today:
-                current = t.balance
-                if t.splits[self.account].get('status', None) in [Transaction.CLEARED, Transaction.RECONCILED]:
-                    current_cleared = current_cleared + t.splits[self.account]['amount']
+        #everything through the end of today
+        current, current_cleared = self._entries.get_balances_through_key((date.today(), float('inf')))
         return LedgerBalances(
-                current=str(fraction_to_decimal(current)),
-                current_cleared=str(fraction_to_decimal(current_cleared)),
+                current=str(fraction_to_decimal(self.opening_balance + current)),
+                current_cleared=str(fraction_to_decimal(self.opening_cleared + current_cleared)),
             )
 
     def get_payees(self):
@@ -503,14 +944,102 @@ class Ledger:
         return [t for t in all_scheduled_txns if t.is_due()]
 
 
+class LedgerColumns:
+    '''A compact, read-only version of an account's ledger, for displaying big ledgers. Each txn is just a row in
+    parallel arrays (date ordinal, amount in cents, status code, payee id, & txn id), sorted by date & txn id, and the
+    full Transactions are only built for the rows that are asked for. Use SQLiteStorage.get_ledger_columns to load one.'''
+
+    STATUS_CODES = {None: 0, Transaction.CLEARED: 1, Transaction.RECONCILED: 2}
+
+    def __init__(self, account, load_txns, opening_balance=0, opening_cleared=0):
+        self.account = account
+        self._load_txns = load_txns #function that takes a list of txn ids, and returns the Transactions
+        self.opening_balance = Money(opening_balance)
+        self.opening_cleared = Money(opening_cleared)
+        self.dates = array('i')
+        self.amounts = array('q')
+        self.statuses = array('b')
+        self.payee_ids = array('q') #0 for no payee
+        self.txn_ids = array('q')
+        self._balances = None
+        self._cleared_balances = None
+
+    def __len__(self):
+        return len(self.txn_ids)
+
+    def append(self, txn_date, amount_cents, status, payee_id, txn_id):
+        '''add a row - rows must be added in (date, txn id) order'''
+        self.dates.append(txn_date.toordinal())
+        self.amounts.append(amount_cents)
+        self.statuses.append(self.STATUS_CODES[status])
+        self.payee_ids.append(payee_id or 0)
+        self.txn_ids.append(txn_id)
+        self._balances = self._cleared_balances = None
+
+    def get_date(self, position):
+        return date.fromordinal(self.dates[position])
+
+    def get_position_for_date(self, txn_date):
+        '''position of the first row on or after txn_date'''
+        return bisect_left(self.dates, get_date(txn_date).toordinal())
+
+    def _running_totals(self, opening_amount, cleared_only=False):
+        cents = array('q')
+        balance = amount_to_cents(opening_amount)
+        for amount, status in zip(self.amounts, self.statuses):
+            if status or not cleared_only:
+                balance += amount
+            cents.append(balance)
+        return BalanceColumn(cents)
+
+    def get_balances(self):
+        '''running balances, lined up with the rows'''
+        if self._balances is None:
+            self._balances = self._running_totals(self.opening_balance)
+        return self._balances
+
+    def get_cleared_balances(self):
+        if self._cleared_balances is None:
+            self._cleared_balances = self._running_totals(self.opening_cleared, cleared_only=True)
+        return self._cleared_balances
+
+    def get_txns(self, start=0, stop=None):
+        '''build the Transactions for rows start through stop-1, in order'''
+        txn_ids = list(self.txn_ids[start:stop])
+        txns = {t.id: t for t in self._load_txns(txn_ids)}
+        return [txns[id_] for id_ in txn_ids]
+
+
 def splits_display(splits):
     account_amt_list = []
     for account, info in splits.items():
-        amount = info['amount']
+        amount = info.amount
         account_amt_list.append(f'{account.name}: {fraction_to_decimal(amount)}')
     return '; '.join(account_amt_list)
 
 
+class TxnQuery:
+    '''Filters for finding txns in any accounts - pass it to SQLiteStorage.query_txns.
+    Amounts are compared with the size of a split amount (so min_amount=500 matches a -600 withdrawal), and
+    statuses can include None for uncleared splits. The split filters (accounts, amounts, & statuses) must all match the same split.'''
+
+    def __init__(self, start_date=None, end_date=None, min_amount=None, max_amount=None, statuses=None, accounts=None, payee=None, text=None):
+        self.start_date = get_date(start_date) if start_date else None
+        self.end_date = get_date(end_date) if end_date else None
+        try:
+            self.min_amount = get_validated_amount(min_amount) if min_amount not in [None, ''] else None
+            self.max_amount = get_validated_amount(max_amount) if max_amount not in [None, ''] else None
+        except InvalidAmount as e:
+            raise InvalidTransactionError('invalid query amount: %s' % e)
+        if statuses:
+            self.statuses = [Transaction.handle_status(s) for s in statuses]
+        else:
+            self.statuses = None
+        self.accounts = accounts or None
+        self.payee = payee
+        self.text = text
+
+
 class ScheduledTransactionFrequency(Enum):
     WEEKLY = 'weekly'
     MONTHLY = 'monthly'
@@ -520,6 +1049,8 @@ class ScheduledTransactionFrequency(Enum):
 
 class ScheduledTransaction:
 
+    __slots__ = ('name', 'frequency', 'next_due_date', 'splits', 'txn_type', 'payee', 'description', 'status', 'id')
+
     @staticmethod
     def from_user_info(name, frequency, next_due_date, account, deposit, withdrawal, txn_date, txn_type, categories, payee, description, id_=None):
         splits = Transaction.splits_from_user_info(account, deposit, withdrawal, categories)
@@ -590,7 +1121,7 @@ class ScheduledTransaction:
 class Budget:
     '''Budget information that's entered by the user - no defaults or calculated values, but
     empty strings are dropped (so we can pass empty string from user form), and strings are converted to
-    Fraction values. Note: all accounts are passed in - if there's no budget info, it just has an empty {}.
+    Money values. Note: all accounts are passed in - if there's no budget info, it just has an empty {}.
     '''
 
     @staticmethod
@@ -627,7 +1158,7 @@ class Budget:
                 keep_info = {}
                 for key, value in info.items():
                     if key in ['amount', 'carryover']:
-                        if isinstance(value, Fraction) and value:
+                        if isinstance(value, (Money, Fraction)) and value:
                             keep_info[key] = value
                         elif not value:
                             continue
@@ -687,11 +1218,11 @@ class Budget:
                 if value:
                     report_info[key] = value
             if 'amount' in report_info:
-                carryover = report_info.get('carryover', Fraction(0))
-                income = report_info.get('income', Fraction(0))
+                carryover = report_info.get('carryover', Money(0))
+                income = report_info.get('income', Money(0))
                 if account.type == AccountType.EXPENSE:
                     report_info['total_budget'] = report_info['amount'] + carryover + income
-                    spent = report_info.get('spent', Fraction(0))
+                    spent = report_info.get('spent', Money(0))
                     report_info['remaining'] = report_info['total_budget'] - spent
                     try:
                         percent_available = (report_info['remaining'] / report_info['total_budget']) * Fraction(100)
@@ -705,10 +1236,10 @@ class Budget:
                     report_info['remaining_percent'] = '{}%'.format(Budget.round_percent_available(fraction_to_decimal(remaining_percent)))
                     report_info['current_status'] = Budget.get_current_status(current_date, self.start_date, self.end_date, remaining_percent)
             for key in report_info.keys():
-                if report_info[key] == Fraction(0):
+                if report_info[key] == 0:
                     report_info[key] = ''
                 else:
-                    if isinstance(report_info[key], Fraction):
+                    if isinstance(report_info[key], (Money, Fraction)):
                         decimal_value = Decimal(report_info[key].numerator) / Decimal(report_info[key].denominator)
                         report_info[key] = str(decimal_value)
                     else:
@@ -722,9 +1253,34 @@ class Budget:
 
 ### Storage ###
 
+class FractionSum:
+    '''SQLite aggregate that sums 'n/d' text values exactly - registered on the storage connection as fsum().
+    Empty strings (eg. a budget value with no carryover) are skipped like NULLs. Returns the total as 'n/d' text
+    (or NULL if there were no values, like SUM).'''
+
+    def __init__(self):
+        self._total = None
+
+    def step(self, value):
+        if value is None or value == '':
+            return
+        if self._total is None:
+            self._total = Fraction(0)
+        self._total += Fraction(value)
+
+    def finalize(self):
+        if self._total is None:
+            return None
+        return f'{self._total.numerator}/{self._total.denominator}'
+
+
 class SQLiteStorage:
 
-    def __init__(self, conn_name):
+    PAGE_OLDER = 'older'
+    PAGE_NEWER = 'newer'
+    BULK_SAVE_KEY = 'bulk_save'
+
+    def __init__(self, conn_name, validate_loaded_txns=False):
         if not conn_name:
             raise SQLiteStorageError('invalid SQLite connection name: %s' % conn_name)
         #conn_name is either ':memory:' or the name of the data file
@@ -738,9 +1294,22 @@ class SQLiteStorage:
         result = self._db_connection.execute('PRAGMA foreign_keys').fetchall()
         if result[0][0] != 1:
             print('WARNING: can\'t enable sqlite3 foreign_keys')
+        self._db_connection.create_aggregate('fsum', 1, FractionSum)
+        self._db_connection.create_function('has_word_prefix', 2, has_word_prefix)
         tables = self._db_connection.execute('SELECT name from sqlite_master WHERE type="table"').fetchall()
         if not tables:
             self._setup_db()
+        self._migrate()
+        #the search index is only created if this SQLite has FTS5, & that can't change while the file's open
+        self._search_index = bool(self._db_connection.execute('SELECT name FROM sqlite_master WHERE type = "table" AND name = "txn_search"').fetchall())
+        self._savepoint_depth = 0
+        self._new_id_objects = [] #for each open transaction block, the objects given ids inside it
+        self._cache_changes = [] #for each open transaction block, the (cache name, id) entries changed inside it
+        #re-check txns as they're loaded (for debugging) - see Transaction.from_storage
+        self._validate_loaded_txns = validate_loaded_txns
+        #identity map (each account id maps to one shared Account object) & payee indexes
+        #   - loaded as they're needed
+        self._clear_caches()
 
     def _setup_db(self):
         '''
@@ -766,9 +1335,311 @@ class SQLiteStorage:
         conn.execute('CREATE TABLE misc (key TEXT UNIQUE NOT NULL, value TEXT)')
         conn.execute('INSERT INTO misc(key, value) VALUES(?, ?)', ('schema_version', '0'))
         conn.execute('INSERT INTO commodities(type, code, name) VALUES(?, ?, ?)', (CommodityType.CURRENCY.value, 'USD', 'US Dollar'))
+        conn.commit()
+
+    def _clear_caches(self):
+        self._accounts = {}
+        self._all_accounts_loaded = False
+        self._payees_by_id = {}
+        self._payees_by_name = {}
+        self._all_payees_loaded = False
+
+    @contextmanager
+    def transaction(self):
+        '''Group storage changes into one unit of work:
+            with storage.transaction():
+                storage.save_txn(txn)
+                storage.save_scheduled_transaction(scheduled_txn)
+        Storage methods don't commit inside the block - everything is committed at the end
+        of the outermost block, or rolled back if there's an exception. Blocks can be nested
+        (each one is a SAVEPOINT), and an exception only rolls back the innermost block it leaves.'''
+        self._savepoint_depth += 1
+        savepoint = f'bricbooks_{self._savepoint_depth}'
+        self._new_id_objects.append([])
+        self._cache_changes.append([])
+        try:
+            self._db_connection.execute(f'SAVEPOINT {savepoint}')
+            try:
+                yield
+            except BaseException:
+                self._db_connection.execute(f'ROLLBACK TO {savepoint}')
+                self._db_connection.execute(f'RELEASE {savepoint}')
+                #the rows are gone, so the objects that were given ids for them shouldn't keep them
+                for obj in self._new_id_objects[-1]:
+                    obj.id = None
+                #put the cached objects changed in the block back the way they are in the DB - update them in place,
+                # since the GUI & ledgers may be holding on to them
+                for cache, id_ in reversed(self._cache_changes[-1]):
+                    self._refresh_cached(cache, id_)
+                raise
+            if self._savepoint_depth == 1:
+                self._db_connection.commit()
+            else:
+                self._db_connection.execute(f'RELEASE {savepoint}')
+                #if the outer block is rolled back, these ids have to be undone too
+                self._new_id_objects[-2].extend(self._new_id_objects[-1])
+                self._cache_changes[-2].extend(self._cache_changes[-1])
+        finally:
+            self._new_id_objects.pop()
+            self._cache_changes.pop()
+            self._savepoint_depth -= 1
+
+    def _set_new_id(self, obj, id_):
+        '''give obj the id of its newly-inserted row (must be called inside a transaction block)'''
+        obj.id = id_
+        self._new_id_objects[-1].append(obj)
+
+    def _note_cache_change(self, cache, id_):
+        '''record that the cached account or payee with this id is being changed (must be called inside a transaction block)'''
+        self._cache_changes[-1].append((cache, id_))
+
+    def _refresh_cached(self, cache, id_):
+        '''reload a cached account or payee from the DB (or drop it if its row is gone), keeping the same object'''
+        if cache == 'account':
+            record = self._db_connection.execute('SELECT id, type, number, name, parent_id FROM accounts WHERE id = ?', (id_,)).fetchone()
+            if record:
+                self._account_from_db_record(record)
+            else:
+                self._accounts.pop(id_, None)
+        else:
+            payee = self._payees_by_id.pop(id_, None)
+            if payee and self._payees_by_name.get(payee.name) is payee:
+                del self._payees_by_name[payee.name]
+            elif payee:
+                #renamed since it was indexed
+                for name, cached_payee in list(self._payees_by_name.items()):
+                    if cached_payee is payee:
+                        del self._payees_by_name[name]
+            record = self._db_connection.execute('SELECT name, notes FROM payees WHERE id = ?', (id_,)).fetchone()
+            if record:
+                if payee:
+                    payee.name, payee.notes = record
+                else:
+                    payee = Payee(id_=id_, name=record[0], notes=record[1])
+                self._payees_by_id[id_] = payee
+                self._payees_by_name[payee.name] = payee
+
+    def _get_migrations(self):
+        '''Schema changes since version 0 - migration N upgrades the DB from schema version N-1 to N.
+        Only ever add to the end of this list.'''
+        return [
+            self._migration_add_indexes,
+            self._migration_add_split_cents,
+            self._migration_add_search_index,
+            self._migration_add_balance_checkpoints,
+            self._migration_add_account_ancestors,
+            self._migration_skip_insert_triggers_for_bulk_saves,
+        ]
+
+    def _migrate(self):
+        '''Upgrade the DB to the current schema version, running each migration in its own transaction.'''
+        conn = self._db_connection
+        migrations = self._get_migrations()
+        schema_version = int(conn.execute('SELECT value FROM misc WHERE key = ?', ('schema_version',)).fetchone()[0])
+        if schema_version > len(migrations):
+            raise SQLiteStorageError(f'data file schema version {schema_version} is newer than this version of {TITLE} supports')
+        for version, migration in enumerate(migrations[schema_version:], start=schema_version+1):
+            conn.execute('BEGIN')
+            try:
+                migration()
+                conn.execute('UPDATE misc SET value = ? WHERE key = ?', (str(version), 'schema_version'))
+            except Exception:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def _migration_add_indexes(self):
+        conn = self._db_connection
+        conn.execute('CREATE INDEX transaction_splits_account_id ON transaction_splits(account_id)')
+        conn.execute('CREATE INDEX transaction_splits_txn_id ON transaction_splits(txn_id)')
+        conn.execute('CREATE INDEX transactions_date ON transactions(date)')
+        conn.execute('CREATE INDEX scheduled_transaction_splits_account_id ON scheduled_transaction_splits(account_id)')
+        conn.execute('CREATE INDEX scheduled_transaction_splits_scheduled_txn_id ON scheduled_transaction_splits(scheduled_txn_id)')
+        conn.execute('CREATE INDEX budget_values_budget_id ON budget_values(budget_id)')
+
+    def _migration_add_split_cents(self):
+        #store split amounts as integer cents as well, so SQLite can sum them
+        conn = self._db_connection
+        conn.execute('ALTER TABLE transaction_splits ADD COLUMN value_cents INTEGER')
+        records = conn.execute('SELECT id, value FROM transaction_splits').fetchall()
+        conn.executemany('UPDATE transaction_splits SET value_cents = ? WHERE id = ?',
+                [(amount_to_cents(get_validated_amount(value)), id_) for id_, value in records])
+
+    def _migration_add_search_index(self):
+        #full-text index of txn description, payee name & split descriptions (rowid is the txn id), kept up to date by triggers.
+        # If this SQLite doesn't have FTS5, skip it - search_txns falls back to matching word prefixes with
+        # the has_word_prefix SQL function.
+        conn = self._db_connection
+        try:
+            conn.execute('CREATE VIRTUAL TABLE txn_search USING fts5(description, payee, split_descriptions)')
+        except sqlite3.OperationalError:
+            return
+        payee_name_sql = '(SELECT name FROM payees WHERE id = new.payee_id)'
+        split_descriptions_sql = self._split_descriptions_sql
+        conn.execute('CREATE TRIGGER txn_search_insert AFTER INSERT ON transactions BEGIN '\
+                'INSERT INTO txn_search(rowid, description, payee, split_descriptions) '\
+                f'VALUES (new.id, new.description, {payee_name_sql}, {split_descriptions_sql("new.id")}); END')
+        conn.execute('CREATE TRIGGER txn_search_update AFTER UPDATE ON transactions BEGIN '\
+                f'UPDATE txn_search SET description = new.description, payee = {payee_name_sql} WHERE rowid = new.id; END')
+        conn.execute('CREATE TRIGGER txn_search_delete AFTER DELETE ON transactions BEGIN '\
+                'DELETE FROM txn_search WHERE rowid = old.id; END')
+        conn.execute('CREATE TRIGGER txn_search_payee_update AFTER UPDATE OF name ON payees BEGIN '\
+                'UPDATE txn_search SET payee = new.name WHERE rowid IN (SELECT id FROM transactions WHERE payee_id = new.id); END')
+        conn.execute('CREATE TRIGGER txn_search_split_insert AFTER INSERT ON transaction_splits BEGIN '\
+                f'UPDATE txn_search SET split_descriptions = {split_descriptions_sql("new.txn_id")} WHERE rowid = new.txn_id; END')
+        conn.execute('CREATE TRIGGER txn_search_split_update AFTER UPDATE OF description ON transaction_splits BEGIN '\
+                f'UPDATE txn_search SET split_descriptions = {split_descriptions_sql("new.txn_id")} WHERE rowid = new.txn_id; END')
+        conn.execute('CREATE TRIGGER txn_search_split_delete AFTER DELETE ON transaction_splits BEGIN '\
+                f'UPDATE txn_search SET split_descriptions = {split_descriptions_sql("old.txn_id")} WHERE rowid = old.txn_id; END')
+        conn.execute('INSERT INTO txn_search(rowid, description, payee, split_descriptions) '\
+                f'SELECT transactions.id, transactions.description, payees.name, {split_descriptions_sql("transactions.id")} '\
+                'FROM transactions LEFT OUTER JOIN payees ON transactions.payee_id = payees.id')
+
+    def _migration_add_balance_checkpoints(self):
+        #each account's balance & cleared balance through the end of each month it has splits in (month is 'YYYY-MM'),
+        # kept up to date by triggers - see account_balance
+        conn = self._db_connection
+        conn.execute('CREATE TABLE balance_checkpoints (account_id INTEGER NOT NULL, month TEXT NOT NULL, balance_cents INTEGER NOT NULL, cleared_cents INTEGER NOT NULL,'\
+                'PRIMARY KEY(account_id, month), FOREIGN KEY(account_id) REFERENCES accounts(id))')
+        previous_checkpoint_sql = self._previous_checkpoint_sql
+        cleared_sql = self._cleared_cents_sql
+        add_new_split_sql = self._checkpoint_change_trigger_sql('new.account_id', self._split_month_sql('new.txn_id'), 'new.value_cents', cleared_sql('new'))
+        remove_old_split_sql = self._checkpoint_change_trigger_sql('old.account_id', self._split_month_sql('old.txn_id'), '-old.value_cents', f'-{cleared_sql("old")}')
+        conn.execute(f'CREATE TRIGGER balance_checkpoints_split_insert AFTER INSERT ON transaction_splits BEGIN {add_new_split_sql} END')
+        conn.execute(f'CREATE TRIGGER balance_checkpoints_split_delete AFTER DELETE ON transaction_splits BEGIN {remove_old_split_sql} END')
+        conn.execute('CREATE TRIGGER balance_checkpoints_split_update AFTER UPDATE OF txn_id, account_id, value_cents, reconciled_state ON transaction_splits '\
+                f'BEGIN {remove_old_split_sql} {add_new_split_sql} END')
+        #when a txn moves to a different month, move its splits' amounts to the new month
+        split_sum_sql = 'COALESCE((SELECT SUM(%s) FROM transaction_splits s WHERE s.txn_id = new.id AND s.account_id = balance_checkpoints.account_id), 0)'
+        txn_accounts_sql = '(SELECT account_id FROM transaction_splits WHERE txn_id = new.id)'
+        old_month = 'substr(old.date, 1, 7)'
+        new_month = 'substr(new.date, 1, 7)'
+        conn.execute('CREATE TRIGGER balance_checkpoints_txn_date_update AFTER UPDATE OF date ON transactions '\
+                f'WHEN {old_month} != {new_month} BEGIN '\
+                f'UPDATE balance_checkpoints SET balance_cents = balance_cents - {split_sum_sql % "s.value_cents"}, cleared_cents = cleared_cents - {split_sum_sql % cleared_sql("s")} '\
+                f'WHERE month >= {old_month} AND account_id IN {txn_accounts_sql}; '\
+                'INSERT OR IGNORE INTO balance_checkpoints(account_id, month, balance_cents, cleared_cents) '\
+                f'SELECT s.account_id, {new_month}, {previous_checkpoint_sql("balance_cents", "s.account_id", new_month)}, {previous_checkpoint_sql("cleared_cents", "s.account_id", new_month)} '\
+                'FROM transaction_splits s WHERE s.txn_id = new.id; '\
+                f'UPDATE balance_checkpoints SET balance_cents = balance_cents + {split_sum_sql % "s.value_cents"}, cleared_cents = cleared_cents + {split_sum_sql % cleared_sql("s")} '\
+                f'WHERE month >= {new_month} AND account_id IN {txn_accounts_sql}; END')
+        #set up checkpoints for the existing txns
+        records = conn.execute(f'SELECT account_id, substr(transactions.date, 1, 7) AS month, SUM(value_cents), SUM({cleared_sql("transaction_splits")}) '\
+                'FROM transaction_splits INNER JOIN transactions ON transaction_splits.txn_id = transactions.id '\
+                'GROUP BY account_id, month ORDER BY account_id, month').fetchall()
+        checkpoints = []
+        totals = {}
+        for account_id, month, cents, cleared_cents in records:
+            balance, cleared = totals.get(account_id, (0, 0))
+            totals[account_id] = (balance + cents, cleared + cleared_cents)
+            checkpoints.append((account_id, month) + totals[account_id])
+        conn.executemany('INSERT INTO balance_checkpoints(account_id, month, balance_cents, cleared_cents) VALUES (?, ?, ?, ?)', checkpoints)
+
+    @staticmethod
+    def _split_descriptions_sql(txn_id):
+        return f"(SELECT group_concat(description, ' ') FROM transaction_splits WHERE txn_id = {txn_id})"
+
+    @staticmethod
+    def _cleared_cents_sql(split):
+        return f"(CASE WHEN {split}.reconciled_state IN ('{Transaction.CLEARED}', '{Transaction.RECONCILED}') THEN {split}.value_cents ELSE 0 END)"
+
+    @staticmethod
+    def _previous_checkpoint_sql(column, account_id, month):
+        return f'COALESCE((SELECT {column} FROM balance_checkpoints WHERE account_id = {account_id} AND month < {month} ORDER BY month DESC LIMIT 1), 0)'
+
+    @staticmethod
+    def _split_month_sql(txn_id):
+        return f'(SELECT substr(date, 1, 7) FROM transactions WHERE id = {txn_id})'
+
+    @classmethod
+    def _checkpoint_change_sql(cls, account_id, month, cents, cleared_cents):
+        #make sure there's a checkpoint for the month, then add the change to it & all the later checkpoints
+        return [
+                'INSERT OR IGNORE INTO balance_checkpoints(account_id, month, balance_cents, cleared_cents) '\
+                f'VALUES ({account_id}, {month}, {cls._previous_checkpoint_sql("balance_cents", account_id, month)}, {cls._previous_checkpoint_sql("cleared_cents", account_id, month)})',
+                f'UPDATE balance_checkpoints SET balance_cents = balance_cents + {cents}, cleared_cents = cleared_cents + {cleared_cents} '\
+                f'WHERE account_id = {account_id} AND month >= {month}',
+            ]
+
+    @classmethod
+    def _checkpoint_change_trigger_sql(cls, account_id, month, cents, cleared_cents):
+        return ' '.join([f'{statement};' for statement in cls._checkpoint_change_sql(account_id, month, cents, cleared_cents)])
+
+    def _migration_add_account_ancestors(self):
+        #closure table of the account tree - a row for every (account, ancestor) pair, including each account as
+        # its own ancestor at depth 0, so subtree totals are just a join - see get_rollup_totals.
+        # save_account keeps it up to date.
+        conn = self._db_connection
+        conn.execute('CREATE TABLE account_ancestors (account_id INTEGER NOT NULL, ancestor_id INTEGER NOT NULL, depth INTEGER NOT NULL,'\
+                'PRIMARY KEY(account_id, ancestor_id), FOREIGN KEY(account_id) REFERENCES accounts(id), FOREIGN KEY(ancestor_id) REFERENCES accounts(id))')
+        conn.execute('CREATE INDEX account_ancestors_ancestor_id ON account_ancestors(ancestor_id)')
+        self._rebuild_account_ancestors()
+
+    def _migration_skip_insert_triggers_for_bulk_saves(self):
+        #the insert triggers update the search index for each txn & split, and every later checkpoint for each split, which
+        # is too slow for bulk loads - while the bulk save flag is set, _save_txns_batch does that work itself.
+        conn = self._db_connection
+        not_bulk_save_sql = f"NOT EXISTS (SELECT 1 FROM misc WHERE key = '{self.BULK_SAVE_KEY}')"
+        add_new_split_sql = self._checkpoint_change_trigger_sql('new.account_id', self._split_month_sql('new.txn_id'), 'new.value_cents', self._cleared_cents_sql('new'))
+        conn.execute('DROP TRIGGER balance_checkpoints_split_insert')
+        conn.execute('CREATE TRIGGER balance_checkpoints_split_insert AFTER INSERT ON transaction_splits '\
+                f'WHEN {not_bulk_save_sql} BEGIN {add_new_split_sql} END')
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'txn_search_insert'").fetchone():
+            conn.execute('DROP TRIGGER txn_search_insert')
+            conn.execute('CREATE TRIGGER txn_search_insert AFTER INSERT ON transactions '\
+                    f'WHEN {not_bulk_save_sql} BEGIN '\
+                    'INSERT INTO txn_search(rowid, description, payee, split_descriptions) '\
+                    'VALUES (new.id, new.description, (SELECT name FROM payees WHERE id = new.payee_id), '\
+                    f'{self._split_descriptions_sql("new.id")}); END')
+            conn.execute('DROP TRIGGER txn_search_split_insert')
+            conn.execute('CREATE TRIGGER txn_search_split_insert AFTER INSERT ON transaction_splits '\
+                    f'WHEN {not_bulk_save_sql} BEGIN '\
+                    f'UPDATE txn_search SET split_descriptions = {self._split_descriptions_sql("new.txn_id")} WHERE rowid = new.txn_id; END')
+
+    def _rebuild_account_ancestors(self):
+        conn = self._db_connection
+        parent_ids = dict(conn.execute('SELECT id, parent_id FROM accounts').fetchall())
+        rows = []
+        for account_id in parent_ids:
+            ancestor_id = account_id
+            depth = 0
+            while ancestor_id:
+                if depth > len(parent_ids):
+                    raise Exception(f'account {account_id} is its own ancestor')
+                rows.append((account_id, ancestor_id, depth))
+                ancestor_id = parent_ids.get(ancestor_id)
+                depth += 1
+        conn.execute('DELETE FROM account_ancestors')
+        conn.executemany('INSERT INTO account_ancestors(account_id, ancestor_id, depth) VALUES (?, ?, ?)', rows)
+
+    def _has_search_index(self):
+        return self._search_index
+
+    def _account_from_db_record(self, record):
+        '''return the shared Account object for this db record, creating it or refreshing its data as needed'''
+        id_, type_, number, name, parent_id = record
+        parent = None
+        if parent_id:
+            parent = self.get_account(parent_id)
+        account = self._accounts.get(id_)
+        if account:
+            account.type = AccountType(type_)
+            account.number = number
+            account.name = name
+            account.parent = parent
+        else:
+            account = Account(id_=id_, type_=AccountType(type_), number=number, name=name, parent=parent)
+            self._accounts[id_] = account
+        return account
 
     def get_account(self, id_=None, number=None, name=None):
         if id_:
+            try:
+                id_ = int(id_)
+            except ValueError:
+                raise Exception(f'no account with id "{id_}"')
+            if id_ in self._accounts:
+                return self._accounts[id_]
             account_info = self._db_connection.execute('SELECT id, type, number, name, parent_id FROM accounts WHERE id = ?', (id_,)).fetchone()
             if not account_info:
                 raise Exception(f'no account with id "{id_}"')
@@ -782,120 +1653,227 @@ class SQLiteStorage:
                 raise Exception(f'no account with name "{name}"')
         else:
             raise Exception('must pass in id_ or name')
-        parent = None
-        if account_info[4]:
-            parent = self.get_account(account_info[4])
-        return Account(
-                id_=account_info[0],
-                type_=AccountType(account_info[1]),
-                number=account_info[2],
-                name=account_info[3],
-                parent=parent,
-            )
+        return self._account_from_db_record(account_info)
 
     def save_account(self, account):
-        c = self._db_connection.cursor()
-        parent_id = None
-        if account.parent:
-            parent_id = account.parent.id
-        if account.id:
-            c.execute('UPDATE accounts SET type = ?, number = ?, name = ?, parent_id = ? WHERE id = ?',
-                    (account.type.value, account.number, account.name, parent_id, account.id))
-            if c.rowcount < 1:
-                raise Exception('no account with id %s to update' % account.id)
-        else:
-            c.execute('INSERT INTO accounts(type, commodity_id, number, name, parent_id) VALUES(?, ?, ?, ?, ?)', (account.type.value, 1, account.number, account.name, parent_id))
-            account.id = c.lastrowid
-        self._db_connection.commit()
+        with self.transaction():
+            c = self._db_connection.cursor()
+            parent_id = None
+            if account.parent:
+                parent_id = account.parent.id
+            if account.id:
+                old_parent = c.execute('SELECT parent_id FROM accounts WHERE id = ?', (account.id,)).fetchone()
+                c.execute('UPDATE accounts SET type = ?, number = ?, name = ?, parent_id = ? WHERE id = ?',
+                        (account.type.value, account.number, account.name, parent_id, account.id))
+                if c.rowcount < 1:
+                    raise Exception('no account with id %s to update' % account.id)
+                if old_parent[0] != parent_id:
+                    #the whole subtree moved - just rebuild the closure table
+                    self._rebuild_account_ancestors()
+            else:
+                c.execute('INSERT INTO accounts(type, commodity_id, number, name, parent_id) VALUES(?, ?, ?, ?, ?)', (account.type.value, 1, account.number, account.name, parent_id))
+                self._set_new_id(account, c.lastrowid)
+                #a new account's ancestors are itself, plus its parent's ancestors
+                c.execute('INSERT INTO account_ancestors(account_id, ancestor_id, depth) VALUES (?, ?, 0)', (account.id, account.id))
+                c.execute('INSERT INTO account_ancestors(account_id, ancestor_id, depth) '\
+                        'SELECT ?, ancestor_id, depth + 1 FROM account_ancestors WHERE account_id = ?', (account.id, parent_id))
+            #keep the identity map in sync - other objects may be holding on to the cached Account
+            self._note_cache_change('account', account.id)
+            cached_account = self._accounts.get(account.id)
+            if cached_account and cached_account is not account:
+                cached_account.type = account.type
+                cached_account.number = account.number
+                cached_account.name = account.name
+                if parent_id:
+                    cached_account.parent = self.get_account(parent_id)
+                else:
+                    cached_account.parent = None
+            else:
+                self._accounts[account.id] = account
+
+    def _load_payees(self):
+        '''load all payees into the in-memory indexes (once per storage object)'''
+        if not self._all_payees_loaded:
+            for r in self._db_connection.execute('SELECT id, name, notes FROM payees ORDER BY id'):
+                payee = Payee(id_=r[0], name=r[1], notes=r[2])
+                self._payees_by_id[payee.id] = payee
+                self._payees_by_name[payee.name] = payee
+            self._all_payees_loaded = True
 
     def get_payee(self, id_=None, name=None):
         '''return None if object can't be found for whatever reason'''
+        self._load_payees()
         if id_:
-            info = self._db_connection.execute('SELECT id, name, notes FROM payees WHERE id = ?', (id_,)).fetchone()
-            if not info:
+            try:
+                return self._payees_by_id.get(int(id_))
+            except ValueError:
                 return None
         elif name:
-            info = self._db_connection.execute('SELECT id, name, notes FROM payees WHERE name = ?', (name,)).fetchone()
-            if not info:
-                return None
+            return self._payees_by_name.get(name)
         else:
             return None
-        return Payee(
-                id_=info[0],
-                name=info[1],
-                notes=info[2]
-            )
 
     def get_payees(self):
-        results = self._db_connection.execute('SELECT id, name, notes FROM payees').fetchall()
-        payees = []
-        for r in results:
-            payees.append(Payee(id_=r[0], name=r[1], notes=r[2]))
-        return payees
+        self._load_payees()
+        return list(self._payees_by_id.values())
 
     def save_payee(self, payee):
-        c = self._db_connection.cursor()
-        if payee.id:
-            c.execute('UPDATE payees SET name = ?, notes = ?', (payee.name, payee.notes))
-            if c.rowcount < 1:
-                raise Exception('no payee with id %s to update' % payee.id)
-        else:
-            c.execute('INSERT INTO payees(name, notes) VALUES(?, ?)', (payee.name, payee.notes))
-            payee.id = c.lastrowid
-        self._db_connection.commit()
-
-    def _get_accounts_by_type(self, type_):
-        db_records = self._db_connection.execute('SELECT id FROM accounts WHERE type = ? ORDER BY id', (type_.value,)).fetchall()
-        accounts = []
-        for r in db_records:
-            accounts.append(self.get_account(r[0]))
-        return accounts
+        with self.transaction():
+            self._load_payees()
+            c = self._db_connection.cursor()
+            old_name = None
+            if payee.id:
+                #get the saved name from the DB - the cached payee may be this object, with the new name already set
+                record = c.execute('SELECT name FROM payees WHERE id = ?', (payee.id,)).fetchone()
+                if not record:
+                    raise Exception('no payee with id %s to update' % payee.id)
+                old_name = record[0]
+                c.execute('UPDATE payees SET name = ?, notes = ? WHERE id = ?', (payee.name, payee.notes, payee.id))
+            else:
+                c.execute('INSERT INTO payees(name, notes) VALUES(?, ?)', (payee.name, payee.notes))
+                self._set_new_id(payee, c.lastrowid)
+            self._note_cache_change('payee', payee.id)
+            if old_name is not None:
+                self._payees_by_name.pop(old_name, None)
+            self._payees_by_id[payee.id] = payee
+            self._payees_by_name[payee.name] = payee
+
+    def resolve_payees(self, names):
+        '''Return {name: Payee} for all the names, creating any payees that aren't in the DB yet.
+        New payees are inserted together, with one commit.'''
+        with self.transaction():
+            return self._resolve_payees(names)
+
+    def _resolve_payees(self, names):
+        self._load_payees()
+        names = list(names)
+        new_names = []
+        for name in names:
+            if name not in self._payees_by_name and name not in new_names:
+                new_names.append(name)
+        if new_names:
+            self._db_connection.executemany('INSERT INTO payees(name) VALUES(?)', [(name,) for name in new_names])
+            for index in range(0, len(new_names), MAX_SQL_VARIABLES):
+                names_chunk = new_names[index:index+MAX_SQL_VARIABLES]
+                placeholders = ', '.join(['?'] * len(names_chunk))
+                for r in self._db_connection.execute(f'SELECT id, name FROM payees WHERE name IN ({placeholders})', names_chunk):
+                    payee = Payee(id_=r[0], name=r[1])
+                    self._note_cache_change('payee', payee.id)
+                    self._payees_by_id[payee.id] = payee
+                    self._payees_by_name[payee.name] = payee
+        return {name: self._payees_by_name[name] for name in names}
+
+    def _get_payee_id(self, payee):
+        if not payee:
+            return None
+        if not payee.id: #Payee may not have been saved in DB yet
+            db_payee = self.get_payee(name=payee.name)
+            if db_payee:
+                payee.id = db_payee.id
+            else:
+                self.save_payee(payee)
+        return payee.id
 
     def get_accounts(self, type_=None):
+        '''Get all the accounts (or just the ones of type_), ordered by type & then id.
+        Accounts all come from the identity map, so this doesn't query the DB after the first call.'''
+        type_order = [AccountType.ASSET, AccountType.LIABILITY, AccountType.INCOME, AccountType.EXPENSE, AccountType.EQUITY]
+        accounts = self._get_accounts_map().values()
         if type_:
-            return self._get_accounts_by_type(type_)
-        else:
-            accounts = []
-            for type_ in [AccountType.ASSET, AccountType.LIABILITY, AccountType.INCOME, AccountType.EXPENSE, AccountType.EQUITY]:
-                accounts.extend(self._get_accounts_by_type(type_))
-            return accounts
-
-    def _txn_from_db_record(self, db_info=None):
-        if not db_info:
-            raise InvalidTransactionError('no db_info to construct transaction')
-        id_, currency_id, txn_type, txn_date, payee_id, description, date_entered = db_info
-        txn_date = get_date(txn_date)
-        payee = self.get_payee(payee_id)
-        cursor = self._db_connection.cursor()
+            accounts = [a for a in accounts if a.type == type_]
+        return sorted(accounts, key=lambda a: (type_order.index(a.type), a.id))
+
+    def _get_accounts_map(self):
+        '''load all accounts into the identity map (once per storage object), and return it'''
+        if not self._all_accounts_loaded:
+            records = self._db_connection.execute('SELECT id, type, number, name, parent_id FROM accounts').fetchall()
+            records_by_id = {r[0]: r for r in records}
+            def _load(record):
+                if record[4] and record[4] not in self._accounts:
+                    _load(records_by_id[record[4]])
+                if record[0] not in self._accounts:
+                    self._account_from_db_record(record)
+            for r in records:
+                _load(r)
+            self._all_accounts_loaded = True
+        return self._accounts
+
+    def _load_txns(self, txn_ids_sql, params=()):
+        '''Build Transactions for all the txn ids selected by txn_ids_sql.
+        Uses the same number of queries no matter how many txns there are.'''
+        accounts = self._get_accounts_map()
         splits = {}
-        split_records = cursor.execute('SELECT account_id, value, reconciled_state FROM transaction_splits WHERE txn_id = ?', (id_,))
-        if split_records:
-            for split_record in split_records:
-                account_id = split_record[0]
-                account = self.get_account(account_id)
-                splits[account] = {'amount': split_record[1]}
-                if split_record[2]:
-                    splits[account]['status'] = split_record[2]
-        return Transaction(splits=splits, txn_date=txn_date, txn_type=txn_type, payee=payee, description=description, id_=id_)
+        split_records = self._db_connection.execute(
+                f'SELECT txn_id, account_id, value_cents, reconciled_state FROM transaction_splits WHERE txn_id IN ({txn_ids_sql}) ORDER BY id',
+                params)
+        for txn_id, account_id, value_cents, status in split_records:
+            splits.setdefault(txn_id, {})[accounts[account_id]] = Split(cents_to_amount(value_cents), status or None)
+        txn_records = self._db_connection.execute(
+                f'SELECT id, type, date, payee_id, description FROM transactions WHERE id IN ({txn_ids_sql})',
+                params)
+        return [self._txn_from_record(record, splits.get(record[0])) for record in txn_records]
+
+    def iter_txns(self, start=None, end=None, accounts=None, batch_size=500):
+        '''Generate all txns (optionally from start to end dates, inclusive, and only the ones with a split in one of
+        accounts), ordered by date & id. Rows are fetched batch_size at a time, so memory use doesn't grow with the number of txns.'''
+        account_map = self._get_accounts_map()
+        conditions = []
+        params = []
+        if start:
+            conditions.append('transactions.date >= ?')
+            params.append(get_date(start).strftime('%Y-%m-%d'))
+        if end:
+            conditions.append('transactions.date <= ?')
+            params.append(get_date(end).strftime('%Y-%m-%d'))
+        if accounts:
+            account_ids = [a.id for a in accounts]
+            conditions.append('transactions.id IN (SELECT txn_id FROM transaction_splits WHERE account_id IN (%s))' % ','.join(['?']*len(account_ids)))
+            params.extend(account_ids)
+        sql = 'SELECT transactions.id, transactions.type, transactions.date, transactions.payee_id, transactions.description, '\
+                'transaction_splits.account_id, transaction_splits.value_cents, transaction_splits.reconciled_state '\
+                'FROM transactions INNER JOIN transaction_splits ON transaction_splits.txn_id = transactions.id'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY transactions.date, transactions.id, transaction_splits.id'
+        c = self._db_connection.cursor()
+        c.execute(sql, params)
+        txn_record = None
+        splits = {}
+        while True:
+            records = c.fetchmany(batch_size)
+            if not records:
+                break
+            for id_, txn_type, txn_date, payee_id, description, account_id, value_cents, status in records:
+                if txn_record and txn_record[0] != id_:
+                    yield self._txn_from_record(txn_record, splits)
+                    splits = {}
+                txn_record = (id_, txn_type, txn_date, payee_id, description)
+                splits[account_map[account_id]] = Split(cents_to_amount(value_cents), status or None)
+        if txn_record:
+            yield self._txn_from_record(txn_record, splits)
+
+    @staticmethod
+    def _date_from_db(value):
+        #dates are always stored as 'YYYY-MM-DD'
+        return date(int(value[:4]), int(value[5:7]), int(value[8:10]))
+
+    def _txn_from_record(self, record, splits):
+        id_, txn_type, txn_date, payee_id, description = record
+        return Transaction.from_storage(txn_date=self._date_from_db(txn_date), txn_type=txn_type, splits=splits, payee=self.get_payee(payee_id),
+                description=description, id_=id_, validate=self._validate_loaded_txns)
 
     def get_txn(self, txn_id):
-        cursor = self._db_connection.cursor()
-        cursor.execute('SELECT * FROM transactions WHERE id = ?', (txn_id,))
-        db_info = cursor.fetchone()
-        return self._txn_from_db_record(db_info=db_info)
+        txns = self._load_txns('?', (txn_id,))
+        if not txns:
+            raise InvalidTransactionError('no txn with id %s' % txn_id)
+        return txns[0]
 
     def save_txn(self, txn):
-        c = self._db_connection.cursor()
-        if txn.payee:
-            if not txn.payee.id: #Payee may not have been saved in DB yet
-                db_payee = self.get_payee(name=txn.payee.name)
-                if db_payee:
-                    txn.payee.id = db_payee.id
-                else:
-                    self.save_payee(txn.payee)
-            payee = txn.payee.id
-        else:
-            payee = None
+        with self.transaction():
+            self._save_txn(self._db_connection.cursor(), txn)
+
+    def _save_txn(self, c, txn):
+        payee = self._get_payee_id(txn.payee)
         if txn.id:
             c.execute('UPDATE transactions SET type = ?, date = ?, payee_id = ?, description = ? WHERE id = ?',
                 (txn.txn_type, txn.txn_date.strftime('%Y-%m-%d'), payee, txn.description, txn.id))
@@ -904,7 +1882,7 @@ class SQLiteStorage:
         else:
             c.execute('INSERT INTO transactions(currency_id, type, date, payee_id, description) VALUES(?, ?, ?, ?, ?)',
                 (1, txn.txn_type, txn.txn_date.strftime('%Y-%m-%d'), payee, txn.description))
-            txn.id = c.lastrowid
+            self._set_new_id(txn, c.lastrowid)
         #update transaction splits
         splits_db_info = c.execute('SELECT account_id FROM transaction_splits WHERE txn_id = ?', (txn.id,)).fetchall()
         old_txn_split_account_ids = [r[0] for r in splits_db_info]
@@ -915,106 +1893,447 @@ class SQLiteStorage:
         for account, info in txn.splits.items():
             if not account.id:
                 self.save_account(account)
-            amount = info['amount']
+            amount = info.amount
+            value_cents = amount_to_cents(amount)
             amount = f'{amount.numerator}/{amount.denominator}'
-            status = info.get('status', None)
+            status = info.status
             if account.id in old_txn_split_account_ids:
-                c.execute('UPDATE transaction_splits SET value = ?, quantity = ?, reconciled_state = ? WHERE txn_id = ? AND account_id = ?', (amount, amount, status, txn.id, account.id))
+                c.execute('UPDATE transaction_splits SET value = ?, quantity = ?, reconciled_state = ?, value_cents = ? WHERE txn_id = ? AND account_id = ?', (amount, amount, status, value_cents, txn.id, account.id))
             else:
-                c.execute('INSERT INTO transaction_splits(txn_id, account_id, value, quantity, reconciled_state) VALUES(?, ?, ?, ?, ?)', (txn.id, account.id, amount, amount, status))
-        self._db_connection.commit()
+                c.execute('INSERT INTO transaction_splits(txn_id, account_id, value, quantity, reconciled_state, value_cents) VALUES(?, ?, ?, ?, ?, ?)', (txn.id, account.id, amount, amount, status, value_cents))
+
+    def save_txns(self, txns, batch_size=1000):
+        '''Save many transactions, with one commit for each batch of batch_size txns.
+        If a batch fails, that batch is rolled back - batches before it stay saved.'''
+        batch = []
+        for txn in txns:
+            batch.append(txn)
+            if len(batch) >= batch_size:
+                self._save_txns_batch(batch)
+                batch = []
+        if batch:
+            self._save_txns_batch(batch)
+
+    def _save_txns_batch(self, txns):
+        #if the batch fails, transaction() takes back the ids it handed out
+        c = self._db_connection.cursor()
+        new_payees = [t.payee for t in txns if t.payee and not t.payee.id]
+        with self.transaction():
+            #look up or create all the payees for the batch at once
+            db_payees = self._resolve_payees([p.name for p in new_payees])
+            for payee in new_payees:
+                self._set_new_id(payee, db_payees[payee.name].id)
+            for txn in txns:
+                if txn.id:
+                    self._save_txn(c, txn)
+            #skip the per-row insert triggers for the new txns, and update the checkpoints once per account & month
+            # and the search index once per txn instead
+            c.execute('INSERT INTO misc(key, value) VALUES(?, ?)', (self.BULK_SAVE_KEY, '1'))
+            split_records = []
+            search_records = []
+            #(account id, month) -> [balance change, cleared balance change]
+            checkpoint_changes = {}
+            for txn in txns:
+                if txn.id:
+                    continue
+                txn_date = txn.txn_date.strftime('%Y-%m-%d')
+                c.execute('INSERT INTO transactions(currency_id, type, date, payee_id, description) VALUES(?, ?, ?, ?, ?)',
+                    (1, txn.txn_type, txn_date, txn.payee and txn.payee.id, txn.description))
+                self._set_new_id(txn, c.lastrowid)
+                #these splits don't have descriptions
+                search_records.append((txn.id, txn.description, txn.payee and txn.payee.name))
+                for account, info in txn.splits.items():
+                    amount = info.amount
+                    status = info.status
+                    value_cents = amount_to_cents(amount)
+                    amount = f'{amount.numerator}/{amount.denominator}'
+                    split_records.append((txn.id, account.id, amount, amount, status, value_cents))
+                    changes = checkpoint_changes.setdefault((account.id, txn_date[:7]), [0, 0])
+                    changes[0] += value_cents
+                    if status in [Transaction.CLEARED, Transaction.RECONCILED]:
+                        changes[1] += value_cents
+            c.executemany('INSERT INTO transaction_splits(txn_id, account_id, value, quantity, reconciled_state, value_cents) VALUES(?, ?, ?, ?, ?, ?)', split_records)
+            c.execute('DELETE FROM misc WHERE key = ?', (self.BULK_SAVE_KEY,))
+            if self._has_search_index():
+                c.executemany('INSERT INTO txn_search(rowid, description, payee, split_descriptions) VALUES (?, ?, ?, NULL)', search_records)
+            for statement in self._checkpoint_change_sql(':account_id', ':month', ':cents', ':cleared_cents'):
+                c.executemany(statement, [{'account_id': account_id, 'month': month, 'cents': cents, 'cleared_cents': cleared_cents}
+                    for (account_id, month), (cents, cleared_cents) in sorted(checkpoint_changes.items())])
 
     def delete_txn(self, txn_id):
-        self._db_connection.execute('DELETE FROM transaction_splits WHERE txn_id = ?', (txn_id,))
-        self._db_connection.execute('DELETE FROM transactions WHERE id = ?', (txn_id,))
-        self._db_connection.commit()
+        with self.transaction():
+            self._db_connection.execute('DELETE FROM transaction_splits WHERE txn_id = ?', (txn_id,))
+            self._db_connection.execute('DELETE FROM transactions WHERE id = ?', (txn_id,))
+
+    def _txn_query_sql(self, query):
+        '''Compile a TxnQuery to one SQL statement (and its params) that selects the ids of the matching txns.'''
+        conditions = []
+        params = []
+        if query.start_date:
+            conditions.append('transactions.date >= ?')
+            params.append(query.start_date.strftime('%Y-%m-%d'))
+        if query.end_date:
+            conditions.append('transactions.date <= ?')
+            params.append(query.end_date.strftime('%Y-%m-%d'))
+        if query.accounts:
+            conditions.append('transaction_splits.account_id IN (%s)' % ','.join(['?']*len(query.accounts)))
+            params.extend([a.id for a in query.accounts])
+        if query.min_amount is not None:
+            conditions.append('ABS(transaction_splits.value_cents) >= ?')
+            params.append(amount_to_cents(query.min_amount))
+        if query.max_amount is not None:
+            conditions.append('ABS(transaction_splits.value_cents) <= ?')
+            params.append(amount_to_cents(query.max_amount))
+        if query.statuses:
+            conditions.append("COALESCE(transaction_splits.reconciled_state, '') IN (%s)" % ','.join(['?']*len(query.statuses)))
+            params.extend([s or '' for s in query.statuses])
+        if query.payee:
+            conditions.append('transactions.payee_id = ?')
+            params.append(query.payee.id)
+        if query.text and get_search_words(query.text):
+            text_conditions, text_params = self._text_search_conditions(get_search_words(query.text))
+            conditions.extend(text_conditions)
+            params.extend(text_params)
+        sql = 'SELECT DISTINCT transaction_splits.txn_id FROM transaction_splits INNER JOIN transactions ON transaction_splits.txn_id = transactions.id '\
+                'LEFT OUTER JOIN payees ON transactions.payee_id = payees.id'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        return sql, params
+
+    def query_txns(self, query):
+        '''Return the txns that match a TxnQuery, ordered by date & id.'''
+        sql, params = self._txn_query_sql(query)
+        return sorted(self._load_txns(sql, params), key=lambda t: (t.txn_date, t.id))
 
-    def get_ledger(self, account):
+    @staticmethod
+    def _fts_match(words):
+        #quote each word so FTS5 doesn't treat it as query syntax, & match it as a prefix
+        return ' '.join(['"%s"*' % w.replace('"', '""') for w in words])
+
+
+    def _text_search_conditions(self, words):
+        '''conditions (& params) for a query on transactions LEFT OUTER JOIN payees that match all the words'''
+        if self._has_search_index():
+            return ['transactions.id IN (SELECT rowid FROM txn_search WHERE txn_search MATCH ?)'], [self._fts_match(words)]
+        #without FTS5, has_word_prefix does the matching, with the same word rules
+        conditions = []
+        params = []
+        for w in words:
+            conditions.append('(has_word_prefix(transactions.description, ?) OR has_word_prefix(payees.name, ?) OR '\
+                    'transactions.id IN (SELECT txn_id FROM transaction_splits WHERE has_word_prefix(description, ?)))')
+            params.extend([w] * 3)
+        return conditions, params
+
+    def search_txns(self, search_term, account=None):
+        '''Return the ids of txns whose description, payee or split descriptions have words starting with each
+        word of search_term, best matches first. Pass an account to only search its txns.
+        If this SQLite doesn't have FTS5, the same words match, but results are newest first instead of best first.'''
+        words = get_search_words(search_term)
+        if not words:
+            return []
+        if self._has_search_index():
+            sql = 'SELECT rowid FROM txn_search WHERE txn_search MATCH ?'
+            params = [self._fts_match(words)]
+            if account:
+                sql += ' AND rowid IN (SELECT txn_id FROM transaction_splits WHERE account_id = ?)'
+                params.append(account.id)
+            sql += ' ORDER BY rank'
+        else:
+            conditions, params = self._text_search_conditions(words)
+            sql = 'SELECT transactions.id FROM transactions LEFT OUTER JOIN payees ON transactions.payee_id = payees.id WHERE '
+            sql += ' AND '.join(conditions)
+            if account:
+                sql += ' AND transactions.id IN (SELECT txn_id FROM transaction_splits WHERE account_id = ?)'
+                params.append(account.id)
+            sql += ' ORDER BY transactions.date DESC, transactions.id DESC'
+        return [r[0] for r in self._db_connection.execute(sql, params).fetchall()]
+
+    def get_ledger(self, account, start=None, end=None):
+        '''Load an account's ledger - with start and/or end, just the txns in that date range (inclusive), and
+        the balances of everything before start are carried forward as the ledger's opening balances.'''
         if not isinstance(account, Account):
             account = self.get_account(account)
-        ledger = Ledger(account=account)
-        db_txn_id_records = self._db_connection.execute('SELECT txn_id FROM transaction_splits WHERE account_id = ?', (account.id,)).fetchall()
-        txn_ids = set([r[0] for r in db_txn_id_records])
-        for txn_id in txn_ids:
-            txn = self.get_txn(txn_id)
+        start = get_date(start) if start else None
+        end = get_date(end) if end else None
+        opening_balance = opening_cleared = Money(0)
+        if start:
+            opening_balance, opening_cleared = self._get_balances_before(account, start)
+        ledger = Ledger(account=account, start=start, end=end, opening_balance=opening_balance, opening_cleared=opening_cleared)
+        sql = 'SELECT txn_id FROM transaction_splits INNER JOIN transactions ON transaction_splits.txn_id = transactions.id '\
+                'WHERE transaction_splits.account_id = ?'
+        params = [account.id]
+        if start:
+            sql += ' AND transactions.date >= ?'
+            params.append(str(start))
+        if end:
+            sql += ' AND transactions.date <= ?'
+            params.append(str(end))
+        for txn in self._load_txns(sql, params):
             ledger.add_transaction(txn)
-        db_scheduled_txn_id_records = self._db_connection.execute('SELECT scheduled_txn_id FROM scheduled_transaction_splits WHERE account_id = ?', (account.id,)).fetchall()
-        scheduled_txn_ids = set(r[0] for r in db_scheduled_txn_id_records)
-        for scheduled_txn_id in scheduled_txn_ids:
-            ledger.add_scheduled_transaction(self.get_scheduled_transaction(scheduled_txn_id))
+        scheduled_txns = self._load_scheduled_txns('SELECT scheduled_txn_id FROM scheduled_transaction_splits WHERE account_id = ?', (account.id,))
+        for scheduled_txn in scheduled_txns:
+            ledger.add_scheduled_transaction(scheduled_txn)
+        return ledger
+
+    def get_ledger_columns(self, account, start=None, end=None):
+        '''Load an account's txns (optionally just from start through end) into a compact LedgerColumns, straight from
+        the split rows - no Transactions are built until the LedgerColumns is asked for them.'''
+        if not isinstance(account, Account):
+            account = self.get_account(account)
+        start = get_date(start) if start else None
+        end = get_date(end) if end else None
+        opening_balance = opening_cleared = Money(0)
+        if start:
+            opening_balance, opening_cleared = self._get_balances_before(account, start)
+        ledger = LedgerColumns(account, load_txns=self._load_txns_by_id, opening_balance=opening_balance, opening_cleared=opening_cleared)
+        sql = 'SELECT transactions.date, transaction_splits.value_cents, transaction_splits.reconciled_state, transactions.payee_id, transactions.id '\
+                'FROM transaction_splits INNER JOIN transactions ON transaction_splits.txn_id = transactions.id '\
+                'WHERE transaction_splits.account_id = ?'
+        params = [account.id]
+        if start:
+            sql += ' AND transactions.date >= ?'
+            params.append(str(start))
+        if end:
+            sql += ' AND transactions.date <= ?'
+            params.append(str(end))
+        sql += ' ORDER BY transactions.date, transactions.id'
+        for txn_date, value_cents, status, payee_id, txn_id in self._db_connection.execute(sql, params):
+            ledger.append(self._date_from_db(txn_date), value_cents, status, payee_id, txn_id)
         return ledger
 
+    def _load_txns_by_id(self, txn_ids):
+        txns = []
+        for index in range(0, len(txn_ids), MAX_SQL_VARIABLES):
+            batch = txn_ids[index:index+MAX_SQL_VARIABLES]
+            txns.extend(self._load_txns(','.join(['?']*len(batch)), batch))
+        return txns
+
+    def get_txns_page(self, account, cursor=None, direction=PAGE_OLDER, page_size=50):
+        '''Get one page of an account's txns (newest first) with their running balances, without loading the whole ledger.
+        cursor is the older_cursor or newer_cursor of a previous page, and direction says which way to go from it.
+        With no cursor, the page has the newest txns.'''
+        if not isinstance(account, Account):
+            account = self.get_account(account)
+        sql = 'SELECT transactions.id, transactions.date FROM transaction_splits '\
+                'INNER JOIN transactions ON transaction_splits.txn_id = transactions.id WHERE transaction_splits.account_id = ?'
+        params = [account.id]
+        if direction == self.PAGE_OLDER:
+            if cursor:
+                sql += ' AND (transactions.date < ? OR (transactions.date = ? AND transactions.id < ?))'
+                params.extend([cursor[0], cursor[0], cursor[1]])
+            sql += ' ORDER BY transactions.date DESC, transactions.id DESC LIMIT ?'
+        elif direction == self.PAGE_NEWER:
+            if cursor:
+                sql += ' AND (transactions.date > ? OR (transactions.date = ? AND transactions.id > ?))'
+                params.extend([cursor[0], cursor[0], cursor[1]])
+            sql += ' ORDER BY transactions.date, transactions.id LIMIT ?'
+        else:
+            raise Exception('invalid page direction: %s' % direction)
+        #get one extra record, to see if there are more txns past this page
+        params.append(page_size + 1)
+        records = self._db_connection.execute(sql, params).fetchall()
+        more_txns = len(records) > page_size
+        records = records[:page_size]
+        if direction == self.PAGE_OLDER:
+            more_older, more_newer = more_txns, bool(cursor)
+        else:
+            records.reverse()
+            more_older, more_newer = bool(cursor), more_txns
+        if not records:
+            return TxnsPage(txns=[], balances=[], older_cursor=None, newer_cursor=None)
+        txns_by_id = {t.id: t for t in self._load_txns(','.join(['?']*len(records)), [r[0] for r in records])}
+        txns = [txns_by_id[r[0]] for r in records]
+        #the balance before this page comes from everything older than the oldest txn in the page
+        oldest_id, oldest_date = records[-1]
+        balance = cents_to_amount(self._db_connection.execute(
+                'SELECT COALESCE(SUM(value_cents), 0) FROM transaction_splits INNER JOIN transactions ON transaction_splits.txn_id = transactions.id '\
+                'WHERE transaction_splits.account_id = ? AND (transactions.date < ? OR (transactions.date = ? AND transactions.id < ?))',
+                (account.id, oldest_date, oldest_date, oldest_id)).fetchone()[0])
+        balances = []
+        for t in reversed(txns):
+            balance += t.splits[account].amount
+            balances.append(balance)
+        balances.reverse()
+        return TxnsPage(
+                txns=txns,
+                balances=balances,
+                older_cursor=(oldest_date, oldest_id) if more_older else None,
+                newer_cursor=(records[0][1], records[0][0]) if more_newer else None,
+            )
+
+    def _balances_sql(self, as_of, account=None):
+        '''SQL (and params) selecting (account_id, balance_cents, cleared_cents) at the end of as_of for all accounts, or just
+        account - each account's latest balance checkpoint before as_of's month, plus its splits in that month through as_of.'''
+        month = as_of.strftime('%Y-%m')
+        params = [month, month, as_of.strftime('%Y-%m-01'), as_of.strftime('%Y-%m-%d')]
+        split_condition = ''
+        account_condition = ''
+        if account:
+            split_condition = 'AND transaction_splits.account_id = ? '
+            account_condition = ' WHERE accounts.id = ?'
+            params.extend([account.id, account.id])
+        sql = 'SELECT accounts.id AS account_id, '\
+                'COALESCE((SELECT balance_cents FROM balance_checkpoints WHERE account_id = accounts.id AND month < ? ORDER BY month DESC LIMIT 1), 0) + COALESCE(month_totals.balance_cents, 0) AS balance_cents, '\
+                'COALESCE((SELECT cleared_cents FROM balance_checkpoints WHERE account_id = accounts.id AND month < ? ORDER BY month DESC LIMIT 1), 0) + COALESCE(month_totals.cleared_cents, 0) AS cleared_cents '\
+                'FROM accounts LEFT OUTER JOIN '\
+                f'(SELECT account_id, SUM(value_cents) AS balance_cents, SUM({self._cleared_cents_sql("transaction_splits")}) AS cleared_cents '\
+                'FROM transaction_splits INNER JOIN transactions ON transaction_splits.txn_id = transactions.id '\
+                f'WHERE transactions.date >= ? AND transactions.date <= ? {split_condition}GROUP BY account_id) AS month_totals '\
+                f'ON month_totals.account_id = accounts.id{account_condition}'
+        return sql, params
+
+    def account_balance(self, account, as_of=None, cleared_only=False):
+        '''Get an account's balance (or cleared balance) at the end of as_of (default today). It's the latest balance
+        checkpoint before as_of's month, plus the account's splits from the start of that month through as_of.'''
+        if not isinstance(account, Account):
+            account = self.get_account(account)
+        as_of = get_date(as_of) if as_of else date.today()
+        _, balance_cents, cleared_cents = self._db_connection.execute(*self._balances_sql(as_of, account=account)).fetchone()
+        return cents_to_amount(cleared_cents if cleared_only else balance_cents)
+
+    def _get_balances_before(self, account, before_date):
+        '''An account's balance & cleared balance of everything before before_date, from one aggregate query.'''
+        _, balance_cents, cleared_cents = self._db_connection.execute(*self._balances_sql(before_date - timedelta(days=1), account=account)).fetchone()
+        return cents_to_amount(balance_cents), cents_to_amount(cleared_cents)
+
+    def get_account_balances(self, as_of=None, rollup=False):
+        '''Get the balances (as of the end of as_of, default today) for all accounts as {account: LedgerBalances}, from one
+        aggregate query - each account's latest checkpoint before as_of's month, plus its splits in that month through as_of.
+        With rollup, each account's balances include all its subaccounts.'''
+        as_of = get_date(as_of) if as_of else date.today()
+        accounts = self._get_accounts_map()
+        balances_sql, params = self._balances_sql(as_of)
+        if rollup:
+            balances_sql = 'SELECT account_ancestors.ancestor_id, SUM(balances.balance_cents), SUM(balances.cleared_cents) '\
+                    f'FROM ({balances_sql}) AS balances INNER JOIN account_ancestors ON balances.account_id = account_ancestors.account_id '\
+                    'GROUP BY account_ancestors.ancestor_id'
+        records = self._db_connection.execute(balances_sql, params).fetchall()
+        balances = {}
+        for account_id, balance, cleared in records:
+            balances[accounts[account_id]] = LedgerBalances(
+                    current=str(fraction_to_decimal(cents_to_amount(balance))),
+                    current_cleared=str(fraction_to_decimal(cents_to_amount(cleared))),
+                )
+        return balances
+
+    def get_rollup_totals(self, start_date=None, end_date=None):
+        '''Get the total of each account's splits, including all its subaccounts, from start_date through end_date (either can be None),
+        as {account: amount} - one query, using the account_ancestors closure table instead of walking the tree.'''
+        accounts = self._get_accounts_map()
+        conditions = []
+        params = []
+        if start_date:
+            conditions.append('transactions.date >= ?')
+            params.append(str(get_date(start_date)))
+        if end_date:
+            conditions.append('transactions.date <= ?')
+            params.append(str(get_date(end_date)))
+        where = f'WHERE {" AND ".join(conditions)} ' if conditions else ''
+        records = self._db_connection.execute(
+                'SELECT account_ancestors.ancestor_id, SUM(transaction_splits.value_cents) '\
+                'FROM transaction_splits INNER JOIN transactions ON transaction_splits.txn_id = transactions.id '\
+                'INNER JOIN account_ancestors ON transaction_splits.account_id = account_ancestors.account_id '\
+                f'{where}GROUP BY account_ancestors.ancestor_id', params).fetchall()
+        totals = {account: Money(0) for account in accounts.values()}
+        for account_id, cents in records:
+            totals[accounts[account_id]] = cents_to_amount(cents)
+        return totals
+
+    def get_current_balances(self, account):
+        '''Get an account's current & cleared balances (through today) as LedgerBalances.'''
+        return LedgerBalances(
+                current=str(fraction_to_decimal(self.account_balance(account))),
+                current_cleared=str(fraction_to_decimal(self.account_balance(account, cleared_only=True))),
+            )
+
     def save_budget(self, budget):
-        c = self._db_connection.cursor()
-        if budget.id:
-            c.execute('UPDATE budgets SET name = ?, start_date = ?, end_date = ? WHERE id = ?',
-                (budget.name, str(budget.start_date), str(budget.end_date), budget.id))
-            #handle budget_values
-            values_db_info = c.execute('SELECT account_id FROM budget_values WHERE budget_id = ?', (budget.id,)).fetchall()
-            old_account_ids = [r[0] for r in values_db_info]
-            budget_data = budget.get_budget_data()
-            new_account_ids = [a.id for a in budget_data.keys()]
-            account_ids_to_delete = set(old_account_ids) - set(new_account_ids)
-            for account_id in account_ids_to_delete:
-                c.execute('DELETE FROM budget_values WHERE budget_id = ? AND account_id = ?', (budget.id, account_id))
-            for account, info in budget_data.items():
-                if info:
-                    carryover = str(info.get('carryover', ''))
-                    notes = info.get('notes', '')
-                    if account.id in old_account_ids:
-                        values = (str(info['amount']), carryover, notes, budget.id, account.id)
-                        c.execute('UPDATE budget_values SET amount = ?, carryover = ?, notes = ? WHERE budget_id = ? AND account_id = ?', values)
-                    else:
-                        values = (budget.id, account.id, str(info['amount']), carryover, notes)
+        with self.transaction():
+            c = self._db_connection.cursor()
+            if budget.id:
+                c.execute('UPDATE budgets SET name = ?, start_date = ?, end_date = ? WHERE id = ?',
+                    (budget.name, str(budget.start_date), str(budget.end_date), budget.id))
+                #handle budget_values
+                values_db_info = c.execute('SELECT account_id FROM budget_values WHERE budget_id = ?', (budget.id,)).fetchall()
+                old_account_ids = [r[0] for r in values_db_info]
+                budget_data = budget.get_budget_data()
+                new_account_ids = [a.id for a in budget_data.keys()]
+                account_ids_to_delete = set(old_account_ids) - set(new_account_ids)
+                for account_id in account_ids_to_delete:
+                    c.execute('DELETE FROM budget_values WHERE budget_id = ? AND account_id = ?', (budget.id, account_id))
+                for account, info in budget_data.items():
+                    if info:
+                        #amounts are stored the way Fractions print (eg. '767/50')
+                        carryover = str(Fraction(info['carryover'])) if 'carryover' in info else ''
+                        notes = info.get('notes', '')
+                        if account.id in old_account_ids:
+                            values = (str(Fraction(info['amount'])), carryover, notes, budget.id, account.id)
+                            c.execute('UPDATE budget_values SET amount = ?, carryover = ?, notes = ? WHERE budget_id = ? AND account_id = ?', values)
+                        else:
+                            values = (budget.id, account.id, str(Fraction(info['amount'])), carryover, notes)
+                            c.execute('INSERT INTO budget_values(budget_id, account_id, amount, carryover, notes) VALUES (?, ?, ?, ?, ?)', values)
+            else:
+                c.execute('INSERT INTO budgets(name, start_date, end_date) VALUES(?, ?, ?)', (budget.name, budget.start_date, budget.end_date))
+                self._set_new_id(budget, c.lastrowid)
+                budget_data = budget.get_budget_data()
+                for account, info in budget_data.items():
+                    if info:
+                        carryover = str(Fraction(info['carryover'])) if 'carryover' in info else ''
+                        notes = info.get('notes', '')
+                        values = (budget.id, account.id, str(Fraction(info['amount'])), carryover, notes)
                         c.execute('INSERT INTO budget_values(budget_id, account_id, amount, carryover, notes) VALUES (?, ?, ?, ?, ?)', values)
-        else:
-            c.execute('INSERT INTO budgets(start_date, end_date) VALUES(?, ?)', (budget.start_date, budget.end_date))
-            budget.id = c.lastrowid
-            budget_data = budget.get_budget_data()
-            for account, info in budget_data.items():
-                if info:
-                    carryover = str(info.get('carryover', ''))
-                    notes = info.get('notes', '')
-                    values = (budget.id, account.id, str(info['amount']), carryover, notes)
-                    c.execute('INSERT INTO budget_values(budget_id, account_id, amount, carryover, notes) VALUES (?, ?, ?, ?, ?)', values)
-        self._db_connection.commit()
-
-    def get_budget(self, budget_id):
+
+    def get_budget(self, budget_id, rollup=False):
+        '''Load a budget with its income & spending info - uses a fixed number of queries, no matter how many accounts there are.
+        With rollup, each account's budget amounts and income & spending info include all its subaccounts.'''
         c = self._db_connection.cursor()
-        records = c.execute('SELECT start_date, end_date FROM budgets WHERE id = ?', (budget_id,)).fetchall()
-        start_date = get_date(records[0][0])
-        end_date = get_date(records[0][1])
-        account_budget_info = {}
-        all_income_spending_info = {}
+        records = c.execute('SELECT name, start_date, end_date FROM budgets WHERE id = ?', (budget_id,)).fetchall()
+        name = records[0][0]
+        start_date = get_date(records[0][1])
+        end_date = get_date(records[0][2])
+        accounts = self._get_accounts_map()
         income_and_expense_accounts = []
-        income_and_expense_accounts.extend(self.get_accounts(type_=AccountType.EXPENSE))
-        income_and_expense_accounts.extend(self.get_accounts(type_=AccountType.INCOME))
-        for account in income_and_expense_accounts:
-            account_budget_info[account] = {}
-            all_income_spending_info[account] = {}
-            #get spent & income values for each expense account
-            spent = Fraction(0)
-            income = Fraction(0)
-            txn_splits_records = self._db_connection.execute('SELECT transaction_splits.value FROM transaction_splits INNER JOIN transactions ON transaction_splits.txn_id = transactions.id WHERE transaction_splits.account_id = ? AND transactions.date > ? AND transactions.date < ?', (account.id, start_date, end_date)).fetchall()
-            for record in txn_splits_records:
-                amt = Fraction(record[0])
-                if amt < Fraction(0):
-                    income += amt * Fraction(-1)
-                else:
-                    spent += amt
-            all_income_spending_info[account]['spent'] = spent
-            all_income_spending_info[account]['income'] = income
-            budget_records = c.execute('SELECT amount, carryover, notes FROM budget_values WHERE budget_id = ? AND account_id = ?', (budget_id, account.id)).fetchall()
-            if budget_records:
-                r = budget_records[0]
-                account_budget_info[account]['amount'] = r[0]
-                account_budget_info[account]['carryover'] = r[1]
-                account_budget_info[account]['notes'] = r[2]
-            else:
-                account_budget_info[account] = {}
-        return Budget(id_=budget_id, start_date=start_date, end_date=end_date, account_budget_info=account_budget_info,
+        for type_ in [AccountType.EXPENSE, AccountType.INCOME]:
+            income_and_expense_accounts.extend(sorted([a for a in accounts.values() if a.type == type_], key=lambda a: a.id))
+        account_budget_info = {account: {} for account in income_and_expense_accounts}
+        all_income_spending_info = {account: {'spent': Money(0), 'income': Money(0)} for account in income_and_expense_accounts}
+        #get spent & income values for all the income & expense accounts at once
+        if rollup:
+            group_account_id = 'account_ancestors.ancestor_id'
+            join_sql = 'INNER JOIN account_ancestors ON transaction_splits.account_id = account_ancestors.account_id '\
+                    'INNER JOIN accounts ON account_ancestors.ancestor_id = accounts.id '
+        else:
+            group_account_id = 'transaction_splits.account_id'
+            join_sql = 'INNER JOIN accounts ON transaction_splits.account_id = accounts.id '
+        totals_records = c.execute(
+                f'SELECT {group_account_id}, '\
+                'COALESCE(SUM(CASE WHEN value_cents > 0 THEN value_cents END), 0), COALESCE(SUM(CASE WHEN value_cents < 0 THEN -value_cents END), 0) '\
+                'FROM transaction_splits INNER JOIN transactions ON transaction_splits.txn_id = transactions.id '\
+                f'{join_sql}'\
+                'WHERE accounts.type IN (?, ?) AND transactions.date > ? AND transactions.date < ? '\
+                f'GROUP BY {group_account_id}',
+                (AccountType.EXPENSE.value, AccountType.INCOME.value, start_date, end_date)).fetchall()
+        for account_id, spent_cents, income_cents in totals_records:
+            all_income_spending_info[accounts[account_id]] = {'spent': cents_to_amount(spent_cents), 'income': cents_to_amount(income_cents)}
+        if rollup:
+            #amounts are 'n/d' text, so total them with fsum - notes are just the account's own
+            budget_records = c.execute('SELECT account_ancestors.ancestor_id, fsum(budget_values.amount), fsum(budget_values.carryover), '\
+                    'MAX(CASE WHEN account_ancestors.depth = 0 THEN budget_values.notes END) '\
+                    'FROM budget_values INNER JOIN account_ancestors ON budget_values.account_id = account_ancestors.account_id '\
+                    'WHERE budget_values.budget_id = ? GROUP BY account_ancestors.ancestor_id', (budget_id,)).fetchall()
+        else:
+            budget_records = c.execute('SELECT account_id, amount, carryover, notes FROM budget_values WHERE budget_id = ?', (budget_id,)).fetchall()
+        for account_id, amount, carryover, notes in budget_records:
+            account = accounts[account_id]
+            if account in account_budget_info:
+                account_budget_info[account] = {'amount': amount, 'carryover': carryover, 'notes': notes}
+        return Budget(id_=budget_id, name=name, start_date=start_date, end_date=end_date, account_budget_info=account_budget_info,
                 income_spending_info=all_income_spending_info)
 
+    def get_budget_summaries(self):
+        '''Budgets with just their id, name & dates, for listing - use get_budget to load one with its report data.'''
+        records = self._db_connection.execute('SELECT id, name, start_date, end_date FROM budgets ORDER BY start_date DESC').fetchall()
+        return [Budget(id_=id_, name=name, start_date=start_date, end_date=end_date) for id_, name, start_date, end_date in records]
+
     def get_budgets(self):
         budgets = []
         c = self._db_connection.cursor()
@@ -1025,85 +2344,86 @@ class SQLiteStorage:
         return budgets
 
     def save_scheduled_transaction(self, scheduled_txn):
-        c = self._db_connection.cursor()
-
-        if scheduled_txn.payee:
-            if not scheduled_txn.payee.id: #Payee may not have been saved in DB yet
-                db_payee = self.get_payee(name=scheduled_txn.payee.name)
-                if db_payee:
-                    scheduled_txn.payee.id = db_payee.id
-                else:
-                    self.save_payee(scheduled_txn.payee)
-            payee = scheduled_txn.payee.id
-        else:
-            payee = None
-
-        #update existing scheduled transaction
-        if scheduled_txn.id:
-            c.execute('UPDATE scheduled_transactions SET name = ?, frequency = ?, next_due_date = ?, txn_type = ?, payee_id = ?, description = ? WHERE id = ?',
-                (scheduled_txn.name, scheduled_txn.frequency.value, scheduled_txn.next_due_date.strftime('%Y-%m-%d'), scheduled_txn.txn_type, payee, scheduled_txn.description, scheduled_txn.id))
-            if c.rowcount < 1:
-                raise Exception('no scheduled transaction with id %s to update' % scheduled_txn.id)
-            #handle splits
-            splits_db_info = c.execute('SELECT account_id FROM scheduled_transaction_splits WHERE scheduled_txn_id = ?', (scheduled_txn.id,)).fetchall()
-            old_split_account_ids = [r[0] for r in splits_db_info]
-            new_split_account_ids = [a.id for a in scheduled_txn.splits.keys()]
-            split_account_ids_to_delete = set(old_split_account_ids) - set(new_split_account_ids)
-            for account_id in split_account_ids_to_delete:
-                c.execute('DELETE FROM scheduled_transaction_splits WHERE scheduled_txn_id = ? AND account_id = ?', (scheduled_txn.id, account_id))
-            for account, info in scheduled_txn.splits.items():
-                amount = info['amount']
-                amount = f'{amount.numerator}/{amount.denominator}'
-                status = info.get('status', None)
-                if account.id in old_split_account_ids:
-                    c.execute('UPDATE scheduled_transaction_splits SET value = ?, quantity = ?, reconciled_state = ? WHERE scheduled_txn_id = ? AND account_id = ?', (amount, amount, status, scheduled_txn.id, account.id))
-                else:
+        with self.transaction():
+            c = self._db_connection.cursor()
+            payee = self._get_payee_id(scheduled_txn.payee)
+
+            #update existing scheduled transaction
+            if scheduled_txn.id:
+                c.execute('UPDATE scheduled_transactions SET name = ?, frequency = ?, next_due_date = ?, txn_type = ?, payee_id = ?, description = ? WHERE id = ?',
+                    (scheduled_txn.name, scheduled_txn.frequency.value, scheduled_txn.next_due_date.strftime('%Y-%m-%d'), scheduled_txn.txn_type, payee, scheduled_txn.description, scheduled_txn.id))
+                if c.rowcount < 1:
+                    raise Exception('no scheduled transaction with id %s to update' % scheduled_txn.id)
+                #handle splits
+                splits_db_info = c.execute('SELECT account_id FROM scheduled_transaction_splits WHERE scheduled_txn_id = ?', (scheduled_txn.id,)).fetchall()
+                old_split_account_ids = [r[0] for r in splits_db_info]
+                new_split_account_ids = [a.id for a in scheduled_txn.splits.keys()]
+                split_account_ids_to_delete = set(old_split_account_ids) - set(new_split_account_ids)
+                for account_id in split_account_ids_to_delete:
+                    c.execute('DELETE FROM scheduled_transaction_splits WHERE scheduled_txn_id = ? AND account_id = ?', (scheduled_txn.id, account_id))
+                for account, info in scheduled_txn.splits.items():
+                    amount = info.amount
+                    amount = f'{amount.numerator}/{amount.denominator}'
+                    status = info.status
+                    if account.id in old_split_account_ids:
+                        c.execute('UPDATE scheduled_transaction_splits SET value = ?, quantity = ?, reconciled_state = ? WHERE scheduled_txn_id = ? AND account_id = ?', (amount, amount, status, scheduled_txn.id, account.id))
+                    else:
+                        c.execute('INSERT INTO scheduled_transaction_splits(scheduled_txn_id, account_id, value, quantity, reconciled_state) VALUES (?, ?, ?, ?, ?)', (scheduled_txn.id, account.id, amount, amount, status))
+            #add new scheduled transaction
+            else:
+                c.execute('INSERT INTO scheduled_transactions(name, frequency, next_due_date, txn_type, payee_id, description) VALUES (?, ?, ?, ?, ?, ?)',
+                    (scheduled_txn.name, scheduled_txn.frequency.value, scheduled_txn.next_due_date.strftime('%Y-%m-%d'), scheduled_txn.txn_type, payee, scheduled_txn.description))
+                self._set_new_id(scheduled_txn, c.lastrowid)
+                for account, info in scheduled_txn.splits.items():
+                    amount = info.amount
+                    amount = f'{amount.numerator}/{amount.denominator}'
+                    status = info.status
                     c.execute('INSERT INTO scheduled_transaction_splits(scheduled_txn_id, account_id, value, quantity, reconciled_state) VALUES (?, ?, ?, ?, ?)', (scheduled_txn.id, account.id, amount, amount, status))
-        #add new scheduled transaction
-        else:
-            c.execute('INSERT INTO scheduled_transactions(name, frequency, next_due_date, txn_type, payee_id, description) VALUES (?, ?, ?, ?, ?, ?)',
-                (scheduled_txn.name, scheduled_txn.frequency.value, scheduled_txn.next_due_date.strftime('%Y-%m-%d'), scheduled_txn.txn_type, payee, scheduled_txn.description))
-            scheduled_txn.id = c.lastrowid
-            for account, info in scheduled_txn.splits.items():
-                amount = info['amount']
-                amount = f'{amount.numerator}/{amount.denominator}'
-                status = info.get('status', None)
-                c.execute('INSERT INTO scheduled_transaction_splits(scheduled_txn_id, account_id, value, quantity, reconciled_state) VALUES (?, ?, ?, ?, ?)', (scheduled_txn.id, account.id, amount, amount, status))
-        self._db_connection.commit()
 
-    def get_scheduled_transaction(self, id_):
-        c = self._db_connection.cursor()
+    def _load_scheduled_txns(self, scheduled_txn_ids_sql, params=()):
+        '''Build ScheduledTransactions for all the ids selected by scheduled_txn_ids_sql, with a fixed number of queries.'''
+        accounts = self._get_accounts_map()
         splits = {}
-        split_records = c.execute('SELECT account_id, value, reconciled_state FROM scheduled_transaction_splits WHERE scheduled_txn_id = ?', (id_,))
-        if split_records:
-            for split_record in split_records:
-                account_id = split_record[0]
-                account = self.get_account(account_id)
-                splits[account] = {'amount': split_record[1]}
-                if split_record[2]:
-                    splits[account]['status'] = split_record[2]
-        rows = c.execute('SELECT name,frequency,next_due_date,txn_type,payee_id,description FROM scheduled_transactions WHERE id = ?', (id_,)).fetchall()
-        payee = self.get_payee(rows[0][4])
-        st = ScheduledTransaction(
-                name=rows[0][0],
-                frequency=ScheduledTransactionFrequency(rows[0][1]),
-                next_due_date=rows[0][2],
-                splits=splits,
-                txn_type=rows[0][3],
-                payee=payee,
-                description=rows[0][5],
-                id_=id_,
-            )
-        return st
-
-    def get_scheduled_transactions(self):
-        c = self._db_connection.cursor()
-        scheduled_txns_records = c.execute('SELECT id FROM scheduled_transactions').fetchall()
+        split_records = self._db_connection.execute(
+                f'SELECT scheduled_txn_id, account_id, value, reconciled_state FROM scheduled_transaction_splits WHERE scheduled_txn_id IN ({scheduled_txn_ids_sql}) ORDER BY id',
+                params)
+        for scheduled_txn_id, account_id, value, status in split_records:
+            split_info = {'amount': value}
+            if status:
+                split_info['status'] = status
+            splits.setdefault(scheduled_txn_id, {})[accounts[account_id]] = split_info
+        records = self._db_connection.execute(
+                'SELECT id, name, frequency, next_due_date, txn_type, payee_id, description FROM scheduled_transactions '\
+                f'WHERE id IN ({scheduled_txn_ids_sql}) ORDER BY id',
+                params)
         scheduled_txns = []
-        for st_record in scheduled_txns_records:
-            scheduled_txns.append(self.get_scheduled_transaction(st_record[0]))
+        for id_, name, frequency, next_due_date, txn_type, payee_id, description in records:
+            payee = self.get_payee(payee_id)
+            scheduled_txns.append(
+                    ScheduledTransaction(
+                        name=name,
+                        frequency=ScheduledTransactionFrequency(frequency),
+                        next_due_date=next_due_date,
+                        splits=splits.get(id_),
+                        txn_type=txn_type,
+                        payee=payee,
+                        description=description,
+                        id_=id_,
+                    )
+                )
         return scheduled_txns
 
+    def get_scheduled_transaction(self, id_):
+        scheduled_txns = self._load_scheduled_txns('?', (id_,))
+        if not scheduled_txns:
+            raise InvalidScheduledTransactionError('no scheduled transaction with id %s' % id_)
+        return scheduled_txns[0]
+
+    def get_scheduled_transactions(self, account=None):
+        if account:
+            return self._load_scheduled_txns('SELECT scheduled_txn_id FROM scheduled_transaction_splits WHERE account_id = ?', (account.id,))
+        return self._load_scheduled_txns('SELECT id FROM scheduled_transactions')
+
 
 ### IMPORT ###
 
@@ -1137,13 +2457,14 @@ def import_kmymoney(kmy_file, storage):
     print(f'{datetime.now()} migrating payees...')
     payee_mapping_info = {}
     payees = root.find('PAYEES')
-    for payee in payees.iter('PAYEE'):
-        payee_obj = Payee(name=payee.attrib['name'])
-        storage.save_payee(payee_obj)
-        payee_mapping_info[payee.attrib['id']] = payee_obj.id
+    payee_names = {payee.attrib['id']: payee.attrib['name'] for payee in payees.iter('PAYEE')}
+    db_payees = storage.resolve_payees(payee_names.values())
+    for kmy_payee_id, name in payee_names.items():
+        payee_mapping_info[kmy_payee_id] = db_payees[name].id
     #migrate transactions
     print(f'{datetime.now()} migrating transactions...')
     transactions = root.find('TRANSACTIONS')
+    txns = []
     for transaction in transactions.iter('TRANSACTION'):
         try:
             splits_el = transaction.find('SPLITS')
@@ -1160,15 +2481,27 @@ def import_kmymoney(kmy_file, storage):
                 payee = None
                 if split.attrib['payee']:
                     payee = storage.get_payee(id_=payee_mapping_info[split.attrib['payee']])
-            storage.save_txn(
-                    Transaction(
+            txns.append(
+                    (Transaction(
                         splits=splits,
                         txn_date=transaction.attrib['postdate'],
                         payee=payee,
-                    )
+                    ), transaction.attrib)
                 )
         except Exception as e:
             print(f'error migrating transaction: {e}\n  {transaction.attrib}')
+    batch_size = 1000
+    for index in range(0, len(txns), batch_size):
+        batch = txns[index:index+batch_size]
+        try:
+            storage.save_txns([txn for txn, _ in batch], batch_size=batch_size)
+        except Exception:
+            #the whole batch was rolled back - save it one txn at a time, so only the bad txns are skipped
+            for txn, attrib in batch:
+                try:
+                    storage.save_txn(txn)
+                except Exception as e:
+                    print(f'error migrating transaction: {e}\n  {attrib}')
     for top_level_el in root:
         if top_level_el.tag not in ['ACCOUNTS', 'PAYEES', 'TRANSACTIONS']:
             print(f"didn't migrate {top_level_el.tag} data")
@@ -1293,15 +2626,18 @@ def get_accounts_model_class():
 
     class Model(QtCore.QAbstractTableModel):
 
-        def __init__(self, accounts):
+        def __init__(self, accounts, balances=None, totals=None):
             self._accounts = accounts
+            self._balances = balances or {}
+            #balances including subaccounts
+            self._totals = totals or {}
             super().__init__()
 
         def rowCount(self, parent):
             return len(self._accounts)
 
         def columnCount(self, parent):
-            return 4
+            return 7
 
         def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
             if role == QtCore.Qt.DisplayRole:
@@ -1314,6 +2650,12 @@ def get_accounts_model_class():
                         return 'Name'
                     elif section == 3:
                         return 'Parent'
+                    elif section == 4:
+                        return 'Balance'
+                    elif section == 5:
+                        return 'Cleared'
+                    elif section == 6:
+                        return 'Total'
 
         def data(self, index, role=QtCore.Qt.DisplayRole):
             if role == QtCore.Qt.DisplayRole:
@@ -1326,6 +2668,16 @@ def get_accounts_model_class():
                 if index.column() == 3:
                     if self._accounts[index.row()].parent:
                         return str(self._accounts[index.row()].parent)
+                if index.column() in [4, 5]:
+                    balances = self._balances.get(self._accounts[index.row()])
+                    if balances:
+                        if index.column() == 4:
+                            return balances.current
+                        return balances.current_cleared
+                if index.column() == 6:
+                    totals = self._totals.get(self._accounts[index.row()])
+                    if totals:
+                        return totals.current
 
         def get_account_id(self, index):
             return self._accounts[index.row()].id
@@ -1340,7 +2692,8 @@ class AccountsDisplay:
         self._reload = reload_accounts
         self._model_class = model_class
         self._accounts = self.storage.get_accounts()
-        self._accounts_model = self._get_accounts_model(self._accounts)
+        self._accounts_model = self._get_accounts_model(self._accounts, self.storage.get_account_balances(),
+                self.storage.get_account_balances(rollup=True))
 
     def get_widget(self):
         main_widget = QtWidgets.QWidget()
@@ -1356,8 +2709,8 @@ class AccountsDisplay:
         main_widget.setLayout(layout)
         return main_widget
 
-    def _get_accounts_model(self, accounts):
-        return self._model_class(accounts)
+    def _get_accounts_model(self, accounts, balances, totals):
+        return self._model_class(accounts, balances, totals)
 
     def _get_accounts_widget(self, model):
         widget = QtWidgets.QTableView()
@@ -1467,17 +2820,17 @@ class LedgerTxnsDisplay:
     def _redisplay_txns(self):
         '''draw/redraw txns on the screen as needed'''
         index = 0 #initialize in case there are no txns in the ledger
+        txns_and_balances = zip(self.ledger.get_sorted_txns(), self.ledger.get_balances())
         if self._filter_text:
-            txns = self.ledger.search(self._filter_text)
-        else:
-            txns = self.ledger.get_sorted_txns_with_balance()
-        for index, txn in enumerate(txns):
+            matching_txn_ids = set(self.storage.search_txns(self._filter_text, account=self.ledger.account))
+            txns_and_balances = [(t, b) for t, b in txns_and_balances if t.id in matching_txn_ids]
+        for index, (txn, balance) in enumerate(txns_and_balances):
             if (txn.id not in self.txn_display_data) or (self.txn_display_data[txn.id]['row'] != index):
-                self._display_txn(txn, row=index, layout=self.txns_layout)
+                self._display_txn(txn, balance, row=index, layout=self.txns_layout)
             else:
                 try:
-                    if self.txn_display_data[txn.id]['widgets']['labels']['balance'].text() != str(fraction_to_decimal(txn.balance)):
-                        self._display_txn(txn, row=index, layout=self.txns_layout)
+                    if self.txn_display_data[txn.id]['widgets']['labels']['balance'].text() != str(fraction_to_decimal(balance)):
+                        self._display_txn(txn, balance, row=index, layout=self.txns_layout)
                 except KeyError:
                     pass
         row = index + 1
@@ -1544,9 +2897,16 @@ class LedgerTxnsDisplay:
         self._redisplay_txns()
 
     def _enter_scheduled_txn(self, new_txn, scheduled_txn, layout):
-        scheduled_txn.advance_to_next_due_date()
-        self.storage.save_scheduled_transaction(scheduled_txn)
-        self.storage.save_txn(new_txn)
+        next_due_date = scheduled_txn.next_due_date
+        try:
+            with self.storage.transaction():
+                scheduled_txn.advance_to_next_due_date()
+                self.storage.save_scheduled_transaction(scheduled_txn)
+                self.storage.save_txn(new_txn)
+        except Exception:
+            #nothing was saved, so the schedule shouldn't move ahead either
+            scheduled_txn.next_due_date = next_due_date
+            raise
         self.ledger.add_transaction(new_txn)
         self._redisplay_txns()
 
@@ -1567,13 +2927,13 @@ class LedgerTxnsDisplay:
             )
         self.scheduled_txn_display.show_form()
 
-    def _display_txn(self, txn, row, layout):
+    def _display_txn(self, txn, balance, row, layout):
         #clear labels if this txn was already displayed, create new labels, add them to layout, and set txn_display_data
         if txn.id in self.txn_display_data:
             for widget in self.txn_display_data[txn.id]['widgets']['labels'].values():
                 layout.removeWidget(widget)
                 widget.deleteLater()
-        tds = get_display_strings_for_ledger(self.ledger.account, txn)
+        tds = get_display_strings_for_ledger(self.ledger.account, txn, balance=balance)
         edit_function = partial(self._edit, txn_id=txn.id, layout=layout)
         update_reconciled_function = partial(self._update_reconciled_state, txn_id=txn.id, layout=layout)
         type_label = QtWidgets.QLabel(tds['txn_type'])
@@ -1593,11 +2953,7 @@ class LedgerTxnsDisplay:
         deposit_label.mousePressEvent = edit_function
         withdrawal_label = QtWidgets.QLabel(tds['withdrawal'])
         withdrawal_label.mousePressEvent = edit_function
-        try:
-            balance = str(fraction_to_decimal(txn.balance))
-        except AttributeError:
-            balance = ''
-        balance_label = QtWidgets.QLabel(balance)
+        balance_label = QtWidgets.QLabel(tds['balance'])
         balance_label.mousePressEvent = edit_function
         layout.addWidget(type_label, row, GUI_FIELDS['txn_type']['column_number'])
         layout.addWidget(date_label, row, GUI_FIELDS['txn_date']['column_number'])
@@ -1908,11 +3264,11 @@ class ScheduledTxnForm:
         account = deposit = withdrawal = None
         if self._scheduled_txn:
             account = list(self._scheduled_txn.splits.keys())[0]
-            amount = self._scheduled_txn.splits[account]['amount']
+            amount = self._scheduled_txn.splits[account].amount
             if amount > 0:
                 deposit = str(fraction_to_decimal(amount))
             else:
-                withdrawal = str(fraction_to_decimal(amount * Fraction(-1)))
+                withdrawal = str(fraction_to_decimal(-amount))
 
         layout.addWidget(QtWidgets.QLabel('Account'), 4, 0)
         account_entry = QtWidgets.QComboBox()
@@ -1978,7 +3334,7 @@ class ScheduledTxnForm:
 
 class LedgerDisplay:
 
-    def __init__(self, storage, current_account=None):
+    def __init__(self, storage, current_account=None, window_days=None):
         self.storage = storage
         #choose an account if there is one
         if not current_account:
@@ -1986,6 +3342,8 @@ class LedgerDisplay:
             if accounts:
                 current_account = accounts[0]
         self._current_account = current_account
+        #only load the txns from the last window_days days (None for all of them)
+        self._window_days = window_days
         self.txns_display_widget = None
         self.balances_widget = None
 
@@ -2009,7 +3367,10 @@ class LedgerDisplay:
         return widget, layout
 
     def _display_ledger(self, layout, account, filter_text=''):
-        self.ledger = self.storage.get_ledger(account=account)
+        start = None
+        if self._window_days:
+            start = date.today() - timedelta(days=self._window_days)
+        self.ledger = self.storage.get_ledger(account=account, start=start)
         self.txns_display = LedgerTxnsDisplay(self.ledger, self.storage, filter_text,
                 post_update_function=partial(self._display_balances_widget, layout=layout, ledger=self.ledger))
         if self.txns_display_widget:
@@ -2049,6 +3410,11 @@ class LedgerDisplay:
         self._filter_box.setText('')
         self._display_ledger(layout=self.layout, account=self._current_account)
 
+    def _show_older_txns(self):
+        self._window_days = None
+        self._older_btn.setEnabled(False)
+        self._display_ledger(layout=self.layout, account=self._current_account, filter_text=self._filter_box.text())
+
     def _show_headings(self, layout, row):
         self.action_combo = QtWidgets.QComboBox()
         current_index = 0
@@ -2072,6 +3438,10 @@ class LedgerDisplay:
         clear_btn = QtWidgets.QPushButton('Show all')
         clear_btn.clicked.connect(self._show_all_txns)
         layout.addWidget(clear_btn, row, 5)
+        self._older_btn = QtWidgets.QPushButton('Older txns')
+        self._older_btn.clicked.connect(self._show_older_txns)
+        self._older_btn.setEnabled(bool(self._window_days))
+        layout.addWidget(self._older_btn, row, 6)
         row += 1
         layout.addWidget(QtWidgets.QLabel('Type'), row, GUI_FIELDS['txn_type']['column_number'])
         layout.addWidget(QtWidgets.QLabel('Date'), row, GUI_FIELDS['txn_date']['column_number'])
@@ -2262,9 +3632,9 @@ class BudgetDisplay:
     def __init__(self, storage, current_budget=None):
         self.storage = storage
         if not current_budget:
-            budgets = self.storage.get_budgets()
+            budgets = self.storage.get_budget_summaries()
             if budgets:
-                current_budget = budgets[0]
+                current_budget = self.storage.get_budget(budgets[0].id)
         self._current_budget = current_budget
         self._budget_select_combo = None
         self._budget_data_display_widget = None
@@ -2299,14 +3669,15 @@ class BudgetDisplay:
         layout.addWidget(self._edit_button, row, 0)
 
     def _update_budget(self, index=0):
-        self._current_budget = self.storage.get_budgets()[index]
+        budget = self.storage.get_budget_summaries()[index]
+        self._current_budget = self.storage.get_budget(budget.id)
         self._budget_select_combo.setCurrentIndex(index)
         self._display_budget(layout=self.layout, budget=self._current_budget, row=self._row_index)
 
     def _show_headings(self, layout, row):
         self._budget_select_combo = QtWidgets.QComboBox()
         current_index = 0
-        budgets = self.storage.get_budgets()
+        budgets = self.storage.get_budget_summaries()
         for index, budget in enumerate(budgets):
             if budget == self._current_budget:
                 current_index = index
@@ -2559,7 +3930,7 @@ class GUI_QT:
         if self.main_widget:
             self.content_layout.removeWidget(self.main_widget)
             self.main_widget.deleteLater()
-        self.ledger_display = LedgerDisplay(self.storage)
+        self.ledger_display = LedgerDisplay(self.storage, window_days=LEDGER_WINDOW_DAYS)
         self.main_widget = self.ledger_display.get_widget()
         self.content_layout.addWidget(self.main_widget, 0, 0)
 
@@ -2585,6 +3956,9 @@ class CLI:
     ACCOUNT_LIST_HEADER = ' ID   | Type        | Number | Name                           | Parent\n'\
         '==============================================================================================='
 
+    ACCOUNT_BALANCES_HEADER = ' ID   | Type        | Name                           | Balance        | Cleared        | Total\n'\
+        '=============================================================================================================='
+
     TXN_LIST_HEADER = ' ID   | Date       | Type   |  Description                   | Payee                          |  Transfer Account              | Withdrawal | Deposit    | Balance\n'\
         '================================================================================================================================================================'
 
@@ -2618,6 +3992,13 @@ class CLI:
                 parent = ''
             self.print(' {0:<4} | {1:<11} | {2:<7} | {3:<30} | {4:<30}'.format(a.id, a.type.name, number[:7], a.name[:30], parent[:30]))
 
+    def _list_account_balances(self):
+        self.print(self.ACCOUNT_BALANCES_HEADER)
+        balances = self.storage.get_account_balances()
+        totals = self.storage.get_account_balances(rollup=True)
+        for a in self.storage.get_accounts():
+            self.print(' {0:<4} | {1:<11} | {2:<30} | {3:<14} | {4:<14} | {5}'.format(a.id, a.type.name, a.name[:30], balances[a].current, balances[a].current_cleared, totals[a].current))
+
     def _get_and_save_account(self, account=None):
         acc_id = None
         name_prefill = acct_type_prefill = number_prefill = ''
@@ -2651,39 +4032,68 @@ class CLI:
         if not num_txns_in_page:
             num_txns_in_page = self.NUM_TXNS_IN_PAGE
         acc_id = self.input('Account ID: ')
-        ledger = self.storage.get_ledger(acc_id)
-        ledger_balances = ledger.get_current_balances_for_display()
-        summary_line = f'{ledger.account.name} (Current balance: {ledger_balances.current}; Cleared: {ledger_balances.current_cleared})'
+        account = self.storage.get_account(acc_id)
+        ledger_balances = self.storage.get_current_balances(account)
+        summary_line = f'{account.name} (Current balance: {ledger_balances.current}; Cleared: {ledger_balances.current_cleared})'
         self.print(summary_line)
-        scheduled_txns_due = ledger.get_scheduled_transactions_due()
+        scheduled_txns_due = [st for st in self.storage.get_scheduled_transactions(account=account) if st.is_due()]
         if scheduled_txns_due:
             self.print('Scheduled Transactions due:')
             for st in scheduled_txns_due:
                 self.print(f'{st.id} {st.name} {st.next_due_date}')
         self.print(self.TXN_LIST_HEADER)
-        txns = ledger.get_sorted_txns_with_balance(reverse=True)
-        page_index = 1
+        page = self.storage.get_txns_page(account, page_size=num_txns_in_page)
         while True:
-            paged_txns, more_txns = pager(txns, num_txns_in_page=num_txns_in_page, page=page_index)
-            for t in paged_txns:
-                tds = get_display_strings_for_ledger(self.storage.get_account(acc_id), t)
+            for t, balance in zip(page.txns, page.balances):
+                tds = get_display_strings_for_ledger(account, t, balance=balance)
                 self.print(' {8:<4} | {0:<10} | {1:<6} | {2:<30} | {3:<30} | {4:30} | {5:<10} | {6:<10} | {7:<10}'.format(
-                    tds['txn_date'], tds['txn_type'], tds['description'], tds['payee'], tds['categories'], tds['withdrawal'], tds['deposit'], fraction_to_decimal(t.balance), t.id)
+                    tds['txn_date'], tds['txn_type'], tds['description'], tds['payee'], tds['categories'], tds['withdrawal'], tds['deposit'], tds['balance'], t.id)
                 )
-            if more_txns:
+            if page.older_cursor:
                 prompt = '(o) older txns'
-                if page_index > 1:
+                if page.newer_cursor:
                     prompt = '(n) newer txns, ' + prompt
                 x = self.input(prompt=f'{prompt} ')
                 if x == 'o':
-                    page_index += 1
-                elif x == 'n':
-                    page_index -= 1
+                    page = self.storage.get_txns_page(account, cursor=page.older_cursor, direction=SQLiteStorage.PAGE_OLDER, page_size=num_txns_in_page)
+                elif x == 'n' and page.newer_cursor:
+                    page = self.storage.get_txns_page(account, cursor=page.newer_cursor, direction=SQLiteStorage.PAGE_NEWER, page_size=num_txns_in_page)
                 else:
                     break
             else:
                 break
 
+    def _query_txns(self):
+        self.print('Find transactions (leave blank for any):')
+        start_date = self.input(prompt='  start date: ')
+        end_date = self.input(prompt='  end date: ')
+        min_amount = self.input(prompt='  min amount: ')
+        max_amount = self.input(prompt='  max amount: ')
+        statuses = self.input(prompt='  statuses (C, R, U for uncleared): ')
+        statuses = [None if s.strip().upper() == 'U' else s.strip() for s in statuses.split(',') if s.strip()]
+        account_ids = self.input(prompt='  account IDs: ')
+        accounts = []
+        for account_id in [a.strip() for a in account_ids.split(',') if a.strip()]:
+            try:
+                accounts.append(self.storage.get_account(account_id))
+            except Exception:
+                #don't drop the filter & list everything
+                self.print(f'account {account_id} not found')
+                return
+        payee_id = self.input(prompt='  payee ID: ')
+        payee = None
+        if payee_id:
+            payee = self.storage.get_payee(payee_id)
+            if not payee:
+                self.print(f'payee {payee_id} not found')
+                return
+        text = self.input(prompt='  text: ')
+        query = TxnQuery(start_date=start_date, end_date=end_date, min_amount=min_amount, max_amount=max_amount,
+                statuses=statuses, accounts=accounts, payee=payee, text=text)
+        for t in self.storage.query_txns(query):
+            payee_name = t.payee.name if t.payee else ''
+            self.print(f' {t.id:<4} | {str(t.txn_date):<10} | {payee_name:<30} | {t.description or "":<30} | {splits_display(t.splits)}')
+
     def _get_common_txn_info(self, txn=None):
         '''get pieces of data common to txns and scheduled txns'''
         txn_info = {}
@@ -2691,10 +4101,10 @@ class CLI:
         splits = {}
         if txn:
             for account, split_info in txn.splits.items():
-                amount = self.input(prompt='%s amount: ' % account.name, prefill=fraction_to_decimal(split_info['amount']))
+                amount = self.input(prompt='%s amount: ' % account.name, prefill=fraction_to_decimal(split_info.amount))
                 if amount:
                     splits[account] = {'amount': amount}
-                    orig_status = split_info.get('status', '')
+                    orig_status = split_info.status or ''
                     if orig_status:
                         orig_status = orig_status.value
                     reconciled_state = self.input(prompt=f'{account.name} reconciled state: ', prefill=orig_status)
@@ -2776,9 +4186,16 @@ class CLI:
             scheduled_txn_id = self.input('Scheduled txn ID (blank to quit): ')
             if scheduled_txn_id:
                 scheduled_txn = self.storage.get_scheduled_transaction(scheduled_txn_id)
-                self._get_and_save_txn(txn=scheduled_txn)
-                scheduled_txn.advance_to_next_due_date()
-                self.storage.save_scheduled_transaction(scheduled_txn)
+                next_due_date = scheduled_txn.next_due_date
+                try:
+                    with self.storage.transaction():
+                        self._get_and_save_txn(txn=scheduled_txn)
+                        scheduled_txn.advance_to_next_due_date()
+                        self.storage.save_scheduled_transaction(scheduled_txn)
+                except Exception:
+                    #nothing was saved, so the schedule shouldn't move ahead either
+                    scheduled_txn.next_due_date = next_due_date
+                    raise
             else:
                 break
 
@@ -2845,7 +4262,7 @@ class CLI:
         self._get_and_save_scheduled_txn(scheduled_txn=scheduled_txn)
 
     def _list_budgets(self):
-        for b in self.storage.get_budgets():
+        for b in self.storage.get_budget_summaries():
             self.print(b)
 
     def _display_budget(self):
@@ -2866,9 +4283,9 @@ class CLI:
                 display += f' {info["notes"]}'
             self.print(display)
 
-    def _display_budget_report(self):
+    def _display_budget_report(self, rollup=False):
         budget_id = self.input('Enter budget ID: ')
-        budget = self.storage.get_budget(budget_id)
+        budget = self.storage.get_budget(budget_id, rollup=rollup)
         self.print(budget)
         budget_report = budget.get_report_display(current_date=date.today())
         for account, info in budget_report['income'].items():
@@ -2953,9 +4370,11 @@ class CLI:
     def run(self):
         info = {
             'a': {'description': 'list accounts', 'function': self._list_accounts},
+            'ab': {'description': 'list account balances', 'function': self._list_account_balances},
             'ac': {'description': 'create account', 'function': self._create_account},
             'ae': {'description': 'edit account', 'function': self._edit_account},
             't': {'description': 'list txns', 'function': self._list_account_txns},
+            'tq': {'description': 'find transactions', 'function': self._query_txns},
             'tc': {'description': 'create transaction', 'function': self._create_txn},
             'te': {'description': 'edit transaction', 'function': self._edit_txn},
             'st': {'description': 'list scheduled transactions', 'function': self._list_scheduled_txns},
@@ -2965,6 +4384,7 @@ class CLI:
             'b': {'description': 'list budgets', 'function': self._list_budgets},
             'bd': {'description': 'display budget', 'function': self._display_budget},
             'bdr': {'description': 'display budget report', 'function': self._display_budget_report},
+            'bdrt': {'description': 'display budget report, with subaccounts included in their parents', 'function': lambda: self._display_budget_report(rollup=True)},
             'bc': {'description': 'create budget', 'function': self._create_budget},
             'be': {'description': 'edit budget', 'function': self._edit_budget},
         }
@@ -72,11 +72,12 @@ def _load_data(storage, many_txns):
 
     if many_txns:
         print('adding 1000 random txns')
+        txns = []
         for i in range(1000):
             amt = random.randint(1, 500)
             day = random.randint(1, 30)
-            txn = bb.Transaction(splits={checking: {'amount': amt * -1}, restaurants: {'amount': amt}}, txn_date='2018-04-%s' % day)
-            storage.save_txn(txn)
+            txns.append(bb.Transaction(splits={checking: {'amount': amt * -1}, restaurants: {'amount': amt}}, txn_date='2018-04-%s' % day))
+        storage.save_txns(txns)
 
     rent_scheduled_txn = bb.ScheduledTransaction(
             name='rent',
@@ -53,6 +53,53 @@ class TestUtils(unittest.TestCase):
             self.assertEqual(sorted([str(f) for f in bb.get_files(tmp)]), [path3, path2])
 
 
+class TestMoney(unittest.TestCase):
+
+    def test_init(self):
+        self.assertEqual(bb.Money('10.5').cents, 1050)
+        self.assertEqual(bb.Money(Fraction(21, 2)).cents, 1050)
+        self.assertEqual(bb.Money(-3).cents, -300)
+        self.assertEqual(bb.Money(bb.Money('0.01')).cents, 1)
+        self.assertEqual(bb.Money.from_cents(-5).cents, -5)
+        with self.assertRaises(bb.InvalidAmount):
+            bb.Money(1.5)
+        with self.assertRaises(bb.InvalidAmount):
+            bb.Money('1.234')
+        with self.assertRaises(bb.InvalidAmount) as cm:
+            bb.Money('abc')
+        self.assertEqual(str(cm.exception), 'error generating Fraction from "abc"')
+        with self.assertRaises(bb.InvalidAmount):
+            bb.Money('1/0')
+
+    def test_fraction_compatible(self):
+        m = bb.Money('-10.05')
+        f = Fraction('-10.05')
+        self.assertEqual(m, f)
+        self.assertEqual(f, m)
+        self.assertEqual(hash(m), hash(f))
+        self.assertEqual(hash(bb.Money(5)), hash(5))
+        self.assertEqual((m.numerator, m.denominator), (f.numerator, f.denominator))
+        self.assertEqual(Fraction(m), f)
+        self.assertEqual(str(m), str(bb.fraction_to_decimal(f)))
+        self.assertEqual(str(bb.Money('1.50')), '1.5')
+        self.assertEqual(str(bb.Money(0)), '0')
+        self.assertTrue(m < 0)
+        self.assertTrue(f < bb.Money(0))
+        self.assertFalse(bb.Money(0))
+
+    def test_arithmetic(self):
+        a = bb.Money('10.5')
+        b = bb.Money('0.25')
+        self.assertEqual(a + b, bb.Money('10.75'))
+        self.assertIsInstance(a + b, bb.Money)
+        self.assertIsInstance(a - 1, bb.Money)
+        self.assertEqual(sum([a, b, -a]), b)
+        self.assertEqual(a * 2, 21)
+        self.assertEqual(a / b, 42)
+        self.assertEqual(a + Fraction(1, 3), Fraction(65, 6))
+        self.assertEqual(-a, Fraction('-10.5'))
+
+
 class TestAccount(unittest.TestCase):
 
     def test_init(self):
@@ -151,7 +198,7 @@ class TestTransaction(unittest.TestCase):
             )
         txn_splits = {self.checking: {'amount': Fraction(100), 'status': 'C'}, self.savings: {'amount': Fraction(-100)}}
         self.assertEqual(t.splits, txn_splits)
-        self.assertTrue(isinstance(t.splits[self.checking]['amount'], Fraction))
+        self.assertTrue(isinstance(t.splits[self.checking]['amount'], bb.Money))
         self.assertEqual(t.txn_date, date.today())
         self.assertEqual(t.txn_type, '1234')
         self.assertEqual(t.payee.name, 'payee 1')
@@ -234,6 +281,16 @@ class TestTransaction(unittest.TestCase):
                 )
         self.assertEqual(str(cm.exception), 'invalid status "d"')
 
+    def test_update_reconciled_state(self):
+        t = bb.Transaction(splits={self.checking: {'amount': '-101'}, self.savings: {'amount': '101'}}, txn_date=date.today())
+        t.update_reconciled_state(self.checking)
+        self.assertEqual(t.splits[self.checking].status, bb.Transaction.CLEARED)
+        t.update_reconciled_state(self.checking)
+        self.assertEqual(t.splits[self.checking].status, bb.Transaction.RECONCILED)
+        t.update_reconciled_state(self.checking)
+        self.assertEqual(t.splits[self.checking], {'amount': -101})
+        self.assertEqual(t.splits[self.savings].status, None)
+
     def test_txn_splits_from_user_info(self):
         #test passing in list, just one account, ...
         house = get_test_account(id_=3, name='House')
@@ -328,6 +385,37 @@ class TestTransaction(unittest.TestCase):
         self.assertEqual(bb._categories_display(t.splits, main_account=a), 'Savings')
 
 
+class TestSplit(unittest.TestCase):
+
+    def test_dict_compatible(self):
+        split = bb.Split(bb.Money('10.5'), 'C')
+        self.assertEqual(split, {'amount': Fraction(21, 2), 'status': 'C'})
+        self.assertEqual({'amount': Fraction(21, 2), 'status': 'C'}, split)
+        self.assertEqual(split['amount'], Fraction(21, 2))
+        self.assertEqual(split.get('status'), 'C')
+        self.assertEqual(dict(split), {'amount': Fraction(21, 2), 'status': 'C'})
+        self.assertEqual(split.pop('status'), 'C')
+        self.assertEqual(split, {'amount': Fraction(21, 2)})
+        self.assertFalse('status' in split)
+        self.assertEqual(split.get('status', ''), '')
+        with self.assertRaises(KeyError):
+            split['status']
+        split['status'] = 'R'
+        self.assertEqual(split.status, 'R')
+        with self.assertRaises(KeyError):
+            split['description'] = 'food'
+
+    def test_slots(self):
+        checking = get_test_account(id_=1)
+        savings = get_test_account(id_=2, name='Savings')
+        txn = bb.Transaction(txn_date=date(2017, 1, 1), splits={checking: {'amount': 5, 'status': ''}, savings: {'amount': -5}})
+        self.assertIsInstance(txn.splits[checking], bb.Split)
+        self.assertIsNone(txn.splits[checking].status)
+        for obj in [txn, checking, bb.Payee('payee'), txn.splits[checking]]:
+            with self.assertRaises(AttributeError):
+                obj.balance = 5
+
+
 class TestLedger(unittest.TestCase):
 
     def setUp(self):
@@ -374,21 +462,52 @@ class TestLedger(unittest.TestCase):
         ledger.add_transaction(bb.Transaction(id_=2, splits=splits2, txn_date=date(2017, 6, 5)))
         ledger.add_transaction(bb.Transaction(id_=3, splits=splits3, txn_date=date(2017, 7, 30)))
         ledger.add_transaction(bb.Transaction(id_=4, splits=splits4, txn_date=date(2017, 4, 25)))
-        ledger_records = ledger.get_sorted_txns_with_balance()
+        ledger_records = ledger.get_sorted_txns()
+        balances = ledger.get_balances()
         self.assertEqual(ledger_records[0].txn_date, date(2017, 4, 25))
-        self.assertEqual(ledger_records[0].balance, 10)
+        self.assertEqual(balances[0], 10)
         self.assertEqual(ledger_records[1].txn_date, date(2017, 6, 5))
-        self.assertEqual(ledger_records[1].balance, -2)
+        self.assertEqual(balances[1], -2)
         self.assertEqual(ledger_records[2].txn_date, date(2017, 7, 30))
-        self.assertEqual(ledger_records[2].balance, -1)
+        self.assertEqual(balances[2], -1)
         self.assertEqual(ledger_records[3].txn_date, date(2017, 8, 5))
-        self.assertEqual(ledger_records[3].balance, Fraction('31.45'))
+        self.assertEqual(balances[3], Fraction('31.45'))
+        self.assertFalse(hasattr(ledger_records[0], 'balance'))
 
-        reversed_ledger_records = ledger.get_sorted_txns_with_balance(reverse=True)
+        reversed_ledger_records = ledger.get_sorted_txns(reverse=True)
+        reversed_balances = ledger.get_balances(reverse=True)
         self.assertEqual(reversed_ledger_records[0].txn_date, date(2017, 8, 5))
-        self.assertEqual(reversed_ledger_records[0].balance, Fraction('31.45'))
+        self.assertEqual(reversed_balances[0], Fraction('31.45'))
         self.assertEqual(reversed_ledger_records[3].txn_date, date(2017, 4, 25))
-        self.assertEqual(reversed_ledger_records[3].balance, 10)
+        self.assertEqual(reversed_balances[3], 10)
+
+    def test_balance_column_eq(self):
+        balances = bb.BalanceColumn([1050, 2000])
+        self.assertEqual(balances, [Fraction('10.5'), 20])
+        self.assertEqual(balances, bb.BalanceColumn([1050, 2000]))
+        self.assertNotEqual(balances, bb.BalanceColumn([1050]))
+        self.assertFalse(balances == None)
+        self.assertNotEqual(balances, 5)
+
+    def test_balances_are_per_ledger(self):
+        #a transfer shows a different balance in each account's ledger
+        checking_ledger = bb.Ledger(account=self.checking)
+        savings_ledger = bb.Ledger(account=self.savings)
+        txn = bb.Transaction(id_=1, splits={self.checking: {'amount': -5}, self.savings: {'amount': 5}}, txn_date=date(2017, 1, 1))
+        checking_ledger.add_transaction(bb.Transaction(id_=2, splits={self.checking: {'amount': 100}, self.savings: {'amount': -100}}, txn_date=date(2016, 1, 1)))
+        checking_ledger.add_transaction(txn)
+        savings_ledger.add_transaction(txn)
+        self.assertEqual(list(checking_ledger.get_balances()), [100, 95])
+        self.assertEqual(list(savings_ledger.get_balances()), [5])
+        self.assertEqual(list(checking_ledger.get_balances()), [100, 95])
+        balances = checking_ledger.get_balances()
+        self.assertTrue(checking_ledger.get_balances() is balances)
+        with self.assertRaises(TypeError):
+            balances[0] = 10
+        checking_ledger.remove_txn(2)
+        self.assertEqual(list(checking_ledger.get_balances()), [-5])
+        self.assertEqual(list(balances), [100, 95])
+        self.assertEqual(bb.get_display_strings_for_ledger(self.checking, txn, balance=checking_ledger.get_balances()[0])['balance'], '-5')
 
     def test_balances(self):
         ledger = bb.Ledger(account=self.checking)
@@ -405,6 +524,28 @@ class TestLedger(unittest.TestCase):
         expected_balances = bb.LedgerBalances(current='70.45', current_cleared='82.45')
         self.assertEqual(ledger.get_current_balances_for_display(), expected_balances)
 
+    def test_txns_before_start(self):
+        ledger = bb.Ledger(account=self.checking, start=date(2017, 6, 1), opening_balance=100, opening_cleared=100)
+        txn = bb.Transaction(id_=1, splits={self.checking: {'amount': 20, 'status': bb.Transaction.CLEARED}, self.savings: {'amount': -20}}, txn_date=date(2017, 5, 1))
+        ledger.add_transaction(txn)
+        ledger.add_transaction(txn)
+        self.assertEqual((ledger.opening_balance, ledger.opening_cleared), (120, 120))
+        self.assertEqual(ledger.get_sorted_txns(), [])
+        #move it into the window
+        txn = bb.Transaction(id_=1, splits={self.checking: {'amount': 30}, self.savings: {'amount': -30}}, txn_date=date(2017, 6, 1))
+        ledger.add_transaction(txn)
+        self.assertEqual((ledger.opening_balance, ledger.opening_cleared), (100, 100))
+        self.assertEqual(list(ledger.get_balances()), [130])
+        #and back out
+        txn = bb.Transaction(id_=1, splits={self.checking: {'amount': 40}, self.savings: {'amount': -40}}, txn_date=date(2017, 5, 31))
+        ledger.add_transaction(txn)
+        self.assertEqual((ledger.opening_balance, ledger.opening_cleared), (140, 100))
+        self.assertEqual(ledger.get_sorted_txns(), [])
+        ledger.remove_txn(1)
+        self.assertEqual((ledger.opening_balance, ledger.opening_cleared), (100, 100))
+        with self.assertRaises(KeyError):
+            ledger.remove_txn(1)
+
     def test_get_scheduled_txns_due(self):
         ledger = bb.Ledger(account=self.checking)
         splits = {self.checking: {'amount': 100}, self.savings: {'amount': -100}}
@@ -455,7 +596,48 @@ class TestLedger(unittest.TestCase):
         splits = {self.checking: {'amount': 100}, self.savings: {'amount': -100}}
         ledger.add_transaction(bb.Transaction(id_=1, splits=splits, txn_date=date(2017, 8, 5)))
         ledger.clear_txns()
-        self.assertEqual(ledger.get_sorted_txns_with_balance(), [])
+        self.assertEqual(ledger.get_sorted_txns(), [])
+
+    def test_edit_and_remove_txns(self):
+        ledger = bb.Ledger(account=self.checking)
+        for i in range(1, 11):
+            ledger.add_transaction(bb.Transaction(id_=i, splits={self.checking: {'amount': i}, self.savings: {'amount': -i}}, txn_date=date(2017, 1, i)))
+        #move a txn to a different date, with a different amount
+        ledger.add_transaction(bb.Transaction(id_=2, splits={self.checking: {'amount': 20, 'status': 'C'}, self.savings: {'amount': -20}}, txn_date=date(2017, 2, 1)))
+        ledger.remove_txn(5)
+        txns = ledger.get_sorted_txns()
+        self.assertEqual([t.id for t in txns], [1, 3, 4, 6, 7, 8, 9, 10, 2])
+        self.assertEqual(ledger.get_balances()[-1], 68)
+        self.assertEqual(ledger.get_balance_at(2), 8)
+        self.assertEqual(ledger.get_txn_balance(2), 68)
+        self.assertEqual(ledger.get_txn_balance(6), 14)
+        self.assertEqual(ledger.get_current_balances_for_display(), bb.LedgerBalances(current='68', current_cleared='20'))
+        with self.assertRaises(IndexError):
+            ledger.get_balance_at(9)
+
+    def test_ledger_entries(self):
+        #use small blocks, so entries get split across blocks
+        entries = bb.LedgerEntries()
+        entries.BLOCK_SIZE = 2
+        expected = {}
+        for i in [5, 1, 9, 3, 7, 2, 8, 4, 6, 10, 0]:
+            entries.add((i,), Fraction(i), Fraction(i % 2), i)
+            expected[i] = Fraction(i)
+        for i in [3, 10, 0]:
+            entries.remove((i,))
+            del expected[i]
+        with self.assertRaises(KeyError):
+            entries.remove((3,))
+        self.assertTrue(len(entries._entries) > 1)
+        self.assertEqual(len(entries), len(expected))
+        self.assertEqual([e[3] for e in entries], sorted(expected))
+        for position, i in enumerate(sorted(expected)):
+            balance = sum([amount for key, amount in expected.items() if key <= i])
+            self.assertEqual(entries.get_balance_at(position), balance)
+            self.assertEqual(entries.get_balances_through_key((i,))[0], balance)
+        self.assertEqual(entries.get_balances_through_key((6,)), (18, 2))
+        self.assertEqual(entries.get_balances_through_key((100,)), (42, 4))
+        self.assertEqual(entries.get_balances_through_key((0,)), (0, 0))
 
     def test_get_payees(self):
         ledger = bb.Ledger(account=self.checking)
@@ -714,7 +896,13 @@ class TestBudget(unittest.TestCase):
         self.assertEqual(budget_report['income'][interest], {})
 
 
-TABLES = [('commodities',), ('institutions',), ('accounts',), ('budgets',), ('budget_values',), ('payees',), ('scheduled_transactions',), ('scheduled_transaction_splits',), ('transactions',), ('transaction_splits',), ('misc',)]
+def get_expected_tables(storage):
+    #the search index tables are only there if this SQLite has FTS5
+    tables = [('commodities',), ('institutions',), ('accounts',), ('budgets',), ('budget_values',), ('payees',), ('scheduled_transactions',), ('scheduled_transaction_splits',), ('transactions',), ('transaction_splits',), ('misc',)]
+    if storage._has_search_index():
+        tables.extend([('txn_search',), ('txn_search_data',), ('txn_search_idx',), ('txn_search_content',), ('txn_search_docsize',), ('txn_search_config',)])
+    tables.extend([('balance_checkpoints',), ('account_ancestors',)])
+    return tables
 
 
 class TestSQLiteStorage(unittest.TestCase):
@@ -735,9 +923,9 @@ class TestSQLiteStorage(unittest.TestCase):
     def test_init(self):
         storage = bb.SQLiteStorage(':memory:')
         tables = storage._db_connection.execute('SELECT name from sqlite_master WHERE type="table"').fetchall()
-        self.assertEqual(tables, TABLES)
+        self.assertEqual(tables, get_expected_tables(storage))
         misc_table_records = storage._db_connection.execute('SELECT * FROM misc').fetchall()
-        self.assertEqual(misc_table_records, [('schema_version', '0')])
+        self.assertEqual(misc_table_records, [('schema_version', '6')])
         commodities_table_records = storage._db_connection.execute('SELECT * FROM commodities').fetchall()
         self.assertEqual(commodities_table_records, [(1, 'currency', 'USD', 'US Dollar')])
 
@@ -750,24 +938,166 @@ class TestSQLiteStorage(unittest.TestCase):
     def test_init_file_doesnt_exist(self):
         storage = bb.SQLiteStorage(self.file_name)
         tables = storage._db_connection.execute('SELECT name from sqlite_master WHERE type="table"').fetchall()
-        self.assertEqual(tables, TABLES)
+        self.assertEqual(tables, get_expected_tables(storage))
 
     def test_init_empty_file(self):
         with open(self.file_name, 'wb') as f:
             pass
         storage = bb.SQLiteStorage(self.file_name)
         tables = storage._db_connection.execute('SELECT name from sqlite_master WHERE type="table"').fetchall()
-        self.assertEqual(tables, TABLES)
+        self.assertEqual(tables, get_expected_tables(storage))
 
     def test_init_db_already_setup(self):
         #set up file
         init_storage = bb.SQLiteStorage(self.file_name)
         tables = init_storage._db_connection.execute('SELECT name from sqlite_master WHERE type="table"').fetchall()
-        self.assertEqual(tables, TABLES)
+        self.assertEqual(tables, get_expected_tables(init_storage))
         #and now open it again and make sure everything's fine
         storage = bb.SQLiteStorage(self.file_name)
         tables = init_storage._db_connection.execute('SELECT name from sqlite_master WHERE type="table"').fetchall()
-        self.assertEqual(tables, TABLES)
+        self.assertEqual(tables, get_expected_tables(storage))
+
+    def test_migrate_old_file(self):
+        #set up a schema version 0 file, with the data stored the way it was then
+        with patch.object(bb.SQLiteStorage, '_get_migrations', return_value=[]):
+            storage = bb.SQLiteStorage(self.file_name)
+        conn = storage._db_connection
+        conn.execute('INSERT INTO accounts(type, commodity_id, name) VALUES(?, ?, ?)', (bb.AccountType.ASSET.value, 1, 'Checking'))
+        conn.execute('INSERT INTO accounts(type, commodity_id, name) VALUES(?, ?, ?)', (bb.AccountType.ASSET.value, 1, 'Savings'))
+        conn.execute('INSERT INTO payees(name) VALUES(?)', ('Grocery Store',))
+        conn.execute('INSERT INTO transactions(currency_id, date, payee_id) VALUES(?, ?, ?)', (1, '2020-01-01', 1))
+        conn.execute('INSERT INTO transaction_splits(txn_id, account_id, value, quantity) VALUES(?, ?, ?, ?)', (1, 1, '21/2', '21/2'))
+        conn.execute('INSERT INTO transaction_splits(txn_id, account_id, value, quantity) VALUES(?, ?, ?, ?)', (1, 2, '-21/2', '-21/2'))
+        conn.commit()
+        conn.close()
+        storage = bb.SQLiteStorage(self.file_name)
+        misc_table_records = storage._db_connection.execute('SELECT * FROM misc').fetchall()
+        self.assertEqual(misc_table_records, [('schema_version', '6')])
+        index_names = [r[0] for r in storage._db_connection.execute('SELECT name FROM sqlite_master WHERE type="index" AND sql IS NOT NULL').fetchall()]
+        self.assertTrue('transaction_splits_account_id' in index_names)
+        self.assertTrue('transaction_splits_txn_id' in index_names)
+        self.assertTrue('transactions_date' in index_names)
+        query_plan = storage._db_connection.execute('EXPLAIN QUERY PLAN SELECT txn_id FROM transaction_splits WHERE account_id = ?', (1,)).fetchall()
+        self.assertTrue('transaction_splits_account_id' in str(query_plan))
+        split_records = storage._db_connection.execute('SELECT account_id, value_cents FROM transaction_splits').fetchall()
+        self.assertEqual(split_records, [(1, 1050), (2, -1050)])
+        checking = storage.get_account(1)
+        txn = storage.get_txn(1)
+        self.assertEqual(txn.splits[checking], {'amount': Fraction(21, 2)})
+        ledger = storage.get_ledger(checking.id)
+        self.assertEqual(len(ledger.get_sorted_txns()), 1)
+        self.assertEqual(storage.search_txns('grocery'), [1])
+        self.assertEqual(storage._db_connection.execute('SELECT * FROM balance_checkpoints').fetchall(), [(1, '2020-01', 1050, 0), (2, '2020-01', -1050, 0)])
+        self.assertEqual(storage.account_balance(checking, date(2020, 1, 31)), Fraction(21, 2))
+        self.assertEqual(storage._db_connection.execute('SELECT * FROM account_ancestors ORDER BY account_id').fetchall(), [(1, 1, 0), (2, 2, 0)])
+
+    def test_newer_schema_version(self):
+        storage = bb.SQLiteStorage(self.file_name)
+        storage._db_connection.execute('UPDATE misc SET value = ? WHERE key = ?', ('1000', 'schema_version'))
+        storage._db_connection.commit()
+        storage._db_connection.close()
+        with self.assertRaises(bb.SQLiteStorageError) as cm:
+            bb.SQLiteStorage(self.file_name)
+        self.assertEqual(str(cm.exception), 'data file schema version 1000 is newer than this version of bricbooks supports')
+
+    def test_fsum(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        savings = get_test_account(name='Savings')
+        storage.save_account(checking)
+        storage.save_account(savings)
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 1, 1), splits={checking: {'amount': '10.01'}, savings: {'amount': '-10.01'}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 1, 2), splits={checking: {'amount': '-2.5'}, savings: {'amount': '2.5'}}))
+        records = storage._db_connection.execute('SELECT account_id, fsum(value) FROM transaction_splits GROUP BY account_id ORDER BY account_id').fetchall()
+        self.assertEqual(records, [(checking.id, '751/100'), (savings.id, '-751/100')])
+        self.assertEqual(Fraction(records[0][1]), Fraction('7.51'))
+        self.assertEqual(storage._db_connection.execute('SELECT fsum(value) FROM scheduled_transaction_splits').fetchone(), (None,))
+
+    def test_transaction(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        savings = get_test_account(name='Savings')
+        queries = []
+        storage._db_connection.set_trace_callback(queries.append)
+        with storage.transaction():
+            storage.save_account(checking)
+            storage.save_account(savings)
+            storage.save_txn(bb.Transaction(txn_date=date(2018, 1, 1), splits={checking: {'amount': 1}, savings: {'amount': -1}}))
+        storage._db_connection.set_trace_callback(None)
+        self.assertEqual(len([q for q in queries if q == 'COMMIT']), 1)
+        self.assertEqual(len(storage.get_ledger(checking).get_sorted_txns()), 1)
+        #an exception rolls back everything in the block
+        rolled_back_txn = bb.Transaction(txn_date=date(2018, 1, 2), splits={checking: {'amount': 2}, savings: {'amount': -2}})
+        rolled_back_payee = bb.Payee('payee')
+        with self.assertRaises(Exception) as cm:
+            with storage.transaction():
+                storage.save_txn(rolled_back_txn)
+                storage.save_payee(rolled_back_payee)
+                storage.save_txn(bb.Transaction(id_=10, txn_date=date(2018, 1, 3), splits={checking: {'amount': 3}, savings: {'amount': -3}}))
+        self.assertEqual(str(cm.exception), 'no txn with id 10 to update')
+        self.assertEqual(storage._db_connection.execute('SELECT date FROM transactions').fetchall(), [('2018-01-01',)])
+        self.assertEqual(storage.get_payees(), [])
+        #objects saved in the rolled-back block don't keep their ids, so they can be saved again
+        self.assertIsNone(rolled_back_txn.id)
+        self.assertIsNone(rolled_back_payee.id)
+        storage.save_txn(rolled_back_txn)
+        storage.delete_txn(rolled_back_txn.id)
+        #rolling back an outer block also undoes ids from nested blocks that finished
+        new_account = get_test_account(name='New')
+        with self.assertRaises(Exception):
+            with storage.transaction():
+                with storage.transaction():
+                    storage.save_account(new_account)
+                raise Exception('error')
+        self.assertIsNone(new_account.id)
+        #nested blocks only roll back to their savepoint
+        with storage.transaction():
+            storage.save_txn(bb.Transaction(txn_date=date(2018, 1, 4), splits={checking: {'amount': 4}, savings: {'amount': -4}}))
+            try:
+                with storage.transaction():
+                    storage.save_payee(bb.Payee('payee'))
+                    storage.save_payee(bb.Payee('payee'))
+            except sqlite3.IntegrityError:
+                pass
+        self.assertEqual(storage._db_connection.execute('SELECT date FROM transactions').fetchall(), [('2018-01-01',), ('2018-01-04',)])
+        self.assertEqual(storage.get_payees(), [])
+        self.assertFalse(storage._db_connection.in_transaction)
+        #a caught nested failure keeps the shared account & payee objects, and puts back their saved data
+        payee = bb.Payee('kept payee')
+        storage.save_payee(payee)
+        with storage.transaction():
+            try:
+                with storage.transaction():
+                    checking.name = 'Renamed'
+                    storage.save_account(checking)
+                    payee.name = 'renamed payee'
+                    storage.save_payee(payee)
+                    raise Exception('error')
+            except Exception:
+                pass
+            storage.save_account(get_test_account(name='Other'))
+        self.assertIs(storage.get_account(checking.id), checking)
+        self.assertEqual(checking.name, 'Checking')
+        self.assertIs(storage.get_account(savings.id), savings)
+        self.assertIs(storage.get_payee(payee.id), payee)
+        self.assertIs(storage.get_payee(name='kept payee'), payee)
+        self.assertEqual(storage.get_payee(name='renamed payee'), None)
+
+    def test_save_txn_error_rolls_back(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        savings = get_test_account(name='Savings')
+        storage.save_account(checking)
+        storage.save_account(savings)
+        t = bb.Transaction(txn_date=date(2018, 1, 1), splits={checking: {'amount': 1}, savings: {'amount': -1}})
+        storage.save_txn(t)
+        #splits for an unsaved account fail partway through saving the txn
+        bad_account = get_test_account(id_=99, name='Bad')
+        updated_t = bb.Transaction(id_=t.id, txn_date=date(2018, 2, 1), splits={checking: {'amount': 1}, bad_account: {'amount': -1}})
+        with self.assertRaises(sqlite3.IntegrityError):
+            storage.save_txn(updated_t)
+        self.assertEqual(storage._db_connection.execute('SELECT date FROM transactions').fetchall(), [('2018-01-01',)])
+        self.assertEqual(storage.get_txn(t.id).splits[savings], {'amount': -1})
 
     def test_save_account(self):
         storage = bb.SQLiteStorage(':memory:')
@@ -878,6 +1208,26 @@ class TestSQLiteStorage(unittest.TestCase):
         account = storage.get_account(number='4010')
         self.assertEqual(account.name, 'Checking')
 
+    def test_account_identity_map(self):
+        storage = bb.SQLiteStorage(':memory:')
+        c = storage._db_connection.cursor()
+        c.execute('INSERT INTO accounts(type, commodity_id, name) VALUES (?, ?, ?)', (bb.AccountType.EXPENSE.value, 1, 'Food'))
+        food_id = c.lastrowid
+        c.execute('INSERT INTO accounts(type, commodity_id, name, parent_id) VALUES (?, ?, ?, ?)', (bb.AccountType.EXPENSE.value, 1, 'Restaurants', food_id))
+        restaurants_id = c.lastrowid
+        restaurants = storage.get_account(restaurants_id)
+        queries = []
+        storage._db_connection.set_trace_callback(queries.append)
+        self.assertIs(storage.get_account(restaurants_id), restaurants)
+        self.assertIs(storage.get_account(str(food_id)), restaurants.parent)
+        self.assertEqual(queries, [])
+        storage._db_connection.set_trace_callback(None)
+        #saving a different object for the same account updates the shared object
+        storage.save_account(bb.Account(id_=food_id, type_=bb.AccountType.EXPENSE, name='Groceries'))
+        self.assertEqual(restaurants.parent.name, 'Groceries')
+        self.assertIs(storage.get_account(food_id), restaurants.parent)
+        self.assertIs(storage.get_account(name='Groceries'), restaurants.parent)
+
     def test_get_accounts(self):
         storage = bb.SQLiteStorage(':memory:')
         checking = get_test_account()
@@ -895,6 +1245,27 @@ class TestSQLiteStorage(unittest.TestCase):
         self.assertEqual(len(accounts), 1)
         self.assertEqual(accounts[0].name, 'Housing')
 
+    def test_get_accounts_one_query(self):
+        storage = bb.SQLiteStorage(':memory:')
+        food = get_test_account(type_=bb.AccountType.EXPENSE, name='Food')
+        storage.save_account(food)
+        checking = get_test_account()
+        storage.save_account(checking)
+        restaurants = bb.Account(type_=bb.AccountType.EXPENSE, name='Restaurants', parent=food)
+        storage.save_account(restaurants)
+        #clear the identity map, so the accounts have to be loaded from the DB
+        storage._accounts = {}
+        storage._all_accounts_loaded = False
+        queries = []
+        storage._db_connection.set_trace_callback(queries.append)
+        accounts = storage.get_accounts()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([a.name for a in accounts], ['Checking', 'Food', 'Restaurants'])
+        self.assertIs(accounts[2].parent, accounts[1])
+        storage.get_accounts(type_=bb.AccountType.EXPENSE)
+        storage._db_connection.set_trace_callback(None)
+        self.assertEqual(len(queries), 1)
+
     def test_payee_unique(self):
         storage = bb.SQLiteStorage(':memory:')
         payee = bb.Payee('payee')
@@ -903,6 +1274,64 @@ class TestSQLiteStorage(unittest.TestCase):
             storage.save_payee(bb.Payee('payee'))
         self.assertEqual(str(cm.exception), 'UNIQUE constraint failed: payees.name')
 
+    def test_payee_cache(self):
+        storage = bb.SQLiteStorage(':memory:')
+        payee = bb.Payee('payee', notes='some notes')
+        storage.save_payee(payee)
+        queries = []
+        storage._db_connection.set_trace_callback(queries.append)
+        self.assertIs(storage.get_payee(payee.id), payee)
+        self.assertIs(storage.get_payee(str(payee.id)), payee)
+        self.assertIs(storage.get_payee(name='payee'), payee)
+        self.assertEqual(storage.get_payee(name='nobody'), None)
+        self.assertEqual(queries, [])
+        storage._db_connection.set_trace_callback(None)
+        other_payee = bb.Payee('other payee')
+        storage.save_payee(other_payee)
+        #renaming a payee only updates that payee
+        storage.save_payee(bb.Payee('renamed payee', id_=payee.id))
+        self.assertEqual(storage.get_payee(name='payee'), None)
+        self.assertEqual(storage.get_payee(payee.id).name, 'renamed payee')
+        self.assertEqual(storage.get_payee(other_payee.id).name, 'other payee')
+        records = storage._db_connection.execute('SELECT id, name FROM payees ORDER BY id').fetchall()
+        self.assertEqual(records, [(payee.id, 'renamed payee'), (other_payee.id, 'other payee')])
+        self.assertEqual([p.name for p in storage.get_payees()], ['renamed payee', 'other payee'])
+
+    def test_rename_cached_payee(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        savings = get_test_account(name='Savings')
+        storage.save_account(checking)
+        storage.save_account(savings)
+        storage.save_payee(bb.Payee('Some Restaurant'))
+        payee = storage.get_payee(name='Some Restaurant')
+        payee.name = 'Diner'
+        storage.save_payee(payee)
+        self.assertEqual(storage.get_payee(name='Some Restaurant'), None)
+        self.assertIs(storage.get_payee(name='Diner'), payee)
+        txn = bb.Transaction(txn_date=date(2018, 1, 1), payee='Some Restaurant', splits={checking: {'amount': 1}, savings: {'amount': -1}})
+        storage.save_txn(txn)
+        self.assertNotEqual(txn.payee.id, payee.id)
+        records = storage._db_connection.execute('SELECT id, name FROM payees ORDER BY id').fetchall()
+        self.assertEqual(records, [(payee.id, 'Diner'), (txn.payee.id, 'Some Restaurant')])
+        self.assertEqual(storage.get_txn(txn.id).payee.name, 'Some Restaurant')
+
+    def test_resolve_payees(self):
+        storage = bb.SQLiteStorage(':memory:')
+        existing = bb.Payee('existing')
+        storage.save_payee(existing)
+        queries = []
+        storage._db_connection.set_trace_callback(queries.append)
+        payees = storage.resolve_payees(['new 1', 'existing', 'new 2', 'new 1'])
+        storage._db_connection.set_trace_callback(None)
+        self.assertEqual(len([q for q in queries if q.startswith('INSERT')]), 2) #executemany traces each row
+        self.assertEqual(len([q for q in queries if q == 'COMMIT']), 1)
+        self.assertIs(payees['existing'], existing)
+        self.assertEqual(sorted(payees.keys()), ['existing', 'new 1', 'new 2'])
+        records = storage._db_connection.execute('SELECT id, name FROM payees ORDER BY id').fetchall()
+        self.assertEqual(records, [(existing.id, 'existing'), (payees['new 1'].id, 'new 1'), (payees['new 2'].id, 'new 2')])
+        self.assertIs(storage.get_payee(name='new 2'), payees['new 2'])
+
     def test_save_txn(self):
         storage = bb.SQLiteStorage(':memory:')
         checking = get_test_account()
@@ -930,6 +1359,93 @@ class TestSQLiteStorage(unittest.TestCase):
         self.assertEqual(txn_split_records, [(1, 1, 1, '-101/1', '-101/1', 'C', None),
                                              (2, 1, 2, '101/1', '101/1', None, None)])
 
+    def test_save_txns(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        savings = get_test_account(name='Savings')
+        storage.save_account(checking)
+        storage.save_account(savings)
+        existing_payee = bb.Payee('existing')
+        storage.save_payee(existing_payee)
+        existing_txn = bb.Transaction(txn_date=date(2018, 1, 1), splits={checking: {'amount': 1}, savings: {'amount': -1}})
+        storage.save_txn(existing_txn)
+        txns = [
+                bb.Transaction(txn_date=date(2018, 1, 2), payee='new payee', splits={checking: {'amount': '-1.23', 'status': 'C'}, savings: {'amount': '1.23'}}),
+                bb.Transaction(txn_date=date(2018, 1, 3), payee=bb.Payee('existing'), splits={checking: {'amount': 5}, savings: {'amount': -5}}),
+                bb.Transaction(txn_date=date(2018, 1, 4), payee='new payee', description='desc', splits={checking: {'amount': 6}, savings: {'amount': -6}}),
+                bb.Transaction(id_=existing_txn.id, txn_date=date(2018, 1, 1), splits={checking: {'amount': 2}, savings: {'amount': -2}}),
+                bb.Transaction(txn_date=date(2018, 1, 5), splits={checking: {'amount': 7}, savings: {'amount': -7}}),
+            ]
+        queries = []
+        storage._db_connection.set_trace_callback(queries.append)
+        storage.save_txns(iter(txns), batch_size=2)
+        storage._db_connection.set_trace_callback(None)
+        self.assertEqual(len([q for q in queries if q == 'COMMIT']), 3)
+        self.assertEqual([t.id for t in txns], [2, 3, 4, 1, 5])
+        self.assertEqual(txns[1].payee.id, existing_payee.id)
+        self.assertEqual(txns[0].payee.id, txns[2].payee.id)
+        self.assertEqual(storage.get_txn(2).splits[checking], {'amount': Fraction('-1.23'), 'status': 'C'})
+        self.assertEqual(storage.get_txn(2).payee.name, 'new payee')
+        self.assertEqual(storage.get_txn(4).description, 'desc')
+        self.assertEqual(storage.get_txn(1).splits[checking], {'amount': 2})
+        ledger = storage.get_ledger(checking)
+        self.assertEqual(len(ledger.get_sorted_txns()), 5)
+
+    def test_save_txns_error_rolls_back_batch(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        savings = get_test_account(name='Savings')
+        storage.save_account(checking)
+        storage.save_account(savings)
+        txns = [
+                bb.Transaction(txn_date=date(2018, 1, 2), payee='new payee', splits={checking: {'amount': 1}, savings: {'amount': -1}}),
+                bb.Transaction(id_=10, txn_date=date(2018, 1, 3), splits={checking: {'amount': 5}, savings: {'amount': -5}}),
+            ]
+        with self.assertRaises(Exception) as cm:
+            storage.save_txns(txns)
+        self.assertEqual(str(cm.exception), 'no txn with id 10 to update')
+        self.assertEqual(txns[0].id, None)
+        self.assertEqual(txns[0].payee.id, None)
+        self.assertEqual(storage._db_connection.execute('SELECT * FROM transactions').fetchall(), [])
+        self.assertEqual(storage._db_connection.execute('SELECT * FROM payees').fetchall(), [])
+        self.assertEqual(storage.get_payee(name='new payee'), None)
+
+    def test_save_txns_matches_save_txn(self):
+        #bulk saves skip the insert triggers, so make sure they end up with the same checkpoints & search index
+        def get_txns(checking, savings):
+            return [
+                    bb.Transaction(txn_date=date(2018, 3, 2), payee='grocery store', splits={checking: {'amount': '-1.23', 'status': 'C'}, savings: {'amount': '1.23'}}),
+                    bb.Transaction(txn_date=date(2018, 1, 3), description='restaurant', splits={checking: {'amount': 5}, savings: {'amount': -5, 'status': 'R'}}),
+                    bb.Transaction(txn_date=date(2018, 3, 4), payee='grocery store', splits={checking: {'amount': 6}, savings: {'amount': -6}}),
+                ]
+        storages = []
+        for bulk in [False, True]:
+            storage = bb.SQLiteStorage(':memory:')
+            checking = get_test_account()
+            savings = get_test_account(name='Savings')
+            storage.save_account(checking)
+            storage.save_account(savings)
+            storage.save_txn(bb.Transaction(txn_date=date(2018, 2, 1), splits={checking: {'amount': 100, 'status': 'C'}, savings: {'amount': -100}}))
+            if bulk:
+                storage.save_txns(get_txns(checking, savings))
+            else:
+                for txn in get_txns(checking, savings):
+                    storage.save_txn(txn)
+            storages.append(storage)
+        per_txn_storage, bulk_storage = storages
+        for sql in ['SELECT * FROM balance_checkpoints ORDER BY account_id, month', 'SELECT * FROM misc']:
+            self.assertEqual(bulk_storage._db_connection.execute(sql).fetchall(), per_txn_storage._db_connection.execute(sql).fetchall())
+        for search_term in ['grocery', 'restaurant']:
+            self.assertEqual(sorted(bulk_storage.search_txns(search_term)), sorted(per_txn_storage.search_txns(search_term)))
+        self.assertEqual(sorted(bulk_storage.search_txns('grocery')), [2, 4])
+        self.assertEqual(bulk_storage.get_account_balances(), per_txn_storage.get_account_balances())
+        #the per-split triggers still work after a bulk save
+        checking = bulk_storage.get_account(name='Checking')
+        savings = bulk_storage.get_account(name='Savings')
+        bulk_storage.save_txn(bb.Transaction(txn_date=date(2018, 1, 1), splits={checking: {'amount': 10}, savings: {'amount': -10}}))
+        self.assertEqual(bulk_storage._db_connection.execute('SELECT * FROM balance_checkpoints WHERE account_id = ? ORDER BY month', (checking.id,)).fetchall(),
+                [(checking.id, '2018-01', 1500, 0), (checking.id, '2018-02', 11500, 10000), (checking.id, '2018-03', 11977, 9877)])
+
     def test_save_txn_payee_string(self):
         storage = bb.SQLiteStorage(':memory:')
         checking = get_test_account()
@@ -1002,8 +1518,8 @@ class TestSQLiteStorage(unittest.TestCase):
                 (1, 1, None, date.today().strftime('%Y-%m-%d'), None, None, None))
         c.execute('SELECT * FROM transaction_splits')
         txn_split_records = c.fetchall()
-        self.assertEqual(txn_split_records, [(1, 1, 1, '101/1', '101/1', None, None, None),
-                                             (2, 1, 2, '-101/1', '-101/1', None, None, None)])
+        self.assertEqual(txn_split_records, [(1, 1, 1, '101/1', '101/1', None, None, None, 10100),
+                                             (2, 1, 2, '-101/1', '-101/1', None, None, None, -10100)])
 
     def test_round_trip(self):
         storage = bb.SQLiteStorage(':memory:')
@@ -1031,15 +1547,15 @@ class TestSQLiteStorage(unittest.TestCase):
                 [(txn_id, 1, '123', date.today().strftime('%Y-%m-%d'), 1, None, None)])
         splits_db_info = c.execute('SELECT * FROM transaction_splits').fetchall()
         self.assertEqual(splits_db_info,
-                [(1, txn_id, checking.id, '-101/1', '-101/1', 'C', None, None),
-                 (2, txn_id, savings.id, '101/1', '101/1', None, None, None)])
+                [(1, txn_id, checking.id, '-101/1', '-101/1', 'C', None, None, -10100),
+                 (2, txn_id, savings.id, '101/1', '101/1', None, None, None, 10100)])
         #update a db field that the Transaction object isn't aware of
         c.execute('UPDATE transaction_splits SET action = ? WHERE account_id = ?', ('buy', checking.id))
         storage._db_connection.commit()
         splits_db_info = c.execute('SELECT * FROM transaction_splits').fetchall()
         self.assertEqual(splits_db_info,
-                [(1, txn_id, checking.id, '-101/1', '-101/1', 'C', None, 'buy'),
-                 (2, txn_id, savings.id, '101/1', '101/1', None, None, None)])
+                [(1, txn_id, checking.id, '-101/1', '-101/1', 'C', None, 'buy', -10100),
+                 (2, txn_id, savings.id, '101/1', '101/1', None, None, None, 10100)])
         #read it back from the db
         txn_from_db = storage.get_txn(txn_id)
         self.assertEqual(txn_from_db.txn_type, '123')
@@ -1063,8 +1579,8 @@ class TestSQLiteStorage(unittest.TestCase):
                 [(txn_id, 1, None, date.today().strftime('%Y-%m-%d'), None, None, None)])
         splits_db_info = c.execute('SELECT * FROM transaction_splits').fetchall()
         self.assertEqual(splits_db_info,
-                [(1, txn_id, checking.id, '-101/1', '-101/1', None, None, 'buy'),
-                 (2, txn_id, another_acct.id, '101/1', '101/1', None, None, None)])
+                [(1, txn_id, checking.id, '-101/1', '-101/1', None, None, 'buy', -10100),
+                 (2, txn_id, another_acct.id, '101/1', '101/1', None, None, None, 10100)])
 
     def test_get_ledger(self):
         storage = bb.SQLiteStorage(':memory:')
@@ -1107,7 +1623,7 @@ class TestSQLiteStorage(unittest.TestCase):
             )
         storage.save_scheduled_transaction(st2)
         ledger = storage.get_ledger(account=checking)
-        txns = ledger.get_sorted_txns_with_balance()
+        txns = ledger.get_sorted_txns()
         self.assertEqual(len(txns), 2)
         self.assertEqual(txns[0].splits[checking]['amount'], 101)
         self.assertEqual(txns[1].splits[checking]['amount'], Fraction('46.23'))
@@ -1117,6 +1633,128 @@ class TestSQLiteStorage(unittest.TestCase):
         ledger_by_id = storage.get_ledger(account=checking.id)
         self.assertEqual(len(txns), 2)
 
+    def test_get_ledger_fixed_number_of_queries(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        savings = get_test_account(name='Savings', type_=bb.AccountType.EXPENSE)
+        storage.save_account(savings)
+        restaurants = get_test_account(name='Restaurants', type_=bb.AccountType.EXPENSE)
+        restaurants.parent = savings
+        storage.save_account(restaurants)
+        payee = bb.Payee('Subway')
+        storage.save_payee(payee)
+        queries = []
+        def _count_queries(num_txns):
+            for i in range(num_txns):
+                storage.save_txn(bb.Transaction(txn_date=date(2017, 1, 1) + timedelta(days=i), payee=payee,
+                    splits={checking: {'amount': '-1.5', 'status': 'C'}, restaurants: {'amount': '1.5'}}))
+            storage.get_ledger(account=checking)
+            del queries[:]
+            storage._db_connection.set_trace_callback(queries.append)
+            ledger = storage.get_ledger(account=checking)
+            storage._db_connection.set_trace_callback(None)
+            return ledger, len(queries)
+        ledger, num_queries = _count_queries(2)
+        ledger, num_queries_with_more_txns = _count_queries(20)
+        self.assertEqual(num_queries, num_queries_with_more_txns)
+        txns = ledger.get_sorted_txns()
+        self.assertEqual(len(txns), 22)
+        self.assertEqual(txns[0].splits[checking], {'amount': Fraction('-1.5'), 'status': 'C'})
+        self.assertEqual(txns[0].payee.name, 'Subway')
+        restaurants_from_txn = [a for a in txns[0].splits.keys() if a != checking][0]
+        self.assertEqual(restaurants_from_txn.parent, savings)
+
+    def test_get_ledger_date_range(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        savings = get_test_account(name='Savings')
+        storage.save_account(savings)
+        storage.save_txn(bb.Transaction(txn_date=date(2017, 1, 5), splits={checking: {'amount': 100, 'status': 'C'}, savings: {'amount': -100}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2017, 3, 1), splits={checking: {'amount': -10}, savings: {'amount': 10}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2017, 3, 10), splits={checking: {'amount': '-2.5', 'status': 'C'}, savings: {'amount': '2.5'}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2017, 3, 20), splits={checking: {'amount': -20}, savings: {'amount': 20}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2017, 4, 1), splits={checking: {'amount': 50}, savings: {'amount': -50}}))
+        ledger = storage.get_ledger(checking, start='2017-03-10', end='2017-03-31')
+        self.assertEqual(ledger.opening_balance, 90)
+        self.assertEqual(ledger.opening_cleared, 100)
+        self.assertEqual([t.txn_date for t in ledger.get_sorted_txns()], [date(2017, 3, 10), date(2017, 3, 20)])
+        self.assertEqual(list(ledger.get_balances()), [Fraction('87.5'), Fraction('67.5')])
+        self.assertEqual(ledger.get_balance_at(1), Fraction('67.5'))
+        self.assertEqual(ledger.get_current_balances_for_display(), bb.LedgerBalances(current='67.5', current_cleared='97.5'))
+        #txns saved outside the window only change the opening balances
+        ledger.add_transaction(bb.Transaction(id_=10, txn_date=date(2017, 2, 1), splits={checking: {'amount': 5}, savings: {'amount': -5}}))
+        ledger.add_transaction(bb.Transaction(id_=11, txn_date=date(2017, 5, 1), splits={checking: {'amount': 5}, savings: {'amount': -5}}))
+        self.assertEqual(len(ledger.get_sorted_txns()), 2)
+        self.assertEqual(list(ledger.get_balances()), [Fraction('92.5'), Fraction('72.5')])
+        ledger = storage.get_ledger(checking, start='2017-03-10')
+        self.assertEqual(ledger.get_current_balances_for_display(), storage.get_current_balances(checking))
+
+    def test_get_ledger_columns(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        savings = get_test_account(name='Savings')
+        storage.save_account(savings)
+        payee = bb.Payee('Grocery Store')
+        storage.save_payee(payee)
+        storage.save_txn(bb.Transaction(txn_date=date(2017, 1, 5), splits={checking: {'amount': 100, 'status': 'C'}, savings: {'amount': -100}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2017, 3, 20), splits={checking: {'amount': -20}, savings: {'amount': 20}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2017, 3, 1), payee=payee, splits={checking: {'amount': '-10.5', 'status': 'R'}, savings: {'amount': '10.5'}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2017, 4, 1), splits={savings: {'amount': 50}, checking: {'amount': -50}}))
+        queries = []
+        storage._db_connection.set_trace_callback(queries.append)
+        ledger = storage.get_ledger_columns(checking)
+        storage._db_connection.set_trace_callback(None)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(len(ledger), 4)
+        self.assertEqual(list(ledger.txn_ids), [1, 3, 2, 4])
+        self.assertEqual(list(ledger.amounts), [10000, -1050, -2000, -5000])
+        self.assertEqual(list(ledger.statuses), [1, 2, 0, 0])
+        self.assertEqual(list(ledger.payee_ids), [0, payee.id, 0, 0])
+        self.assertEqual(ledger.get_date(1), date(2017, 3, 1))
+        self.assertEqual(ledger.get_position_for_date('2017-03-02'), 2)
+        self.assertEqual(list(ledger.get_balances()), [100, Fraction('89.5'), Fraction('69.5'), Fraction('19.5')])
+        self.assertEqual(list(ledger.get_cleared_balances()), [100, Fraction('89.5'), Fraction('89.5'), Fraction('89.5')])
+        txns = ledger.get_txns(1, 3)
+        self.assertEqual([t.id for t in txns], [3, 2])
+        self.assertEqual(txns[0].payee, payee)
+        self.assertEqual(txns[0].splits[checking], {'amount': Fraction('-10.5'), 'status': 'R'})
+        #a date range carries the earlier balances forward
+        ledger = storage.get_ledger_columns(checking, start='2017-03-02', end='2017-03-31')
+        self.assertEqual(list(ledger.txn_ids), [2])
+        self.assertEqual(list(ledger.get_balances()), [Fraction('69.5')])
+        self.assertEqual(list(ledger.get_cleared_balances()), [Fraction('89.5')])
+
+    def test_load_txns_without_revalidating(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        savings = get_test_account(name='Savings')
+        storage.save_account(savings)
+        payee = bb.Payee('Grocery Store')
+        storage.save_payee(payee)
+        storage.save_txn(bb.Transaction(txn_date=date(2017, 1, 5), payee=payee, description='food',
+            splits={checking: {'amount': '-10.5', 'status': 'C'}, savings: {'amount': '10.5'}}))
+        with patch('bricbooks.check_txn_splits') as check_splits:
+            with patch('bricbooks.get_date') as get_date:
+                txn = storage.get_txn(1)
+        check_splits.assert_not_called()
+        get_date.assert_not_called()
+        self.assertEqual(txn.txn_date, date(2017, 1, 5))
+        self.assertEqual(txn.splits, {checking: {'amount': Fraction('-10.5'), 'status': 'C'}, savings: {'amount': Fraction('10.5')}})
+        self.assertIsInstance(txn.splits[checking]['amount'], bb.Money)
+        self.assertEqual(txn.payee, payee)
+        self.assertEqual(txn.description, 'food')
+        #bad data in the DB is only caught in validation mode
+        storage._db_connection.execute('UPDATE transaction_splits SET value_cents = 500 WHERE account_id = ?', (savings.id,))
+        self.assertEqual(storage.get_txn(1).splits[savings], {'amount': 5})
+        storage._validate_loaded_txns = True
+        with self.assertRaises(bb.InvalidTransactionError) as cm:
+            storage.get_txn(1)
+        self.assertTrue("splits don't balance" in str(cm.exception))
+
     def test_delete_txn_from_db(self):
         storage = bb.SQLiteStorage(':memory:')
         checking = get_test_account()
@@ -1143,6 +1781,358 @@ class TestSQLiteStorage(unittest.TestCase):
         self.assertEqual(len(txn_splits_records), 2)
         self.assertEqual([r[0] for r in txn_splits_records], [txn2.id, txn2.id])
 
+    def test_iter_txns(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        savings = get_test_account(name='Savings')
+        storage.save_account(savings)
+        housing = get_test_account(type_=bb.AccountType.EXPENSE, name='Housing')
+        storage.save_account(housing)
+        payee = bb.Payee('payee')
+        txn1 = bb.Transaction(txn_date=date(2018, 1, 3), splits={checking: {'amount': -10, 'status': 'C'}, housing: {'amount': 10}}, payee=payee)
+        txn2 = bb.Transaction(txn_date=date(2018, 1, 1), splits={checking: {'amount': -5}, savings: {'amount': 5}})
+        txn3 = bb.Transaction(txn_date=date(2018, 2, 1), splits={savings: {'amount': '-1.5'}, housing: {'amount': '1.5'}}, description='desc')
+        storage.save_txns([txn1, txn2, txn3])
+        txns = list(storage.iter_txns(batch_size=1))
+        self.assertEqual([t.id for t in txns], [txn2.id, txn1.id, txn3.id])
+        self.assertEqual(txns[1].splits, {checking: {'amount': -10, 'status': 'C'}, housing: {'amount': 10}})
+        self.assertEqual(txns[1].payee, payee)
+        self.assertEqual(txns[2].splits[savings], {'amount': Fraction('-1.5')})
+        self.assertEqual(txns[2].description, 'desc')
+        self.assertEqual([t.id for t in storage.iter_txns(start=date(2018, 1, 2))], [txn1.id, txn3.id])
+        self.assertEqual([t.id for t in storage.iter_txns(start='2018-01-01', end='2018-01-03')], [txn2.id, txn1.id])
+        #txns for the filtered accounts still have all their splits
+        txns = list(storage.iter_txns(accounts=[savings]))
+        self.assertEqual([t.id for t in txns], [txn2.id, txn3.id])
+        self.assertEqual(txns[0].splits, {checking: {'amount': -5}, savings: {'amount': 5}})
+        self.assertEqual(list(storage.iter_txns(end=date(2017, 12, 31))), [])
+
+    def test_search_txns(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        savings = get_test_account(name='Savings')
+        storage.save_account(savings)
+        housing = get_test_account(type_=bb.AccountType.EXPENSE, name='Housing')
+        storage.save_account(housing)
+        txn1 = bb.Transaction(txn_date=date(2018, 1, 1), splits={checking: {'amount': -10}, housing: {'amount': 10}}, payee=bb.Payee('Some Restaurant'))
+        txn2 = bb.Transaction(txn_date=date(2018, 1, 2), splits={checking: {'amount': -5}, savings: {'amount': 5}}, description='restaurant savings')
+        txn3 = bb.Transaction(txn_date=date(2018, 1, 3), splits={savings: {'amount': -1}, housing: {'amount': 1}}, description='rent')
+        storage.save_txn(txn1)
+        storage.save_txns([txn2, txn3])
+        self.assertEqual(sorted(storage.search_txns('restaurant')), [txn1.id, txn2.id])
+        self.assertEqual(storage.search_txns('REST'), storage.search_txns('rest'))
+        self.assertEqual(sorted(storage.search_txns('re')), [txn1.id, txn2.id, txn3.id])
+        self.assertEqual(storage.search_txns('restaurant', account=housing), [txn1.id])
+        self.assertEqual(storage.search_txns('restaurant sav'), [txn2.id])
+        self.assertEqual(storage.search_txns('"restaurant'), storage.search_txns('restaurant'))
+        self.assertEqual(storage.search_txns('  '), [])
+        #index is kept up to date when txns, payees & split descriptions change
+        txn3.description = 'restaurant tip'
+        storage.save_txn(txn3)
+        self.assertEqual(storage.search_txns('rent'), [])
+        self.assertEqual(storage.search_txns('tip'), [txn3.id])
+        payee = storage.get_payee(name='Some Restaurant')
+        payee.name = 'Diner'
+        storage.save_payee(payee)
+        self.assertEqual(storage.search_txns('diner'), [txn1.id])
+        storage._db_connection.execute('UPDATE transaction_splits SET description = ? WHERE txn_id = ? AND account_id = ?', ('security deposit', txn2.id, savings.id))
+        self.assertEqual(storage.search_txns('deposit'), [txn2.id])
+        storage.delete_txn(txn2.id)
+        self.assertEqual(storage.search_txns('deposit'), [])
+        self.assertEqual(storage.search_txns('restaurant'), [txn3.id])
+
+    def test_search_txns_without_index(self):
+        #act like this SQLite doesn't have FTS5
+        with patch.object(bb.SQLiteStorage, '_migration_add_search_index', lambda storage: None):
+            storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        savings = get_test_account(name='Savings')
+        storage.save_account(savings)
+        txn1 = bb.Transaction(txn_date=date(2018, 1, 1), splits={checking: {'amount': -10}, savings: {'amount': 10}}, payee=bb.Payee('Some Restaurant'))
+        txn2 = bb.Transaction(txn_date=date(2018, 1, 2), splits={checking: {'amount': -5}, savings: {'amount': 5}}, description='restaurant savings')
+        storage.save_txns([txn1, txn2])
+        self.assertFalse(storage._has_search_index())
+        tables = storage._db_connection.execute('SELECT name from sqlite_master WHERE type="table"').fetchall()
+        self.assertEqual(tables, get_expected_tables(storage))
+        self.assertEqual(storage.search_txns('restaurant'), [txn2.id, txn1.id])
+        self.assertEqual(storage.search_txns('restaurant sav'), [txn2.id])
+        self.assertEqual(storage.search_txns('restaurant', account=checking), [txn2.id, txn1.id])
+        self.assertEqual([t.id for t in storage.query_txns(bb.TxnQuery(text='restaurant sav'))], [txn2.id])
+
+    def test_search_txns_same_results_without_index(self):
+        with patch.object(bb.SQLiteStorage, '_migration_add_search_index', lambda storage: None):
+            storage_without_index = bb.SQLiteStorage(':memory:')
+        storages = [bb.SQLiteStorage(':memory:'), storage_without_index]
+        if not storages[0]._has_search_index():
+            self.skipTest('this SQLite does not have FTS5')
+        for storage in storages:
+            checking = get_test_account()
+            storage.save_account(checking)
+            savings = get_test_account(name='Savings')
+            storage.save_account(savings)
+            storage.save_txns([
+                bb.Transaction(txn_date=date(2018, 1, 1), splits={checking: {'amount': -10}, savings: {'amount': 10}}, payee=bb.Payee("Bob's Diner")),
+                bb.Transaction(txn_date=date(2018, 1, 2), splits={checking: {'amount': -5}, savings: {'amount': 5}}, description='restaurant-savings'),
+                bb.Transaction(txn_date=date(2018, 1, 3), splits={checking: {'amount': -1}, savings: {'amount': 1}}, description='Car Insurance'),
+            ])
+        #words match from their start, & punctuation separates words
+        for term in ['restaurant', 'staurant', 'sav', 'diner', 'iner', 'bob', 's', '"car', 'car ins', 'car_ins', 'INS', '']:
+            self.assertEqual(sorted(storages[0].search_txns(term)), sorted(storages[1].search_txns(term)), term)
+
+    def test_search_index_check_is_cached(self):
+        storage = bb.SQLiteStorage(':memory:')
+        queries = []
+        storage._db_connection.set_trace_callback(queries.append)
+        storage.search_txns('restaurant')
+        storage._db_connection.set_trace_callback(None)
+        self.assertEqual([q for q in queries if 'sqlite_master' in q], [])
+
+    def test_query_txns(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        card1 = get_test_account(type_=bb.AccountType.LIABILITY, name='Card 1')
+        storage.save_account(card1)
+        card2 = get_test_account(type_=bb.AccountType.LIABILITY, name='Card 2')
+        storage.save_account(card2)
+        housing = get_test_account(type_=bb.AccountType.EXPENSE, name='Housing')
+        storage.save_account(housing)
+        payee = bb.Payee('Hardware Store')
+        txn1 = bb.Transaction(txn_date=date(2018, 7, 5), splits={card1: {'amount': -600}, housing: {'amount': 600}}, payee=payee)
+        txn2 = bb.Transaction(txn_date=date(2018, 8, 5), splits={card2: {'amount': -700, 'status': 'C'}, housing: {'amount': 700}})
+        txn3 = bb.Transaction(txn_date=date(2018, 9, 5), splits={card2: {'amount': -50}, housing: {'amount': 50}}, description='paint')
+        txn4 = bb.Transaction(txn_date=date(2018, 10, 5), splits={card1: {'amount': -800}, housing: {'amount': 800}})
+        txn5 = bb.Transaction(txn_date=date(2018, 8, 1), splits={checking: {'amount': -900, 'status': 'R'}, card1: {'amount': 900}})
+        storage.save_txns([txn1, txn2, txn3, txn4, txn5])
+        #uncleared card txns over $500 in Q3
+        query = bb.TxnQuery(start_date='2018-07-01', end_date='2018-09-30', min_amount='500', statuses=[None], accounts=[card1, card2])
+        #first call loads the accounts
+        storage.query_txns(query)
+        queries = []
+        storage._db_connection.set_trace_callback(queries.append)
+        txns = storage.query_txns(query)
+        storage._db_connection.set_trace_callback(None)
+        self.assertEqual([t.id for t in txns], [txn1.id, txn5.id])
+        self.assertEqual(txns[0].splits, {card1: {'amount': -600}, housing: {'amount': 600}})
+        self.assertEqual(len(queries), 2)
+        self.assertEqual([t.id for t in storage.query_txns(bb.TxnQuery(statuses=['c', 'R']))], [txn5.id, txn2.id])
+        self.assertEqual([t.id for t in storage.query_txns(bb.TxnQuery(accounts=[checking], statuses=[None]))], [])
+        self.assertEqual([t.id for t in storage.query_txns(bb.TxnQuery(max_amount='50.00'))], [txn3.id])
+        self.assertEqual([t.id for t in storage.query_txns(bb.TxnQuery(payee=payee))], [txn1.id])
+        self.assertEqual([t.id for t in storage.query_txns(bb.TxnQuery(text='paint', accounts=[housing]))], [txn3.id])
+        self.assertEqual(len(storage.query_txns(bb.TxnQuery())), 5)
+        with self.assertRaises(bb.InvalidTransactionError):
+            bb.TxnQuery(min_amount='1.001')
+        with self.assertRaises(bb.InvalidTransactionError):
+            bb.TxnQuery(statuses=['X'])
+
+    def test_get_txns_page(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        savings = get_test_account(name='Savings')
+        storage.save_account(savings)
+        #two txns on each date, so the page boundaries fall between txns with the same date
+        for i in range(10):
+            storage.save_txn(bb.Transaction(txn_date=date(2018, 1, i//2 + 1), splits={checking: {'amount': i+1}, savings: {'amount': -(i+1)}}))
+        other = get_test_account(name='Other')
+        storage.save_account(other)
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 1, 1), splits={savings: {'amount': 100}, other: {'amount': -100}}))
+        page = storage.get_txns_page(checking, page_size=4)
+        self.assertEqual([t.id for t in page.txns], [10, 9, 8, 7])
+        self.assertEqual(page.balances, [55, 45, 36, 28])
+        self.assertEqual(page.newer_cursor, None)
+        self.assertEqual(page.older_cursor, ('2018-01-04', 7))
+        page = storage.get_txns_page(checking, cursor=page.older_cursor, page_size=4)
+        self.assertEqual([t.id for t in page.txns], [6, 5, 4, 3])
+        self.assertEqual(page.balances, [21, 15, 10, 6])
+        self.assertEqual(page.newer_cursor, ('2018-01-03', 6))
+        page = storage.get_txns_page(checking, cursor=page.older_cursor, page_size=4)
+        self.assertEqual([t.id for t in page.txns], [2, 1])
+        self.assertEqual(page.balances, [3, 1])
+        self.assertEqual(page.older_cursor, None)
+        page = storage.get_txns_page(checking, cursor=page.newer_cursor, direction=bb.SQLiteStorage.PAGE_NEWER, page_size=4)
+        self.assertEqual([t.id for t in page.txns], [6, 5, 4, 3])
+        self.assertEqual(page.balances, [21, 15, 10, 6])
+        page = storage.get_txns_page(checking, cursor=page.newer_cursor, direction=bb.SQLiteStorage.PAGE_NEWER, page_size=4)
+        self.assertEqual([t.id for t in page.txns], [10, 9, 8, 7])
+        self.assertEqual(page.newer_cursor, None)
+        self.assertEqual(storage.get_txns_page(savings, page_size=1).balances, [45])
+        empty_account = get_test_account(name='Empty')
+        storage.save_account(empty_account)
+        self.assertEqual(storage.get_txns_page(empty_account), bb.TxnsPage(txns=[], balances=[], older_cursor=None, newer_cursor=None))
+
+    def test_account_balance(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        savings = get_test_account(name='Savings')
+        storage.save_account(savings)
+        def check_balances():
+            #compare with adding up all the splits
+            for account in [checking, savings]:
+                for as_of in [date(2018, 12, 31), date(2019, 1, 15), date(2019, 1, 31), date(2019, 3, 1), date(2019, 6, 30), date(2020, 1, 1)]:
+                    txns = storage._load_txns('SELECT txn_id FROM transaction_splits WHERE account_id = ?', (account.id,))
+                    splits = [t.splits[account] for t in txns if t.txn_date <= as_of]
+                    self.assertEqual(storage.account_balance(account, as_of), sum([s['amount'] for s in splits]))
+                    self.assertEqual(storage.account_balance(account, as_of, cleared_only=True), sum([s['amount'] for s in splits if s.get('status')]))
+        txn1 = bb.Transaction(txn_date=date(2019, 1, 10), splits={checking: {'amount': '100.5', 'status': 'C'}, savings: {'amount': '-100.5'}})
+        txn2 = bb.Transaction(txn_date=date(2019, 1, 20), splits={checking: {'amount': -20}, savings: {'amount': 20}})
+        txn3 = bb.Transaction(txn_date=date(2019, 3, 1), splits={checking: {'amount': -5, 'status': 'R'}, savings: {'amount': 5}})
+        storage.save_txn(txn1)
+        storage.save_txns([txn2, txn3])
+        check_balances()
+        self.assertEqual(storage.account_balance(checking, '2019-06-30'), Fraction('75.5'))
+        self.assertEqual(storage.account_balance(checking.id, date(2019, 1, 15)), Fraction('100.5'))
+        self.assertEqual(storage.account_balance(checking), Fraction('75.5'))
+        #move a txn to an earlier month, with a new amount & status
+        txn3 = bb.Transaction(id_=txn3.id, txn_date=date(2018, 12, 1), splits={checking: {'amount': -7}, savings: {'amount': 7, 'status': 'C'}})
+        storage.save_txn(txn3)
+        check_balances()
+        #and to a later month
+        txn1.txn_date = date(2019, 6, 1)
+        storage.save_txn(txn1)
+        check_balances()
+        storage.delete_txn(txn2.id)
+        check_balances()
+        self.assertEqual(storage.account_balance(checking, date(2019, 6, 30)), Fraction('93.5'))
+        #a failed save doesn't change the checkpoints
+        with self.assertRaises(Exception):
+            storage.save_txn(bb.Transaction(id_=100, txn_date=date(2019, 1, 1), splits={checking: {'amount': 1}, savings: {'amount': -1}}))
+        check_balances()
+
+    def test_get_account_balances(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        savings = get_test_account(name='Savings')
+        storage.save_account(savings)
+        housing = get_test_account(type_=bb.AccountType.EXPENSE, name='Housing')
+        storage.save_account(housing)
+        unused = get_test_account(name='Unused')
+        storage.save_account(unused)
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 1, 1), splits={checking: {'amount': 100, 'status': 'C'}, savings: {'amount': -100}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 2, 10), splits={checking: {'amount': '-12.5', 'status': 'R'}, housing: {'amount': '12.5'}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 2, 20), splits={checking: {'amount': -5}, housing: {'amount': 5}}))
+        #first call loads the accounts
+        storage.get_account_balances()
+        queries = []
+        storage._db_connection.set_trace_callback(queries.append)
+        balances = storage.get_account_balances(as_of=date(2018, 2, 15))
+        storage._db_connection.set_trace_callback(None)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(balances, {
+            checking: bb.LedgerBalances(current='87.5', current_cleared='87.5'),
+            savings: bb.LedgerBalances(current='-100', current_cleared='0'),
+            housing: bb.LedgerBalances(current='12.5', current_cleared='0'),
+            unused: bb.LedgerBalances(current='0', current_cleared='0'),
+        })
+        balances = storage.get_account_balances()
+        self.assertEqual(balances[checking], storage.get_current_balances(checking))
+        self.assertEqual(balances[housing], bb.LedgerBalances(current='17.5', current_cleared='0'))
+
+    def test_get_rollup_totals(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        transportation = get_test_account(type_=bb.AccountType.EXPENSE, name='Transportation')
+        storage.save_account(transportation)
+        car = bb.Account(type_=bb.AccountType.EXPENSE, name='Car', parent=transportation)
+        storage.save_account(car)
+        gas = bb.Account(type_=bb.AccountType.EXPENSE, name='Gas Stations', parent=car)
+        storage.save_account(gas)
+        insurance = bb.Account(type_=bb.AccountType.EXPENSE, name='Car Insurance', parent=car)
+        storage.save_account(insurance)
+        food = get_test_account(type_=bb.AccountType.EXPENSE, name='Food')
+        storage.save_account(food)
+        self.assertEqual(storage._db_connection.execute('SELECT ancestor_id, depth FROM account_ancestors WHERE account_id = ? ORDER BY depth', (gas.id,)).fetchall(),
+                [(gas.id, 0), (car.id, 1), (transportation.id, 2)])
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 1, 5), splits={checking: {'amount': -30}, gas: {'amount': 30}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 2, 5), splits={checking: {'amount': -100}, insurance: {'amount': 100}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 2, 10), splits={checking: {'amount': '-7.5'}, transportation: {'amount': '7.5'}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 2, 12), splits={checking: {'amount': -20}, food: {'amount': 20}}))
+        #first call loads the accounts
+        storage.get_rollup_totals()
+        queries = []
+        storage._db_connection.set_trace_callback(queries.append)
+        totals = storage.get_rollup_totals()
+        storage._db_connection.set_trace_callback(None)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(totals[transportation], Fraction(275, 2))
+        self.assertEqual(totals[car], 130)
+        self.assertEqual(totals[gas], 30)
+        self.assertEqual(totals[food], 20)
+        self.assertEqual(totals[checking], Fraction(-315, 2))
+        totals = storage.get_rollup_totals(start_date=date(2018, 2, 1), end_date=date(2018, 2, 10))
+        self.assertEqual(totals[transportation], Fraction(215, 2))
+        self.assertEqual(totals[gas], 0)
+        #move Car under Food - the whole subtree goes with it
+        car.parent = food
+        storage.save_account(car)
+        totals = storage.get_rollup_totals()
+        self.assertEqual(totals[transportation], Fraction(15, 2))
+        self.assertEqual(totals[food], 150)
+        balances = storage.get_account_balances(as_of=date(2018, 12, 31), rollup=True)
+        self.assertEqual(balances[food], bb.LedgerBalances(current='150', current_cleared='0'))
+        self.assertEqual(balances[gas], bb.LedgerBalances(current='30', current_cleared='0'))
+
+    def test_account_ancestors_cycle(self):
+        storage = bb.SQLiteStorage(':memory:')
+        food = get_test_account(type_=bb.AccountType.EXPENSE, name='Food')
+        storage.save_account(food)
+        restaurants = bb.Account(type_=bb.AccountType.EXPENSE, name='Restaurants', parent=food)
+        storage.save_account(restaurants)
+        food.parent = restaurants
+        with self.assertRaises(Exception) as cm:
+            storage.save_account(food)
+        self.assertEqual(str(cm.exception), f'account {food.id} is its own ancestor')
+        self.assertEqual(storage._db_connection.execute('SELECT parent_id FROM accounts WHERE id = ?', (food.id,)).fetchone(), (None,))
+
+    def test_get_budget_rollup(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        food = get_test_account(type_=bb.AccountType.EXPENSE, name='Food')
+        storage.save_account(food)
+        restaurants = bb.Account(type_=bb.AccountType.EXPENSE, name='Restaurants', parent=food)
+        storage.save_account(restaurants)
+        budget = bb.Budget(year=2018, account_budget_info={
+            food: {'amount': 100, 'notes': 'groceries'},
+            restaurants: {'amount': '20.5', 'carryover': '4.25'},
+        })
+        storage.save_budget(budget)
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 3, 1), splits={checking: {'amount': -10}, food: {'amount': 10}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 3, 2), splits={checking: {'amount': -25}, restaurants: {'amount': 25}}))
+        report = storage.get_budget(budget.id).get_report_display()
+        self.assertEqual(report['expense'][food]['spent'], '10')
+        self.assertEqual(report['expense'][food]['amount'], '100')
+        report = storage.get_budget(budget.id, rollup=True).get_report_display()
+        self.assertEqual(report['expense'][food]['spent'], '35')
+        self.assertEqual(report['expense'][food]['amount'], '120.5')
+        self.assertEqual(report['expense'][food]['carryover'], '4.25')
+        self.assertEqual(report['expense'][food]['notes'], 'groceries')
+        self.assertEqual(report['expense'][restaurants]['spent'], '25')
+        self.assertEqual(report['expense'][restaurants]['amount'], '20.5')
+        #save_budget stores '' for a missing carryover, which fsum skips
+        records = storage._db_connection.execute('SELECT fsum(amount), fsum(carryover) FROM budget_values').fetchall()
+        self.assertEqual(records, [('241/2', '17/4')])
+
+    def test_get_current_balances(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        savings = get_test_account(name='Savings')
+        storage.save_account(savings)
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 1, 1), splits={checking: {'amount': '10.5', 'status': 'C'}, savings: {'amount': '-10.5'}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 1, 2), splits={checking: {'amount': 5}, savings: {'amount': -5}}))
+        storage.save_txn(bb.Transaction(txn_date=date.today() + timedelta(days=1), splits={checking: {'amount': 20}, savings: {'amount': -20}}))
+        balances = storage.get_current_balances(checking)
+        self.assertEqual(balances, storage.get_ledger(checking).get_current_balances_for_display())
+        self.assertEqual(balances, bb.LedgerBalances(current='15.5', current_cleared='10.5'))
+
     def test_save_budget(self):
         storage = bb.SQLiteStorage(':memory:')
         housing = get_test_account(type_=bb.AccountType.EXPENSE, name='Housing')
@@ -1300,7 +2290,7 @@ class TestSQLiteStorage(unittest.TestCase):
 
         budget_data = budget.get_budget_data()
         self.assertEqual(budget_data[housing], {'amount': Fraction(135), 'notes': 'hello'})
-        self.assertEqual(type(budget_data[housing]['amount']), Fraction)
+        self.assertEqual(type(budget_data[housing]['amount']), bb.Money)
         self.assertEqual(budget_data[wages], {'amount': Fraction(70)})
 
         report_display = budget.get_report_display(current_date=date(2018, 6, 30))
@@ -1323,6 +2313,35 @@ class TestSQLiteStorage(unittest.TestCase):
         self.assertEqual(incomes[wages]['current_status'], '+93%')
 
 
+    def test_get_budget_fixed_number_of_queries(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        wages = get_test_account(name='Wages', type_=bb.AccountType.INCOME)
+        storage.save_account(wages)
+        expense_accounts = []
+        for i in range(20):
+            account = get_test_account(type_=bb.AccountType.EXPENSE, name=f'Expense {i}')
+            storage.save_account(account)
+            expense_accounts.append(account)
+            storage.save_txn(bb.Transaction(txn_date=date(2018, 1, i+2), splits={checking: {'amount': -(i+1)}, account: {'amount': i+1}}))
+        storage.save_txn(bb.Transaction(txn_date=date(2018, 1, 2), splits={checking: {'amount': 100}, wages: {'amount': -100}}))
+        budget = bb.Budget(year=2018, account_budget_info={expense_accounts[0]: {'amount': '5'}, wages: {'amount': '100'}})
+        storage.save_budget(budget)
+        #first call loads the accounts
+        storage.get_budget(budget.id)
+        queries = []
+        storage._db_connection.set_trace_callback(queries.append)
+        budget = storage.get_budget(budget.id)
+        storage._db_connection.set_trace_callback(None)
+        self.assertEqual(len(queries), 3)
+        report_display = budget.get_report_display(current_date=date(2018, 6, 30))
+        self.assertEqual(list(report_display['expense'].keys()), expense_accounts)
+        self.assertEqual(report_display['expense'][expense_accounts[0]]['spent'], '1')
+        self.assertEqual(report_display['expense'][expense_accounts[0]]['remaining'], '4')
+        self.assertEqual(report_display['expense'][expense_accounts[19]]['spent'], '20')
+        self.assertEqual(report_display['income'][wages]['income'], '100')
+
     def test_get_budgets(self):
         storage = bb.SQLiteStorage(':memory:')
         b = bb.Budget(year=2018)
@@ -1333,6 +2352,26 @@ class TestSQLiteStorage(unittest.TestCase):
         self.assertEqual(budgets[0].start_date, date(2019, 1, 1))
         self.assertEqual(budgets[1].start_date, date(2018, 1, 1))
 
+    def test_get_budget_summaries(self):
+        storage = bb.SQLiteStorage(':memory:')
+        housing = get_test_account(type_=bb.AccountType.EXPENSE, name='Housing')
+        storage.save_account(housing)
+        storage.save_budget(bb.Budget(year=2018, account_budget_info={housing: {'amount': '35'}}))
+        storage.save_budget(bb.Budget(year=2019, name='2019 budget'))
+        queries = []
+        storage._db_connection.set_trace_callback(queries.append)
+        budgets = storage.get_budget_summaries()
+        storage._db_connection.set_trace_callback(None)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([b.start_date for b in budgets], [date(2019, 1, 1), date(2018, 1, 1)])
+        self.assertEqual(budgets[0].name, '2019 budget')
+        self.assertEqual(budgets[1].end_date, date(2018, 12, 31))
+        self.assertEqual(budgets[1].get_budget_data(), {})
+        with self.assertRaises(bb.BudgetError):
+            budgets[1].get_report_display()
+        budget = storage.get_budget(budgets[0].id)
+        self.assertEqual(budget.name, '2019 budget')
+
     def test_get_budget_reports(self):
         storage = bb.SQLiteStorage(':memory:')
         housing = get_test_account(type_=bb.AccountType.EXPENSE, name='Housing')
@@ -1561,6 +2600,18 @@ class TestCLI(unittest.TestCase):
         output += ' 1    | ASSET       |         | Checking account with long nam |                               \n'
         self.assertEqual(self.memory_buffer.getvalue(), output)
 
+    def test_list_account_balances(self):
+        checking = get_test_account()
+        self.cli.storage.save_account(checking)
+        savings = get_test_account(name='Savings')
+        self.cli.storage.save_account(savings)
+        self.cli.storage.save_txn(bb.Transaction(txn_date=date(2017, 1, 1), splits={checking: {'amount': '10.5', 'status': 'C'}, savings: {'amount': '-10.5'}}))
+        self.cli._list_account_balances()
+        output = '%s\n' % bb.CLI.ACCOUNT_BALANCES_HEADER
+        output += ' 1    | ASSET       | Checking                       | 10.5           | 10.5           | 10.5\n'
+        output += ' 2    | ASSET       | Savings                        | -10.5          | 0              | -10.5\n'
+        self.assertEqual(self.memory_buffer.getvalue(), output)
+
     @patch('builtins.input')
     def test_create_account(self, input_mock):
         savings = get_test_account(name='Savings')
@@ -1631,9 +2682,50 @@ class TestCLI(unittest.TestCase):
         txn2 = bb.Transaction(splits={checking: {'amount': 5}, savings: {'amount': -5}}, txn_date=date(2017, 1, 2), payee='payee 2')
         self.cli.storage.save_txn(txn)
         self.cli.storage.save_txn(txn2)
+        txn3 = bb.Transaction(splits={checking: {'amount': 5}, savings: {'amount': -5}}, txn_date=date(2017, 1, 3))
+        self.cli.storage.save_txn(txn3)
+        input_mock.side_effect = ['1', 'o', 'n', 'q']
         self.cli._list_account_txns(num_txns_in_page=1)
         printed_output = self.memory_buffer.getvalue()
         self.assertTrue('(o) older' in printed_output)
+        self.assertTrue('(n) newer txns, (o) older txns' in printed_output)
+        self.assertEqual(printed_output.count(' 3    | 2017-01-03 '), 2)
+        self.assertEqual(printed_output.count(' 2    | 2017-01-02 '), 1)
+        self.assertEqual(printed_output.count(' 1    | 2017-01-01 '), 0)
+
+    @patch('builtins.input')
+    def test_query_txns(self, input_mock):
+        checking = get_test_account()
+        self.cli.storage.save_account(checking)
+        savings = get_test_account(name='Savings')
+        self.cli.storage.save_account(savings)
+        txn = bb.Transaction(splits={checking: {'amount': 5}, savings: {'amount': -5}}, txn_date=date(2017, 1, 1), payee='some payee', description='description')
+        txn2 = bb.Transaction(splits={checking: {'amount': 500, 'status': 'C'}, savings: {'amount': -500}}, txn_date=date(2017, 1, 2))
+        self.cli.storage.save_txn(txn)
+        self.cli.storage.save_txn(txn2)
+        input_mock.side_effect = ['2017-01-01', '', '', '10', 'u', '1', '', 'desc']
+        self.cli._query_txns()
+        printed_output = self.memory_buffer.getvalue()
+        self.assertTrue(' 1    | 2017-01-01 | some payee                     | description                    | Checking: 5; Savings: -5\n' in printed_output)
+        self.assertFalse(' 2    |' in printed_output)
+
+    @patch('builtins.input')
+    def test_query_txns_not_found(self, input_mock):
+        checking = get_test_account()
+        self.cli.storage.save_account(checking)
+        savings = get_test_account(name='Savings')
+        self.cli.storage.save_account(savings)
+        self.cli.storage.save_txn(bb.Transaction(splits={checking: {'amount': 5}, savings: {'amount': -5}}, txn_date=date(2017, 1, 1), payee='some payee'))
+        input_mock.side_effect = ['', '', '', '', '', '', '99']
+        self.cli._query_txns()
+        printed_output = self.memory_buffer.getvalue()
+        self.assertTrue('payee 99 not found\n' in printed_output)
+        self.assertFalse(' 1    |' in printed_output)
+        input_mock.side_effect = ['', '', '', '', '', '1, 99']
+        self.cli._query_txns()
+        printed_output = self.memory_buffer.getvalue()
+        self.assertTrue('account 99 not found\n' in printed_output)
+        self.assertFalse(' 1    |' in printed_output)
 
     def test_pager(self):
         self.assertEqual(bb.pager([1, 2, 3], num_txns_in_page=1, page=1), ([1], True))
@@ -1654,7 +2746,7 @@ class TestCLI(unittest.TestCase):
                 'type 1', str(payee.id), 'description']
         self.cli._create_txn()
         ledger = self.cli.storage.get_ledger(1)
-        txn = ledger.get_sorted_txns_with_balance()[0]
+        txn = ledger.get_sorted_txns()[0]
         self.assertEqual(txn.txn_date, date(2019, 2, 24))
         self.assertEqual(txn.splits[checking], {'amount': -15, 'status': 'C'})
         self.assertEqual(txn.splits[savings], {'amount': 15})
@@ -1675,7 +2767,7 @@ class TestCLI(unittest.TestCase):
                 'type 1', "'payee 1", 'description']
         self.cli._create_txn()
         ledger = self.cli.storage.get_ledger(1)
-        txn = ledger.get_sorted_txns_with_balance()[0]
+        txn = ledger.get_sorted_txns()[0]
         self.assertEqual(txn.payee.name, 'payee 1')
 
     @patch('builtins.input')
@@ -1692,7 +2784,7 @@ class TestCLI(unittest.TestCase):
                 'type 1', "'payee 1", 'description']
         self.cli._create_txn()
         ledger = self.cli.storage.get_ledger(1)
-        txn = ledger.get_sorted_txns_with_balance()[0]
+        txn = ledger.get_sorted_txns()[0]
         self.assertEqual(txn.payee.name, 'payee 1')
 
     @patch('builtins.input')
@@ -1799,7 +2891,7 @@ class TestCLI(unittest.TestCase):
         input_mock.side_effect = [str(st.id), '2019-01-02', '-101', '', '101', '', '', '', '', '', '', '', '']
         self.cli._list_scheduled_txns()
         ledger = self.cli.storage.get_ledger(checking.id)
-        txn = ledger.get_sorted_txns_with_balance()[0]
+        txn = ledger.get_sorted_txns()[0]
         self.assertEqual(txn.splits, valid_splits)
         self.assertEqual(txn.txn_date, date(2019, 1, 2))
         scheduled_txn = self.cli.storage.get_scheduled_transaction(st.id)
@@ -1827,7 +2919,7 @@ class TestCLI(unittest.TestCase):
         scheduled_txn = self.cli.storage.get_scheduled_transaction(st.id)
         self.assertEqual(scheduled_txn.next_due_date, date(2019, 1, 9))
         ledger = self.cli.storage.get_ledger(checking.id)
-        txns = ledger.get_sorted_txns_with_balance()
+        txns = ledger.get_sorted_txns()
         self.assertEqual(txns, [])
 
     @patch('builtins.input')
@@ -2014,6 +3106,21 @@ class TestQtGUI(unittest.TestCase):
         self.assertEqual(accounts[1].name, 'Savings')
         self.assertEqual(accounts[1].parent.name, 'Checking')
 
+    def test_account_balances(self):
+        storage = bb.SQLiteStorage(':memory:')
+        checking = get_test_account()
+        storage.save_account(checking)
+        savings = get_test_account(name='Savings')
+        storage.save_account(savings)
+        storage.save_txn(bb.Transaction(txn_date=date(2017, 1, 1), splits={checking: {'amount': 10, 'status': 'C'}, savings: {'amount': -10}}))
+        model_class = bb.get_accounts_model_class()
+        accounts_display = bb.AccountsDisplay(storage, reload_accounts=fake_method, model_class=model_class)
+        model = accounts_display._accounts_model
+        self.assertEqual(model.headerData(4, QtCore.Qt.Horizontal), 'Balance')
+        self.assertEqual(model.data(model.index(0, 4)), '10')
+        self.assertEqual(model.data(model.index(0, 5)), '10')
+        self.assertEqual(model.data(model.index(1, 5)), '0')
+
     @unittest.skip('either update for model-view change or remove')
     def test_account_edit(self):
         storage = bb.SQLiteStorage(':memory:')
@@ -2086,12 +3193,12 @@ class TestQtGUI(unittest.TestCase):
         QtTest.QTest.mouseClick(ledger_display.add_txn_display._widgets['save_btn'], QtCore.Qt.LeftButton)
         #make sure new txn was saved
         ledger = storage.get_ledger(account=checking)
-        txns = ledger.get_sorted_txns_with_balance()
+        txns = ledger.get_sorted_txns()
         self.assertEqual(len(txns), 3)
         self.assertEqual(txns[1].splits[checking], {'amount': -18})
         self.assertEqual(txns[1].payee.name, 'Burgers')
         #check new txn display
-        self.assertEqual(len(ledger_display.ledger.get_sorted_txns_with_balance()), 3)
+        self.assertEqual(len(ledger_display.ledger.get_sorted_txns()), 3)
         self.assertEqual(ledger_display.txns_display.txn_display_data[txns[1].id]['row'], 1)
 
     def test_ledger_add_not_first_account(self):
@@ -2112,7 +3219,7 @@ class TestQtGUI(unittest.TestCase):
         QtTest.QTest.mouseClick(ledger_display.add_txn_display._widgets['save_btn'], QtCore.Qt.LeftButton)
         #make sure new txn was saved correctly
         ledger = storage.get_ledger(account=savings)
-        txns = ledger.get_sorted_txns_with_balance()
+        txns = ledger.get_sorted_txns()
         self.assertEqual(len(txns), 1)
         self.assertEqual(txns[0].splits,
                 {savings: {'amount': -18}, housing: {'amount': 18}}
@@ -2137,7 +3244,7 @@ class TestQtGUI(unittest.TestCase):
         QtTest.QTest.mouseClick(ledger_display.add_txn_display._widgets['save_btn'], QtCore.Qt.LeftButton)
         #make sure new txn was saved
         ledger = storage.get_ledger(account=checking)
-        txns = ledger.get_sorted_txns_with_balance()
+        txns = ledger.get_sorted_txns()
         self.assertEqual(len(txns), 1)
         self.assertEqual(txns[0].splits[checking], {'amount': -10})
 
@@ -2224,7 +3331,7 @@ class TestQtGUI(unittest.TestCase):
         QtTest.QTest.mouseClick(ledger_display.txns_display.edit_txn_display._widgets['save_btn'], QtCore.Qt.LeftButton)
         #make sure edit was saved
         ledger = storage.get_ledger(account=checking)
-        txns = ledger.get_sorted_txns_with_balance()
+        txns = ledger.get_sorted_txns()
         self.assertEqual(len(txns), 4)
         self.assertEqual(txns[2].txn_date, date(2017, 12, 31))
         self.assertEqual(txns[2].splits[checking], {'amount': 20})
@@ -2261,7 +3368,7 @@ class TestQtGUI(unittest.TestCase):
         QtTest.QTest.mouseClick(ledger_display.txns_display.edit_txn_display._widgets['save_btn'], QtCore.Qt.LeftButton)
         #make sure new category was saved
         ledger = storage.get_ledger(account=checking)
-        txns = ledger.get_sorted_txns_with_balance()
+        txns = ledger.get_sorted_txns()
         self.assertEqual(txns[1].splits[restaurants], {'amount': -17})
 
     def test_ledger_txn_edit_multiple_splits(self):
@@ -2307,7 +3414,7 @@ class TestQtGUI(unittest.TestCase):
         QtTest.QTest.mouseClick(ledger_display.txns_display.edit_txn_display._widgets['delete_btn'], QtCore.Qt.LeftButton)
         #make sure txn was deleted
         ledger = storage.get_ledger(account=checking)
-        txns = ledger.get_sorted_txns_with_balance()
+        txns = ledger.get_sorted_txns()
         self.assertEqual(len(txns), 1)
         self.assertEqual(txns[0].splits[checking], {'amount': 23})
 
@@ -2344,7 +3451,7 @@ class TestQtGUI(unittest.TestCase):
         gui.storage.save_txn(txn)
         QtTest.QTest.mouseClick(gui.ledger_button, QtCore.Qt.LeftButton) #go to ledger page
         QtTest.QTest.mouseClick(gui.ledger_display.txns_display.txn_display_data[txn.id]['widgets']['labels']['status'], QtCore.Qt.LeftButton) #click to change status
-        txns = gui.storage.get_ledger(checking).get_sorted_txns_with_balance()
+        txns = gui.storage.get_ledger(checking).get_sorted_txns()
         self.assertEqual(txns[0].splits[checking]['status'], bb.Transaction.CLEARED)
 
     def test_budget_display(self):
@@ -2472,13 +3579,35 @@ class TestImport(unittest.TestCase):
         self.assertEqual(len(payees), 2)
         checking = storage.get_account(name='Checking')
         ledger = storage.get_ledger(checking)
-        txns = ledger.get_sorted_txns_with_balance()
+        txns = ledger.get_sorted_txns()
         self.assertEqual(len(txns), 4)
         self.assertEqual(txns[1].payee.name, 'A restaurant')
         balances = ledger.get_current_balances_for_display()
         expected_balances = bb.LedgerBalances(current='742.78', current_cleared='842.78')
         self.assertEqual(balances, expected_balances)
 
+    def test_kmymoney_skips_txns_that_fail_to_save(self):
+        storage = bb.SQLiteStorage(':memory:')
+        save_txn = storage.save_txn
+        saved_txns = []
+        def _save_txn(txn):
+            #fail the first txn, save the rest
+            if not saved_txns:
+                saved_txns.append(None)
+                raise Exception('bad txn')
+            save_txn(txn)
+            saved_txns.append(txn)
+        with open('import_test.kmy', 'rb') as f:
+            with patch.object(storage, 'save_txns', side_effect=Exception('batch failed')):
+                with patch.object(storage, 'save_txn', side_effect=_save_txn):
+                    with patch('builtins.print') as print_mock:
+                        bb.import_kmymoney(kmy_file=f, storage=storage)
+        num_txns = storage._db_connection.execute('SELECT COUNT(*) FROM transactions').fetchone()[0]
+        self.assertEqual(num_txns, len(saved_txns) - 1)
+        self.assertTrue(num_txns > 0)
+        errors = [c[0][0] for c in print_mock.call_args_list if c[0][0].startswith('error migrating transaction: bad txn')]
+        self.assertEqual(len(errors), 1)
+
 
 if __name__ == '__main__':
     import sys